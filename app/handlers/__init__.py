@@ -2,10 +2,11 @@
 
 import json
 import functools
-from typing import Any
+from typing import Any, Optional
 
+from aiogram.exceptions import TelegramBadRequest
 from aiogram.fsm.context import FSMContext
-from aiogram.types import Message, CallbackQuery, InlineKeyboardButton
+from aiogram.types import Message, CallbackQuery, InlineKeyboardButton, InlineKeyboardMarkup
 from aiogram.types.user import User
 
 from utils import messages
@@ -16,72 +17,91 @@ from utils import __
 DEFAULT_USER_OPTIONS = {
     'active_book': 0,
     'hl': 'en',
+    'report_mode': 'chart',
 }
 
 
+@functools.lru_cache(maxsize=1024)
+def _parse_user_options(options: str) -> dict[str, Any]:
+    """Parse user options stored in DB, using defaults for missing ones."""
+    user_options = {key: DEFAULT_USER_OPTIONS[key] for key in DEFAULT_USER_OPTIONS}
+    user_options.update(json.loads(options))
+    return user_options
+
+
 class DBUser:
     """Works with user data in DB."""
-    db: models.DB
+    db: models.AsyncDB
     from_user: User
     user: Any
     user_options: dict[str, Any] = {}
 
-    def __init__(self, db: models.DB, from_user: User) -> None:
+    def __init__(self, db: models.AsyncDB, from_user: User, user: Any) -> None:
         self.db = db
         self.from_user = from_user
-        self.user = self.db.get_user_by(id=self.from_user.id)
-        if not self.user:
-            self.db.add_user(
-                id=self.from_user.id,
-                username=self.from_user.username,
-                full_name=self.from_user.full_name,
-                language=self.from_user.language_code,
+        self.user = user
+        self.user_options = dict(_parse_user_options(self.user.options))
+
+    @classmethod
+    async def load(cls, db: models.AsyncDB, from_user: User) -> 'DBUser':
+        """Loads user from DB, creating the record on first visit."""
+        user = await db.get_user_by(id=from_user.id)
+        if not user:
+            await db.add_user(
+                id=from_user.id,
+                username=from_user.username,
+                full_name=from_user.full_name,
+                language=from_user.language_code,
                 options=json.dumps(DEFAULT_USER_OPTIONS),
             )
-            self.user = self.db.get_user_by(id=from_user.id)
-        self.user_options = {key: DEFAULT_USER_OPTIONS[key] for key in DEFAULT_USER_OPTIONS}
-        self.user_options.update(json.loads(self.user.options))
+            user = await db.get_user_by(id=from_user.id)
+            # Handler is going to reply, the database is not locked meanwhile.
+            await db.commit_unit_of_work()
+        return cls(db, from_user, user)
 
-    def active_book(self) -> Any:
+    async def active_book(self) -> Any:
         """Returns active book for the user."""
         if not self.user_options['active_book']:
             return False
-        book = self.db.get_book_by(
-            id=self.user_options['active_book'],
-            deleted=False
+        book = await self.db.get_active_book(
+            user_id=self.from_user.id,
+            book_id=self.user_options['active_book']
         )
         if not book:
             return False
-        if book.user_id == self.from_user.id:
-            return book
-        shared_book = self.db.get_shared_book_by(
-            book_id=self.user_options['active_book'],
-            user_id=self.from_user.id,
-            disabled=False,
-            deleted=False
-        )
-        if shared_book:
-            return book
-        return False
+        return book
 
-    def update_active_book(self, book_id: int):
+    async def update_active_book(self, book_id: int):
         """Update active book for current user."""
         self.user_options['active_book'] = book_id
-        self.db.update_user(id=self.user.id, options=json.dumps(self.user_options))
+        await self.db.update_user(id=self.user.id, options=json.dumps(self.user_options))
 
-    def update_language(self, language: str):
+    async def update_language(self, language: str):
         """Update language for current user."""
         self.user_options['hl'] = language
-        self.db.update_user(id=self.user.id, options=json.dumps(self.user_options))
+        await self.db.update_user(id=self.user.id, options=json.dumps(self.user_options))
+
+    async def update_report_mode(self, report_mode: str):
+        """Update report mode for current user."""
+        self.user_options['report_mode'] = report_mode
+        await self.db.update_user(id=self.user.id, options=json.dumps(self.user_options))
 
 
 class HandlerBase:
     """Base class for handlers."""
-    db: models.DB
+    db: models.AsyncDB
 
-    def __init__(self, db: models.DB) -> None:
+    def __init__(self, db: models.AsyncDB) -> None:
         self.db = db
 
+    async def commit(self) -> None:
+        """Commits changes made by the handler so far.
+
+        Called after the changes and before the reply, so SQLite write lock
+        is not held while the reply is sent to Telegram.
+        """
+        await self.db.commit_unit_of_work()
+
     def active_book_required(func) -> Any:
         """Decorator that checks if current user has active book."""
         @functools.wraps(func)
@@ -94,16 +114,16 @@ class HandlerBase:
                 from_user = kwargs['from_user']
             else:
                 from_user = message_call.from_user
-            dbuser = DBUser(self.db, from_user)
-            book = dbuser.active_book()
+            dbuser = await DBUser.load(self.db, from_user)
+            book = await dbuser.active_book()
             if not book:
                 await state.clear()
                 if isinstance(message_call, CallbackQuery):
                     message = message_call.message
-                    await message.edit_reply_markup(reply_markup=None)
                 else:
                     message = message_call
-                await message.answer(
+                await self.show(
+                    message,
                     text=__(
                         text_dict=messages.ACTIVE_BOOK_REQUIRED,
                         lang=from_user.language_code
@@ -118,7 +138,55 @@ class HandlerBase:
     async def _invalid_request(self, message: Message, state: FSMContext) -> None:
         """Shows 'Invalid request' message."""
         await state.clear()
-        await message.answer(text='Invalid request.')
+        await self.show(message, text='Invalid request.')
+
+    @staticmethod
+    def _is_keyboard(message: Message) -> bool:
+        """Returns True if message is a bot message with inline keyboard, i.e. a tapped one."""
+        return (
+            isinstance(message, Message)
+            and message.from_user is not None
+            and message.from_user.is_bot
+            and message.text is not None
+            and message.reply_markup is not None
+        )
+
+    async def show(
+        self,
+        message: Message,
+        text: str,
+        reply_markup: Optional[InlineKeyboardMarkup] = None
+    ) -> Message:
+        """Shows next step of the dialog and returns message showing it.
+
+        Bot message with inline keyboard is edited in place, so a tap
+        takes one request and chat is not filled with stale keyboards.
+        Otherwise, or if the message can't be edited any more, new message
+        is sent. Returned message has no keyboard of the previous step, so
+        one more step shown with it goes to a new message.
+        """
+        if self._is_keyboard(message):
+            try:
+                edited = await message.edit_text(text=text, reply_markup=reply_markup)
+            except TelegramBadRequest as error:
+                if 'message is not modified' in error.message:
+                    return message
+            else:
+                if isinstance(edited, Message):
+                    return edited
+        return await message.answer(text=text, reply_markup=reply_markup)
+
+    async def drop_keyboard(self, message: Message) -> Message:
+        """Removes keyboard of a tapped message before output it can't turn into, e.g. charts."""
+        if self._is_keyboard(message):
+            try:
+                edited = await message.edit_reply_markup(reply_markup=None)
+            except TelegramBadRequest:
+                pass
+            else:
+                if isinstance(edited, Message):
+                    return edited
+        return message
 
     def back_button(self, hl: str = 'en') -> InlineKeyboardButton:
         """Returns 'back' button."""
@@ -42,7 +42,7 @@ class BooksState(StatesGroup):
 class Books(HandlerBase):
     """Handler class for /books workflow."""
 
-    def __init__(self, db: models.DB, dp: Dispatcher, router: Router) -> None:
+    def __init__(self, db: models.AsyncDB, dp: Dispatcher, router: Router) -> None:
         super().__init__(db)
         dp.message.register(self.books, Command('books'))
         router.callback_query.register(self.books_callback, BooksState.book)
@@ -67,8 +67,8 @@ class Books(HandlerBase):
         await state.clear()
         await state.set_state(BooksState.book)
         from_user = from_user or message.from_user
-        dbuser = DBUser(self.db, from_user)
-        books = self.db.get_books_by(
+        dbuser = await DBUser.load(self.db, from_user)
+        books = await self.db.get_books_by(
             user_id=from_user.id,
             deleted=False
         )
@@ -86,7 +86,7 @@ class Books(HandlerBase):
                     callback_data=str(book.id)
                 )
             )
-        shared_books = self.db.get_shared_books_by(
+        shared_books = await self.db.get_shared_books_by(
             user_id=from_user.id,
             disabled=False,
             deleted=False
@@ -113,7 +113,8 @@ class Books(HandlerBase):
             )
         ])
         keyboard_inline = InlineKeyboardMarkup(inline_keyboard=button_groups)
-        await message.answer(
+        await self.show(
+            message,
             text=__(
                 text_dict=messages.BOOKS_WELCOME,
                 lang=from_user.language_code
@@ -123,7 +124,6 @@ class Books(HandlerBase):
 
     async def books_callback(self, call: CallbackQuery, state: FSMContext) -> None:
         """Callback for ook selector."""
-        await call.message.edit_reply_markup(reply_markup=None)
         if call.data == '/new':
             await state.update_data(book='/new')
             await self.title(call.message, state, call.from_user)
@@ -147,7 +147,7 @@ class Books(HandlerBase):
         from_user = from_user or message.from_user
         data = await state.get_data()
         shared_book_id = int(data['book'])
-        shared_book = self.db.get_shared_book_by(
+        shared_book = await self.db.get_shared_book_by(
             id=shared_book_id,
             user_id=from_user.id,
             disabled=False,
@@ -170,7 +170,8 @@ class Books(HandlerBase):
             ],
         ]
         keyboard_inline = InlineKeyboardMarkup(inline_keyboard=button_groups)
-        await message.answer(
+        await self.show(
+            message,
             text=__(
                 text_dict=messages.BOOKS_SELECTED,
                 lang=from_user.language_code
@@ -184,11 +185,10 @@ class Books(HandlerBase):
 
     async def shared_actions_callback(self, call: CallbackQuery, state: FSMContext) -> None:
         """Callback for actions for shared book."""
-        await call.message.edit_reply_markup(reply_markup=None)
-        dbuser = DBUser(self.db, call.from_user)
+        dbuser = await DBUser.load(self.db, call.from_user)
         data = await state.get_data()
         shared_book_id = int(data['book'])
-        shared_book = self.db.get_shared_book_by(
+        shared_book = await self.db.get_shared_book_by(
             id=shared_book_id,
             user_id=call.from_user.id,
             disabled=False,
@@ -202,9 +202,11 @@ class Books(HandlerBase):
             return
         if call.data == '/join':
             await state.clear()
-            dbuser = DBUser(self.db, call.from_user)
-            dbuser.update_active_book(shared_book.book_id)
-            await call.message.answer(
+            dbuser = await DBUser.load(self.db, call.from_user)
+            await dbuser.update_active_book(shared_book.book_id)
+            await self.commit()
+            await self.show(
+                call.message,
                 text=__(
                     text_dict=messages.BOOKS_CONNECTED,
                     lang=call.from_user.language_code
@@ -216,11 +218,13 @@ class Books(HandlerBase):
             return
         if call.data == '/disconnect':
             await state.clear()
-            dbuser = DBUser(self.db, call.from_user)
-            self.db.update_shared_book(id=shared_book_id, deleted=True)
+            dbuser = await DBUser.load(self.db, call.from_user)
+            await self.db.update_shared_book(id=shared_book_id, deleted=True)
             if dbuser.user_options['active_book'] == shared_book.book_id:
-                dbuser.update_active_book(0)
-            await call.message.answer(
+                await dbuser.update_active_book(0)
+            await self.commit()
+            notice = await self.show(
+                call.message,
                 text=__(
                     text_dict=messages.BOOKS_DISCONNECTED,
                     lang=call.from_user.language_code
@@ -229,7 +233,7 @@ class Books(HandlerBase):
                     currency=shared_book.currency
                 ),
             )
-            await self.books(call.message, state, call.from_user)
+            await self.books(notice, state, call.from_user)
             return
         await self._invalid_request(call.message, state)
 
@@ -244,7 +248,7 @@ class Books(HandlerBase):
         from_user = from_user or message.from_user
         data = await state.get_data()
         book_id = int(data['book'])
-        book = self.db.get_book_by(
+        book = await self.db.get_book_by(
             user_id=from_user.id,
             id=book_id,
             deleted=False
@@ -282,7 +286,8 @@ class Books(HandlerBase):
             ]
         ]
         keyboard_inline = InlineKeyboardMarkup(inline_keyboard=button_groups)
-        await message.answer(
+        await self.show(
+            message,
             text=__(
                 text_dict=messages.BOOKS_SELECTED,
                 lang=from_user.language_code
@@ -292,11 +297,10 @@ class Books(HandlerBase):
 
     async def actions_callback(self, call: CallbackQuery, state: FSMContext) -> None:
         """Callback for actions for own book."""
-        await call.message.edit_reply_markup(reply_markup=None)
-        dbuser = DBUser(self.db, call.from_user)
+        dbuser = await DBUser.load(self.db, call.from_user)
         data = await state.get_data()
         book_id = int(data['book'])
-        book = self.db.get_book_by(
+        book = await self.db.get_book_by(
             user_id=call.from_user.id,
             id=book_id,
             deleted=False
@@ -318,9 +322,11 @@ class Books(HandlerBase):
             return
         if call.data == '/join':
             await state.clear()
-            dbuser = DBUser(self.db, call.from_user)
-            dbuser.update_active_book(book_id)
-            await call.message.answer(
+            dbuser = await DBUser.load(self.db, call.from_user)
+            await dbuser.update_active_book(book_id)
+            await self.commit()
+            await self.show(
+                call.message,
                 text=__(
                     text_dict=messages.BOOKS_CONNECTED,
                     lang=call.from_user.language_code
@@ -329,17 +335,19 @@ class Books(HandlerBase):
             return
         if call.data == '/delete':
             await state.clear()
-            dbuser = DBUser(self.db, call.from_user)
-            self.db.update_book(id=book.id, deleted=True)
+            dbuser = await DBUser.load(self.db, call.from_user)
+            await self.db.update_book(id=book.id, deleted=True)
             if dbuser.user_options['active_book'] == book.id:
-                dbuser.update_active_book(0)
-            await call.message.answer(
+                await dbuser.update_active_book(0)
+            await self.commit()
+            notice = await self.show(
+                call.message,
                 text=__(
                     text_dict=messages.BOOKS_DELETED,
                     lang=call.from_user.language_code
                 ).format(title=book.title, currency=book.currency),
             )
-            await self.books(call.message, state, call.from_user)
+            await self.books(notice, state, call.from_user)
             return
         await self._invalid_request(call.message, state)
 
@@ -352,7 +360,8 @@ class Books(HandlerBase):
         """Displays message and ask user to enter book title."""
         await state.set_state(BooksState.title)
         from_user = from_user or message.from_user
-        await message.answer(
+        await self.show(
+            message,
             text=__(
                 text_dict=messages.BOOKS_ADD_TITLE,
                 lang=from_user.language_code
@@ -386,7 +395,7 @@ class Books(HandlerBase):
                 ),
             )
             return
-        book = self.db.get_book_by(
+        book = await self.db.get_book_by(
             user_id=message.from_user.id,
             title=title,
             deleted=False
@@ -405,7 +414,7 @@ class Books(HandlerBase):
             await self.currency(message, state, message.from_user)
             return
         book_id = int(data['book'])
-        book = self.db.get_book_by(
+        book = await self.db.get_book_by(
             user_id=message.from_user.id,
             id=book_id,
             deleted=False
@@ -413,7 +422,8 @@ class Books(HandlerBase):
         if not book:
             await self._invalid_request(message, state)
             return
-        self.db.update_book(id=book_id, title=title)       
+        await self.db.update_book(id=book_id, title=title)       
+        await self.commit()
         await message.answer(
             text=__(
                 text_dict=messages.BOOKS_TITLE_UPDATED,
@@ -443,7 +453,8 @@ class Books(HandlerBase):
                 button_groups.append([])
             button_groups[-1].append(button)
         keyboard_inline = InlineKeyboardMarkup(inline_keyboard=button_groups)
-        await message.answer(
+        await self.show(
+            message,
             text=__(
                 text_dict=messages.BOOKS_SET_CURRENCY,
                 lang=from_user.language_code
@@ -453,10 +464,9 @@ class Books(HandlerBase):
 
     async def currency_callback(self, call: CallbackQuery, state: FSMContext) -> None:
         """Callback for currency selector."""
-        await call.message.edit_reply_markup(reply_markup=None)
         currency = call.data
         if currency not in CURRENCIES:
-            self._invalid_request(call.message, state=state)
+            await self._invalid_request(call.message, state=state)
             return
         await state.update_data(currency=currency)
         data = await state.get_data()
@@ -464,7 +474,7 @@ class Books(HandlerBase):
             await self.import_categories(call.message, state, call.from_user)
             return
         book_id = int(data['book'])
-        book = self.db.get_book_by(
+        book = await self.db.get_book_by(
             user_id=call.from_user.id,
             id=book_id,
             deleted=False
@@ -472,14 +482,16 @@ class Books(HandlerBase):
         if not book:
             await self._invalid_request(call.message, state=state)
             return
-        self.db.update_book(id=book_id, currency=currency)       
-        await call.message.answer(
+        await self.db.update_book(id=book_id, currency=currency)       
+        await self.commit()
+        notice = await self.show(
+            call.message,
             text=__(
                 text_dict=messages.BOOKS_CURRENCY_UPDATED,
                 lang=call.from_user.language_code
             ),
         )
-        await self.actions(call.message, state, call.from_user)
+        await self.actions(notice, state, call.from_user)
 
     async def import_categories(
         self,
@@ -501,7 +513,8 @@ class Books(HandlerBase):
             ),
         ]
         keyboard_inline = InlineKeyboardMarkup(inline_keyboard=[buttons])
-        await message.answer(
+        await self.show(
+            message,
             text=__(
                 text_dict=messages.BOOKS_CREATE_DEFAULT_CATEGORIES,
                 lang=from_user.language_code
@@ -511,7 +524,6 @@ class Books(HandlerBase):
 
     async def import_categories_callback(self, call: CallbackQuery, state: FSMContext) -> None:
         """Callback for import_categories."""
-        await call.message.edit_reply_markup(reply_markup=None)
         data = await state.get_data()
         await state.clear()
         default_expense_categories = {}
@@ -525,7 +537,7 @@ class Books(HandlerBase):
                 text_dict=DEFAULT_INCOME_CATEGORIES,
                 lang=call.from_user.language_code
             )
-        book_ids = self.db.add_book(
+        book_ids = await self.db.add_book(
             user_id=call.from_user.id,
             title=data['title'],
             currency=data['currency'],
@@ -533,7 +545,9 @@ class Books(HandlerBase):
             default_income_categories=default_income_categories,
             default_expense_categories=default_expense_categories
         )
-        await call.message.answer(
+        await self.commit()
+        notice = await self.show(
+            call.message,
             text=__(
                 text_dict=messages.BOOKS_SUCCESSFULLY_CREATED,
                 lang=call.from_user.language_code
@@ -543,7 +557,7 @@ class Books(HandlerBase):
                 book_uid=book_ids['book_uid']
             ),
         )
-        await self.books(call.message, state, call.from_user)
+        await self.books(notice, state, call.from_user)
         return
 
     async def category_type(
@@ -569,7 +583,8 @@ class Books(HandlerBase):
             buttons,
             [self.back_button(from_user.language_code)]
         ])
-        await message.answer(
+        await self.show(
+            message,
             text=__(
                 text_dict=messages.CATEGORIES_TYPE_WELCOME,
                 lang=from_user.language_code
@@ -579,7 +594,6 @@ class Books(HandlerBase):
 
     async def category_type_callback(self, call: CallbackQuery, state: FSMContext) -> None:
         """Callback for category type selector."""
-        await call.message.edit_reply_markup(reply_markup=None)
         if call.data == '/back':
             await self.actions(call.message, state, call.from_user)
             return
@@ -611,7 +625,7 @@ class Books(HandlerBase):
         from_user = from_user or message.from_user
         data = await state.get_data()
         book_id = int(data['book'])
-        book = self.db.get_book_by(
+        book = await self.db.get_book_by(
             user_id=from_user.id,
             id=book_id,
             deleted=False
@@ -619,19 +633,14 @@ class Books(HandlerBase):
         if not book:
             await self._invalid_request(message, state)
             return
+        category_tree = await self.db.get_category_tree(book.id)
         parent_category = None
         if 'parent_category' in data:
-            parent_category = self.db.get_category_by(
-                book_id=book.id,
-                id=int(data['parent_category']),
-                category_type=data['category_type'],
-                deleted=False,
-            )
-        categories = self.db.get_categories_by(
-            book_id=book.id,
-            category_type=data['category_type'],
-            parent_id=(0 if not parent_category else parent_category.id),
-            deleted=False
+            parent_category = category_tree.get(
+                int(data['parent_category']), data['category_type'])
+        categories = category_tree.get_children(
+            (0 if not parent_category else parent_category.id),
+            data['category_type']
         )
         button_groups = []
         buttons = [
@@ -668,7 +677,8 @@ class Books(HandlerBase):
         ])
         keyboard_inline = InlineKeyboardMarkup(inline_keyboard=button_groups)
         if not parent_category:
-            await message.answer(
+            await self.show(
+                message,
                 text=__(
                     text_dict=messages.CATEGORIES_WELCOME,
                     lang=from_user.language_code
@@ -676,7 +686,8 @@ class Books(HandlerBase):
                 reply_markup=keyboard_inline,
             )
         else:
-            await message.answer(
+            await self.show(
+                message,
                 text=__(
                     text_dict=messages.CATEGORIES_WELCOME_TO_CATEGORY,
                     lang=from_user.language_code
@@ -686,10 +697,9 @@ class Books(HandlerBase):
 
     async def categories_callback(self, call: CallbackQuery, state: FSMContext) -> None:
         """Callback for category selector."""
-        await call.message.edit_reply_markup(reply_markup=None)
         data = await state.get_data()
         book_id = int(data['book'])
-        book = self.db.get_book_by(
+        book = await self.db.get_book_by(
             user_id=call.from_user.id,
             id=book_id,
             deleted=False
@@ -697,14 +707,11 @@ class Books(HandlerBase):
         if not book:
             await self._invalid_request(call.message, state)
             return
+        category_tree = await self.db.get_category_tree(book.id)
         parent_category = None
         if 'parent_category' in data:
-            parent_category = self.db.get_category_by(
-                book_id=book.id,
-                id=int(data['parent_category']),
-                category_type=data['category_type'],
-                deleted=False
-            )
+            parent_category = category_tree.get(
+                int(data['parent_category']), data['category_type'])
 
         if call.data == '/new':
             await state.update_data(category='/new')
@@ -719,15 +726,14 @@ class Books(HandlerBase):
             await self.category_limit(call.message, state, call.from_user)
             return
         if call.data == '/delete':
-            category = self.db.get_category_by(
-                book_id=book.id,
-                id=int(data['parent_category']),
-                deleted=False
-            )
+            message = call.message
+            category = category_tree.get(int(data['parent_category']))
             if category:
-                self.db.delete_category(category.id)
+                await self.db.delete_category(category.id)
+                await self.commit()
                 await state.update_data(parent_category=category.parent_id)
-                await call.message.answer(
+                message = await self.show(
+                    message,
                     text=__(
                         text_dict=messages.CATEGORIES_DELETED,
                         lang=call.from_user.language_code
@@ -735,18 +741,13 @@ class Books(HandlerBase):
                 )
             else:
                 await state.update_data(parent_category=0)
-            await self._categories(call.message, state, call.from_user)
+            await self._categories(message, state, call.from_user)
             return
         if call.data == '/back':
             if not parent_category:
                 await self.category_type(call.message, state, call.from_user)
                 return
-            category = self.db.get_category_by(
-                book_id=book.id,
-                id=int(data['parent_category']),
-                category_type=data['category_type'],
-                deleted=False
-            )
+            category = category_tree.get(int(data['parent_category']), data['category_type'])
             if category:
                 await state.update_data(parent_category=category.parent_id)
             else:
@@ -755,12 +756,7 @@ class Books(HandlerBase):
             return
 
         category_id = int(call.data)
-        category = self.db.get_category_by(
-            book_id=book.id,
-            id=category_id,
-            category_type=data['category_type'],
-            deleted=False
-        )
+        category = category_tree.get(category_id, data['category_type'])
         if not category:
             await self._invalid_request(call.message, state)
             return
@@ -778,7 +774,7 @@ class Books(HandlerBase):
         from_user = from_user or message.from_user
         data = await state.get_data()
         book_id = int(data['book'])
-        book = self.db.get_book_by(
+        book = await self.db.get_book_by(
             user_id=from_user.id,
             id=book_id,
             deleted=False
@@ -786,22 +782,15 @@ class Books(HandlerBase):
         if not book:
             await self._invalid_request(message, state)
             return
+        category_tree = await self.db.get_category_tree(book.id)
         parent_category = None
         if 'parent_category' in data:
-            parent_category = self.db.get_category_by(
-                book_id=book.id,
-                id=int(data['parent_category']),
-                category_type=data['category_type'],
-                deleted=False
-            )
+            parent_category = category_tree.get(
+                int(data['parent_category']), data['category_type'])
         if not parent_category:
             await self._invalid_request(message, state)
             return
-        try:
-            options = json.loads(parent_category.options)
-        except Exception:
-            options = {}
-        monthly_limit = options.get('monthly_limit')
+        monthly_limit = category_tree.get_options(parent_category.id).get('monthly_limit')
         if monthly_limit:
             monthly_limit_str = f'{monthly_limit:.2f} {book.currency}'
         else:
@@ -809,7 +798,8 @@ class Books(HandlerBase):
                 text_dict=messages.CATEGORIES_NO_LIMIT,
                 lang=from_user.language_code
             )
-        await message.answer(
+        await self.show(
+            message,
             text=__(
                 text_dict=messages.CATEGORIES_SET_LIMIT,
                 lang=from_user.language_code
@@ -820,7 +810,7 @@ class Books(HandlerBase):
         """Handles entered category limit."""
         data = await state.get_data()
         book_id = int(data['book'])
-        book = self.db.get_book_by(
+        book = await self.db.get_book_by(
             user_id=message.from_user.id,
             id=book_id,
             deleted=False
@@ -828,14 +818,11 @@ class Books(HandlerBase):
         if not book:
             await self._invalid_request(message, state)
             return
+        category_tree = await self.db.get_category_tree(book.id)
         parent_category = None
         if 'parent_category' in data:
-            parent_category = self.db.get_category_by(
-                book_id=book.id,
-                id=int(data['parent_category']),
-                category_type=data['category_type'],
-                deleted=False
-            )
+            parent_category = category_tree.get(
+                int(data['parent_category']), data['category_type'])
         if not parent_category:
             await self._invalid_request(message, state)
             return
@@ -849,12 +836,10 @@ class Books(HandlerBase):
                 ),
             )
             return
-        try:
-            options = json.loads(parent_category.options)
-        except Exception:
-            options = {}
+        options = dict(category_tree.get_options(parent_category.id))
         options['monthly_limit'] = float(limit_str)
-        self.db.update_category(id=parent_category.id, options=json.dumps(options))       
+        await self.db.update_category(id=parent_category.id, options=json.dumps(options))       
+        await self.commit()
         await message.answer(
             text=__(
                 text_dict=messages.CATEGORIES_LIMIT_UPDATED,
@@ -872,7 +857,8 @@ class Books(HandlerBase):
         """Displays message to request category title."""
         await state.set_state(BooksState.category_title)
         from_user = from_user or message.from_user
-        await message.answer(
+        await self.show(
+            message,
             text=__(
                 text_dict=messages.CATEGORIES_ADD_TITLE,
                 lang=from_user.language_code
@@ -883,7 +869,7 @@ class Books(HandlerBase):
         """Handles entered category title."""
         data = await state.get_data()
         book_id = int(data['book'])
-        book = self.db.get_book_by(
+        book = await self.db.get_book_by(
             user_id=message.from_user.id,
             id=book_id,
             deleted=False
@@ -916,20 +902,15 @@ class Books(HandlerBase):
                 ),
             )
             return
+        category_tree = await self.db.get_category_tree(book.id)
         parent_category = None
         if 'parent_category' in data:
-            parent_category = self.db.get_category_by(
-                book_id=book.id,
-                id=int(data['parent_category']),
-                category_type=data['category_type'],
-                deleted=False
-            )
-        category = self.db.get_category_by(
-            book_id=book.id,
-            parent_id=(0 if not parent_category else parent_category.id),
-            category_type=data['category_type'],
-            title=title,
-            deleted=False
+            parent_category = category_tree.get(
+                int(data['parent_category']), data['category_type'])
+        category = category_tree.get_child_by_title(
+            (0 if not parent_category else parent_category.id),
+            data['category_type'],
+            title
         )
         if category:
             await message.answer(
@@ -940,13 +921,14 @@ class Books(HandlerBase):
             )
             return
         if data['category'] == '/new':
-            self.db.add_category(
+            await self.db.add_category(
                 book_id=book.id,
                 category_type=data['category_type'],
                 parent_id=(0 if not parent_category else parent_category.id),
                 title=title,
                 deleted=False
             )    
+            await self.commit()
             await message.answer(
                 text=__(
                     text_dict=messages.CATEGORIES_SUCCESSFULLY_CREATED,
@@ -956,16 +938,12 @@ class Books(HandlerBase):
             await self._categories(message, state, message.from_user)
             return
         category_id = int(data['category'])
-        category = self.db.get_category_by(
-            book_id=book.id,
-            id=category_id,
-            category_type=data['category_type'],
-            deleted=False
-        )
+        category = category_tree.get(category_id, data['category_type'])
         if not category:
             await self._invalid_request(message, state)
             return
-        self.db.update_category(id=category_id, title=title)       
+        await self.db.update_category(id=category_id, title=title)       
+        await self.commit()
         await message.answer(
             text=__(
                 text_dict=messages.CATEGORIES_TITLE_UPDATED,
@@ -982,19 +960,19 @@ class Books(HandlerBase):
             await self._invalid_request(message, state)
             return
         book_uid = request[1]
-        book = self.db.get_book_by(book_uid=book_uid, deleted=False)
+        book = await self.db.get_book_by(book_uid=book_uid, deleted=False)
         if not book:
             await self._invalid_request(message, state)
             return
-        dbuser = DBUser(self.db, message.from_user)
+        dbuser = await DBUser.load(self.db, message.from_user)
         if book.user_id != dbuser.user.id:
-            shared_book = self.db.get_shared_book_by(
+            shared_book = await self.db.get_shared_book_by(
                 user_id=dbuser.user.id,
                 book_id=book.id,
                 deleted=False
             )
             if not shared_book:
-                self.db.add_shared_book(
+                await self.db.add_shared_book(
                     user_id=dbuser.user.id,
                     book_id=book.id,
                     disabled=False,
@@ -1008,7 +986,8 @@ class Books(HandlerBase):
                     ).format(title=book.title, currency=book.currency),
                 )
                 return
-        dbuser.update_active_book(book.id)
+        await dbuser.update_active_book(book.id)
+        await self.commit()
         await message.answer(
             text=__(
                 text_dict=messages.BOOKS_CONNECTED,
@@ -1,10 +1,11 @@
 """Handlers for expenses workflow."""
-import json
 
+import re
 from datetime import datetime
 from typing import Any, Optional
 
 from aiogram import Dispatcher, F, Router
+from aiogram.filters import StateFilter
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.types import (
@@ -22,6 +23,10 @@ from utils import models
 from utils import __
 from utils import MONTH_LABELS
 
+AMOUNT_PATTERN = re.compile(r'^[\-\+]{0,1}\d+\.{0,1}\d*$')
+# Amount followed by category, e.g. '12.50 taxi' or '12.50 food/restaurants'.
+AMOUNT_CATEGORY_PATTERN = re.compile(r'^(?P<amount>[\-\+]{0,1}\d+\.{0,1}\d*)\s+(?P<category>\D.*)$')
+
 
 class ExpensesState(StatesGroup):
     """State for expenses."""
@@ -33,9 +38,15 @@ class ExpensesState(StatesGroup):
 class Expenses(HandlerBase):
     """Handlers for expenses workflow."""
 
-    def __init__(self, db: models.DB, dp: Dispatcher, router: Router) -> None:
+    def __init__(self, db: models.AsyncDB, dp: Dispatcher, router: Router) -> None:
         super().__init__(db)
-        dp.message.register(self.expenses_message, F.text.regexp(r"^[\-\+]{0,1}\d+\.{0,1}\d*$"))
+        dp.message.register(self.expenses_message, F.text.regexp(AMOUNT_PATTERN))
+        # Text with amount may be a book or category title, so only outside other dialogs.
+        dp.message.register(
+            self.expenses_message,
+            F.text.regexp(AMOUNT_CATEGORY_PATTERN),
+            StateFilter(None, ExpensesState)
+        )
         router.callback_query.register(self.selector_category_type_callback, ExpensesState.category_type)
         router.callback_query.register(self.selector_categories_callback, ExpensesState.category)
 
@@ -46,9 +57,14 @@ class Expenses(HandlerBase):
             state: FSMContext,
             book: Optional[Any] = None
     ) -> None:
-        """Entrypoint for expenses."""
+        """Entrypoint for expenses.
+
+        If amount is followed by text matching a single category, expense
+        is recorded right away, otherwise user selects category as usual.
+        """
         await state.clear()
-        amount = round(float(message.text), 2)
+        match = AMOUNT_CATEGORY_PATTERN.match(message.text.strip())
+        amount = round(float(match['amount'] if match else message.text), 2)
         if not amount:
             await message.answer(
                 text=__(
@@ -57,6 +73,21 @@ class Expenses(HandlerBase):
                 ),
             )
             return
+        if match:
+            category_tree = await self.db.get_category_tree(book.id)
+            categories = category_tree.find(match['category'])
+            if len(categories) == 1:
+                await self._add_expense(
+                    message,
+                    state=state,
+                    from_user=message.from_user,
+                    book=book,
+                    category_tree=category_tree,
+                    category=categories[0],
+                    category_type=categories[0].category_type,
+                    amount=amount
+                )
+                return
         await state.update_data(amount=amount)
         await message.answer(
             text=__(
@@ -92,7 +123,8 @@ class Expenses(HandlerBase):
             ),
         ]
         keyboard_inline = InlineKeyboardMarkup(inline_keyboard=[buttons])
-        await message.answer(
+        await self.show(
+            message,
             text=__(
                 text_dict=messages.EXPENSES_SELECT_CATEGORY_TYPE,
                 lang=from_user.language_code
@@ -102,7 +134,6 @@ class Expenses(HandlerBase):
 
     async def selector_category_type_callback(self, call: CallbackQuery, state: FSMContext) -> None:
         """Callback for category type selector."""
-        await call.message.edit_reply_markup(reply_markup=None)
         if call.data == CategoryType.INCOME.name:
             await state.update_data(category_type=CategoryType.INCOME)
         else:
@@ -123,19 +154,13 @@ class Expenses(HandlerBase):
         await state.set_state(ExpensesState.category)
         from_user = from_user or message.from_user
         data = await state.get_data()
+        category_tree = await self.db.get_category_tree(book.id)
         parent_category = None
         if 'category' in data:
-            parent_category = self.db.get_category_by(
-                book_id=book.id,
-                id=int(data['category']),
-                category_type=data['category_type'],
-                deleted=False,
-            )
-        categories = self.db.get_categories_by(
-            book_id=book.id,
-            category_type=data['category_type'],
-            parent_id=(0 if not parent_category else parent_category.id),
-            deleted=False
+            parent_category = category_tree.get(int(data['category']), data['category_type'])
+        categories = category_tree.get_children(
+            (0 if not parent_category else parent_category.id),
+            data['category_type']
         )
         button_groups = []
         buttons = [
@@ -157,7 +182,8 @@ class Expenses(HandlerBase):
                 self.back_button(from_user.language_code),
             ])
             keyboard_inline = InlineKeyboardMarkup(inline_keyboard=button_groups)
-            await message.answer(
+            await self.show(
+                message,
                 text=__(
                     text_dict=messages.EXPENSES_CATEGORY_SELECT_CATEGORY,
                     lang=from_user.language_code
@@ -172,7 +198,8 @@ class Expenses(HandlerBase):
                 ),
             ])
             keyboard_inline = InlineKeyboardMarkup(inline_keyboard=button_groups)
-            await message.answer(
+            await self.show(
+                message,
                 text=__(
                     text_dict=messages.EXPENSES_ROOT_SELECT_CATEGORY,
                     lang=from_user.language_code
@@ -188,78 +215,21 @@ class Expenses(HandlerBase):
         book: Any
     ) -> None:
         """Callback for category selector."""
-        await call.message.edit_reply_markup(reply_markup=None)
         data = await state.get_data()
-        category = self.db.get_category_by(
-            book_id=book.id,
-            category_type=data['category_type'],
-            id=int(data['category']),
-            deleted=False
-        )
+        category_tree = await self.db.get_category_tree(book.id)
+        category = category_tree.get(int(data['category']), data['category_type'])
         amount = round(float(data['amount']), 2)
         if call.data == '/submit':
-            created = datetime.utcnow()
-            self.db.add_expense(
-                user_id=call.from_user.id,
-                book_id=book.id,
-                category_id=(0 if not category else category.id),
+            await self._add_expense(
+                call.message,
+                state=state,
+                from_user=call.from_user,
+                book=book,
+                category_tree=category_tree,
+                category=category,
                 category_type=data['category_type'],
-                amount=amount,
-                year=created.year,
-                month=created.month,
-                day=created.day,
-                created=created,
-                deleted=False
+                amount=amount
             )
-            total_expenses = self.db.get_expenses(
-                book_id=book.id,
-                category_id=(0 if not category else category.id),
-                year=created.year,
-                month=created.month,
-            )
-            await state.clear()
-            if category:
-                try:
-                    options = json.loads(category.options)
-                except Exception:
-                    options = {}
-                monthly_limit = options.get('monthly_limit')
-                if monthly_limit:
-                    monthly_limit_str = f'{monthly_limit:.2f} {book.currency}'
-                else:
-                    monthly_limit_str = __(
-                        text_dict=messages.CATEGORIES_NO_LIMIT,
-                        lang=call.from_user.language_code,
-                    )
-                await call.message.answer(
-                    text=__(
-                        text_dict=messages.EXPENSES_SUCCESSFULLY_CREATED_IN_CATEGORY,
-                        lang=call.from_user.language_code
-                    ).format(
-                        amount='{:.2f}'.format(amount),
-                        currency=book.currency,
-                        category_title=category.title,
-                        book_title=book.title,
-                        year=created.year,
-                        month_label=__(
-                            text_dict=MONTH_LABELS[created.month],
-                            lang=call.from_user.language_code
-                        ),
-                        total_amount='{:.2f}'.format(total_expenses or 0),
-                        monthly_limit=monthly_limit_str,
-                    )
-                )
-            else:
-                await call.message.answer(
-                    text=__(
-                        text_dict=messages.EXPENSES_SUCCESSFULLY_CREATED,
-                        lang=call.from_user.language_code
-                    ).format(
-                        amount='{:.2f}'.format(amount),
-                        currency=book.currency,
-                        book_title=book.title
-                    )
-                )
             return
         if call.data == '/back':
             if category:
@@ -270,14 +240,83 @@ class Expenses(HandlerBase):
             return
 
         category_id = int(call.data)
-        category = self.db.get_category_by(
-            book_id=book.id,
-            category_type=data['category_type'],
-            id=category_id,
-            deleted=False
-        )
+        category = category_tree.get(category_id, data['category_type'])
         if not category:
             await self._invalid_request(call.message, state=state)
             return
         await state.update_data(category=category_id)
         await self.selector_categories(call.message, state=state, from_user=call.from_user)
+
+    async def _add_expense(
+        self,
+        message: Message,
+        state: FSMContext,
+        from_user: User,
+        book: Any,
+        category_tree: models.CategoryTree,
+        category: Any,
+        category_type: CategoryType,
+        amount: float
+    ) -> None:
+        """Records expense and shows it together with month total of the category."""
+        created = datetime.utcnow()
+        await self.db.add_expense(
+            user_id=from_user.id,
+            book_id=book.id,
+            category_id=(0 if not category else category.id),
+            category_type=category_type,
+            amount=amount,
+            year=created.year,
+            month=created.month,
+            day=created.day,
+            created=created,
+            deleted=False
+        )
+        total_expenses = await self.db.get_expenses(
+            book_id=book.id,
+            category_id=(0 if not category else category.id),
+            year=created.year,
+            month=created.month,
+        )
+        await self.commit()
+        await state.clear()
+        if category:
+            monthly_limit = category_tree.get_options(category.id).get('monthly_limit')
+            if monthly_limit:
+                monthly_limit_str = f'{monthly_limit:.2f} {book.currency}'
+            else:
+                monthly_limit_str = __(
+                    text_dict=messages.CATEGORIES_NO_LIMIT,
+                    lang=from_user.language_code,
+                )
+            await self.show(
+                message,
+                text=__(
+                    text_dict=messages.EXPENSES_SUCCESSFULLY_CREATED_IN_CATEGORY,
+                    lang=from_user.language_code
+                ).format(
+                    amount='{:.2f}'.format(amount),
+                    currency=book.currency,
+                    category_title=category.title,
+                    book_title=book.title,
+                    year=created.year,
+                    month_label=__(
+                        text_dict=MONTH_LABELS[created.month],
+                        lang=from_user.language_code
+                    ),
+                    total_amount='{:.2f}'.format(total_expenses or 0),
+                    monthly_limit=monthly_limit_str,
+                )
+            )
+        else:
+            await self.show(
+                message,
+                text=__(
+                    text_dict=messages.EXPENSES_SUCCESSFULLY_CREATED,
+                    lang=from_user.language_code
+                ).format(
+                    amount='{:.2f}'.format(amount),
+                    currency=book.currency,
+                    book_title=book.title
+                )
+            )
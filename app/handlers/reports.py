@@ -1,12 +1,16 @@
 """Handlers for reports workflow."""
 
+import asyncio
 import calendar
-import json
+import functools
+import hashlib
+import html
+import logging
 from datetime import datetime, timedelta
-from io import BytesIO
-from typing import Any, Optional
+from typing import Any, Awaitable, Callable, Hashable, Optional
 
 from aiogram import Dispatcher, Router
+from aiogram.exceptions import TelegramBadRequest
 from aiogram.filters import Command
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
@@ -15,18 +19,39 @@ from aiogram.types import (
     CallbackQuery,
     InlineKeyboardButton,
     InlineKeyboardMarkup,
+    InputMediaPhoto,
 )
 from aiogram.types.user import User
 from aiogram.types.input_file import BufferedInputFile
-import matplotlib.pyplot as plt
 
-from handlers import HandlerBase
+from handlers import HandlerBase, DBUser
 from utils import CategoryType
+from utils import charts
 from utils import messages
 from utils import models
 from utils import __
+from utils.cache import LRUCache, SingleFlight
+from utils.scheduler import JobScheduler, QueueFull
 from utils import MONTH_LABELS
 
+# Queued reports are started in order of priority, lower value first.
+# Daily reports are interactive, they are never rejected.
+PRIORITY_DAY = 0
+PRIORITY_MONTH = 1
+PRIORITY_YEAR = 2
+
+AUTO_TEXT_REPORT_MAX_ROWS = 10
+TEXT_REPORT_TITLE_WIDTH = 20
+
+_NOT_CACHED = object()
+# Chart of a report as (kind, (year, month, day), category type).
+ChartKey = tuple[str, tuple[Optional[int], Optional[int], Optional[int]], CategoryType]
+# Renders chart from data loaded already.
+ChartRender = Callable[[], Awaitable[charts.Chart]]
+# Chart key and function loading its data, which returns render of the
+# chart or None if there is no data.
+ChartSpec = tuple[ChartKey, Callable[[], Awaitable[Optional[ChartRender]]]]
+
 
 class ReportState(StatesGroup):
     """State for reports."""
@@ -39,8 +64,38 @@ class ReportState(StatesGroup):
 class Reports(HandlerBase):
     """Handler class for reports workflow."""
 
-    def __init__(self, db: models.DB, dp: Dispatcher, router: Router) -> None:
+    renderer: charts.ChartRenderer
+    charts_cache: LRUCache
+    charts_flights: SingleFlight
+    scheduler: JobScheduler
+
+    def __init__(
+        self,
+        db: models.AsyncDB,
+        dp: Dispatcher,
+        router: Router,
+        renderer: charts.ChartRenderer,
+        charts_cache_size: int = 32 * 1024 * 1024,
+        max_concurrent_reports: int = 2,
+        max_queued_reports: int = 20
+    ) -> None:
         super().__init__(db)
+        self.renderer = renderer
+        # Missing charts are cached too, so every entry weighs at least
+        # as much as its key.
+        self.charts_cache = LRUCache(
+            maxsize=charts_cache_size,
+            weigher=lambda chart: len(chart.image_png) + 256 if chart else 256
+        )
+        self.charts_flights = SingleFlight()
+        # Only reports with charts to render are scheduled, queued ones
+        # wait apart from updates being handled.
+        self.scheduler = JobScheduler(
+            max_concurrency=max_concurrent_reports,
+            max_queue=max_queued_reports,
+            min_rejected_priority=PRIORITY_MONTH
+        )
+        self._reports: set[asyncio.Task] = set()
         dp.message.register(self.today, Command('today'))
         dp.message.register(self.year, Command('year'))
         dp.message.register(self.month, Command('month'))
@@ -59,33 +114,15 @@ class Reports(HandlerBase):
         """Entrypoint for 'Today's expenses'."""
         await state.clear()
         ct = datetime.utcnow()
-        income_exists = await self.per_category_report(
-            message,
-            state=state,
-            from_user=message.from_user,
-            book=book,
-            category_type=CategoryType.INCOME,
-            year=ct.year,
-            month=ct.month,
-            day=ct.day
-        )
-        expense_exists = await self.per_category_report(
+        await self.daily_report(
             message,
-            state=state,
             from_user=message.from_user,
             book=book,
-            category_type=CategoryType.EXPENSE,
             year=ct.year,
             month=ct.month,
-            day=ct.day
+            day=ct.day,
+            no_data_reply=True
         )
-        if not any((income_exists, expense_exists)):
-            await message.answer(
-                text=__(
-                    text_dict=messages.REPORTS_NO_DATA,
-                    lang=message.from_user.language_code
-                ),
-            )
 
     @HandlerBase.active_book_required
     async def year(
@@ -142,9 +179,10 @@ class Reports(HandlerBase):
     ) -> None:
         """Displays message with year selector."""
         from_user = from_user or message.from_user
-        records = self.db.get_expenses_per_year(book.id, category_type=None)
+        records = await self.db.get_expenses_per_year(book.id, category_type=None)
         if not records:
-            await message.answer(
+            await self.show(
+                message,
                 text=__(
                     text_dict=messages.REPORTS_NO_DATA,
                     lang=from_user.language_code
@@ -159,7 +197,7 @@ class Reports(HandlerBase):
             elif data['report_type'] in ('month', 'day'):
                 await self.selector_month(message, state=state, from_user=from_user)
             else:
-                self._invalid_request(message, state=state)
+                await self._invalid_request(message, state=state)
             return
         await state.set_state(ReportState.year)
         button_groups = []
@@ -173,7 +211,8 @@ class Reports(HandlerBase):
                 button_groups.append([])
             button_groups[-1].append(button)
         keyboard_inline = InlineKeyboardMarkup(inline_keyboard=button_groups)
-        await message.answer(
+        await self.show(
+            message,
             text=__(
                 text_dict=messages.REPORTS_SELECT_YEAR,
                 lang=from_user.language_code
@@ -183,7 +222,6 @@ class Reports(HandlerBase):
 
     async def selector_year_callback(self, call: CallbackQuery, state: FSMContext) -> None:
         """Callback for year selector."""
-        await call.message.edit_reply_markup(reply_markup=None)
         year = int(call.data)
         await state.update_data(year=year)
         data = await state.get_data()
@@ -194,7 +232,7 @@ class Reports(HandlerBase):
             await self.selector_month(call.message, state=state, from_user=call.from_user)
             return
         else:
-            self._invalid_request(call.message, state=state)
+            await self._invalid_request(call.message, state=state)
             return
 
     @HandlerBase.active_book_required
@@ -206,37 +244,26 @@ class Reports(HandlerBase):
         from_user: Optional[User] = None
     ) -> None:
         """Report for the specified year."""
+        message = await self.drop_keyboard(message)
         data = await state.get_data()
         await state.clear()
-        await self.per_category_report(
-            message,
-            state=state,
-            from_user=from_user,
-            book=book,
-            category_type=CategoryType.INCOME,
-            year=data['year']
-        )
-        await self.per_month_report(
-            message,
-            from_user=from_user,
-            book=book,
-            category_type=CategoryType.INCOME,
-            year=data['year']
-        )
-        await self.per_category_report(
+        await self._schedule_report(
             message,
-            state=state,
             from_user=from_user,
             book=book,
-            category_type=CategoryType.EXPENSE,
-            year=data['year']
-        )
-        await self.per_month_report(
-            message,
-            from_user=from_user,
-            book=book,
-            category_type=CategoryType.EXPENSE,
-            year=data['year']
+            priority=PRIORITY_YEAR,
+            chart_keys=[
+                (kind, (data['year'], None, None), category_type)
+                for category_type in (CategoryType.INCOME, CategoryType.EXPENSE)
+                for kind in ('per_category', 'per_month')
+            ],
+            report=functools.partial(
+                self.yearly_report,
+                message,
+                from_user=from_user,
+                book=book,
+                year=data['year']
+            )
         )
 
     @HandlerBase.active_book_required
@@ -251,9 +278,10 @@ class Reports(HandlerBase):
         from_user = from_user or message.from_user
         data = await state.get_data()
         year = int(data['year'])
-        records = self.db.get_expenses_per_month(book.id, category_type=None, year=year)
+        records = await self.db.get_expenses_per_month(book.id, category_type=None, year=year)
         if not records:
-            await message.answer(
+            await self.show(
+                message,
                 text=__(
                     text_dict=messages.REPORTS_NO_DATA,
                     lang=from_user.language_code
@@ -267,7 +295,7 @@ class Reports(HandlerBase):
             elif data['report_type'] == 'day':
                 await self.selector_day(message, state=state, from_user=from_user)
             else:
-                self._invalid_request(message, state=state)
+                await self._invalid_request(message, state=state)
             return
         await state.set_state(ReportState.month)
         button_groups = []
@@ -284,7 +312,8 @@ class Reports(HandlerBase):
                 button_groups.append([])
             button_groups[-1].append(button)
         keyboard_inline = InlineKeyboardMarkup(inline_keyboard=button_groups)
-        await message.answer(
+        await self.show(
+            message,
             text=__(
                 text_dict=messages.REPORTS_SELECT_MONTH,
                 lang=from_user.language_code
@@ -294,10 +323,9 @@ class Reports(HandlerBase):
 
     async def selector_month_callback(self, call: CallbackQuery, state: FSMContext) -> None:
         """Callback for month selector."""
-        await call.message.edit_reply_markup(reply_markup=None)
         month = int(call.data)
         if month < 1 or month > 12:
-            self._invalid_request(call.message, state=state)
+            await self._invalid_request(call.message, state=state)
             return
         await state.update_data(month=month)
         data = await state.get_data()
@@ -308,7 +336,7 @@ class Reports(HandlerBase):
             await self.selector_day(call.message, state=state, from_user=call.from_user)
             return
         else:
-            self._invalid_request(call.message, state=state)
+            await self._invalid_request(call.message, state=state)
             return
 
     @HandlerBase.active_book_required
@@ -320,41 +348,27 @@ class Reports(HandlerBase):
         from_user: Optional[User] = None
     ) -> None:
         """Report for the specified month."""
+        message = await self.drop_keyboard(message)
         data = await state.get_data()
         await state.clear()
-        await self.per_category_report(
-            message,
-            state=state,
-            from_user=from_user,
-            book=book,
-            category_type=CategoryType.INCOME,
-            year=data['year'],
-            month=data['month']
-        )
-        await self.per_day_report(
-            message,
-            from_user=from_user,
-            book=book,
-            category_type=CategoryType.INCOME,
-            year=data['year'],
-            month=data['month']
-        )
-        await self.per_category_report(
+        await self._schedule_report(
             message,
-            state=state,
             from_user=from_user,
             book=book,
-            category_type=CategoryType.EXPENSE,
-            year=data['year'],
-            month=data['month']
-        )
-        await self.per_day_report(
-            message,
-            from_user=from_user,
-            book=book,
-            category_type=CategoryType.EXPENSE,
-            year=data['year'],
-            month=data['month']
+            priority=PRIORITY_MONTH,
+            chart_keys=[
+                (kind, (data['year'], data['month'], None), category_type)
+                for category_type in (CategoryType.INCOME, CategoryType.EXPENSE)
+                for kind in ('per_category', 'per_day')
+            ],
+            report=functools.partial(
+                self.monthly_report,
+                message,
+                from_user=from_user,
+                book=book,
+                year=data['year'],
+                month=data['month']
+            )
         )
 
     @HandlerBase.active_book_required
@@ -370,9 +384,10 @@ class Reports(HandlerBase):
         data = await state.get_data()
         year = int(data['year'])
         month = int(data['month'])
-        records = self.db.get_expenses_per_day(book.id, category_type=None, year=year, month=month)
+        records = await self.db.get_expenses_per_day(book.id, category_type=None, year=year, month=month)
         if not records:
-            await message.answer(
+            await self.show(
+                message,
                 text=__(
                     text_dict=messages.REPORTS_NO_DATA,
                     lang=from_user.language_code
@@ -398,7 +413,8 @@ class Reports(HandlerBase):
                 button_groups.append([])
             button_groups[-1].append(button)
         keyboard_inline = InlineKeyboardMarkup(inline_keyboard=button_groups)
-        await message.answer(
+        await self.show(
+            message,
             text=__(
                 text_dict=messages.REPORTS_SELECT_DAY,
                 lang=from_user.language_code
@@ -415,24 +431,13 @@ class Reports(HandlerBase):
         from_user: Optional[User] = None
     ) -> None:
         """Report for the specified day."""
+        message = await self.drop_keyboard(message)
         data = await state.get_data()
         await state.clear()
-        await self.per_category_report(
-            message,
-            state=state,
-            from_user=from_user,
-            book=book,
-            category_type=CategoryType.INCOME,
-            year=data['year'],
-            month=data['month'],
-            day=data['day']
-        )
-        await self.per_category_report(
+        await self.daily_report(
             message,
-            state=state,
             from_user=from_user,
             book=book,
-            category_type=CategoryType.EXPENSE,
             year=data['year'],
             month=data['month'],
             day=data['day']
@@ -440,43 +445,532 @@ class Reports(HandlerBase):
 
     async def selector_day_callback(self, call: CallbackQuery, state: FSMContext) -> None:
         """Callback for day selector."""
-        await call.message.edit_reply_markup(reply_markup=None)
         day = int(call.data)
         await state.update_data(day=day)
         await self._day(call.message, state=state, from_user=call.from_user)
 
-    async def per_category_report(
+    async def _schedule_report(
         self,
         message: Message,
-        state: FSMContext,
+        from_user: User,
+        book: Any,
+        priority: int,
+        chart_keys: list[ChartKey],
+        report: Callable[[], Awaitable[Any]]
+    ) -> None:
+        """Runs report at once or passes it to scheduler.
+
+        Report is run at once if all its charts, given as (kind, period,
+        category type), are cached, as it has nothing to render. Otherwise
+        it is run apart from the update being handled, which is done once
+        the report is scheduled, so waiting reports hold neither update
+        slots nor DB units of work.
+        """
+        if await self._charts_cached(book, from_user.language_code, chart_keys):
+            await report()
+            return
+        task = asyncio.create_task(self._run_scheduled(message, from_user, priority, report))
+        self._reports.add(task)
+        task.add_done_callback(self._reports.discard)
+
+    async def _run_scheduled(
+        self,
+        message: Message,
+        from_user: User,
+        priority: int,
+        report: Callable[[], Awaitable[Any]]
+    ) -> None:
+        """Runs report through scheduler, in DB unit of work of its own.
+
+        User is notified if report is queued, or if it is rejected because
+        too many reports are waiting already.
+        """
+        async def on_queued(position: int) -> None:
+            await message.answer(
+                text=__(
+                    text_dict=messages.REPORTS_QUEUED,
+                    lang=from_user.language_code
+                ).format(position=position),
+            )
+
+        async def job() -> None:
+            async with self.db.unit_of_work():
+                await report()
+
+        try:
+            await self.scheduler.run(priority, job, on_queued)
+        except QueueFull:
+            await message.answer(
+                text=__(
+                    text_dict=messages.REPORTS_BUSY,
+                    lang=from_user.language_code
+                ),
+            )
+        except Exception:
+            logging.exception('Report for user %s failed', from_user.id)
+
+    async def close(self) -> None:
+        """Waits for scheduled reports to be sent."""
+        if self._reports:
+            await asyncio.wait(list(self._reports))
+
+    async def yearly_report(
+        self,
+        message: Message,
+        from_user: User,
+        book: Any,
+        year: int
+    ) -> None:
+        """Sends charts for the year."""
+        chart_list = await self._charts(book, from_user.language_code, [
+            self.per_category_chart(
+                from_user=from_user,
+                book=book,
+                category_type=CategoryType.INCOME,
+                year=year
+            ),
+            self.per_month_chart(
+                from_user=from_user,
+                book=book,
+                category_type=CategoryType.INCOME,
+                year=year
+            ),
+            self.per_category_chart(
+                from_user=from_user,
+                book=book,
+                category_type=CategoryType.EXPENSE,
+                year=year
+            ),
+            self.per_month_chart(
+                from_user=from_user,
+                book=book,
+                category_type=CategoryType.EXPENSE,
+                year=year
+            ),
+        ])
+        await self._send_charts(message, chart_list)
+
+    async def monthly_report(
+        self,
+        message: Message,
+        from_user: User,
+        book: Any,
+        year: int,
+        month: int
+    ) -> None:
+        """Sends charts for the month."""
+        chart_list = await self._charts(book, from_user.language_code, [
+            self.per_category_chart(
+                from_user=from_user,
+                book=book,
+                category_type=CategoryType.INCOME,
+                year=year,
+                month=month
+            ),
+            self.per_day_chart(
+                from_user=from_user,
+                book=book,
+                category_type=CategoryType.INCOME,
+                year=year,
+                month=month
+            ),
+            self.per_category_chart(
+                from_user=from_user,
+                book=book,
+                category_type=CategoryType.EXPENSE,
+                year=year,
+                month=month
+            ),
+            self.per_day_chart(
+                from_user=from_user,
+                book=book,
+                category_type=CategoryType.EXPENSE,
+                year=year,
+                month=month
+            ),
+        ])
+        await self._send_charts(message, chart_list)
+
+    async def daily_report(
+        self,
+        message: Message,
+        from_user: User,
+        book: Any,
+        year: int,
+        month: int,
+        day: int,
+        no_data_reply: bool = False
+    ) -> None:
+        """Sends report for the day as text or charts, according to user options.
+
+        Only charts go through scheduler. If there is no data for the day,
+        user is told so with no_data_reply.
+        """
+        dbuser = await DBUser.load(self.db, from_user)
+        report_mode = dbuser.user_options['report_mode']
+        if report_mode in ('text', 'auto'):
+            category_types = (CategoryType.INCOME, CategoryType.EXPENSE)
+            # DB calls share connection of the unit of work, one at a time.
+            sections = [
+                await self._per_category_text_records(book, category_type, year, month, day)
+                for category_type in category_types
+            ]
+            rows_count = sum(len(records) for records, _ in sections)
+            if report_mode == 'text' or rows_count <= AUTO_TEXT_REPORT_MAX_ROWS:
+                if not rows_count:
+                    if no_data_reply:
+                        await self._answer_no_data(message, from_user)
+                    return
+                await message.answer(text='\n\n'.join(
+                    self._per_category_text(
+                        from_user=from_user,
+                        book=book,
+                        category_type=category_type,
+                        period=f'{year}-{month:02}-{day:02}',
+                        records=records,
+                        monthly_amounts=monthly_amounts
+                    )
+                    for category_type, (records, monthly_amounts) in zip(category_types, sections)
+                    if records
+                ))
+                return
+        await self._schedule_report(
+            message,
+            from_user=from_user,
+            book=book,
+            priority=PRIORITY_DAY,
+            chart_keys=[
+                ('per_category', (year, month, day), category_type)
+                for category_type in (CategoryType.INCOME, CategoryType.EXPENSE)
+            ],
+            report=functools.partial(
+                self._daily_charts,
+                message,
+                from_user=from_user,
+                book=book,
+                year=year,
+                month=month,
+                day=day,
+                no_data_reply=no_data_reply
+            )
+        )
+
+    async def _daily_charts(
+        self,
+        message: Message,
+        from_user: User,
+        book: Any,
+        year: int,
+        month: int,
+        day: int,
+        no_data_reply: bool
+    ) -> None:
+        """Sends charts for the day, or tells there is no data if asked to."""
+        chart_list = await self._charts(book, from_user.language_code, [
+            self.per_category_chart(
+                from_user=from_user,
+                book=book,
+                category_type=category_type,
+                year=year,
+                month=month,
+                day=day
+            )
+            for category_type in (CategoryType.INCOME, CategoryType.EXPENSE)
+        ])
+        if not chart_list:
+            if no_data_reply:
+                await self._answer_no_data(message, from_user)
+            return
+        await self._send_charts(message, chart_list)
+
+    async def _answer_no_data(self, message: Message, from_user: User) -> None:
+        """Tells user there is no data for the report."""
+        await message.answer(
+            text=__(
+                text_dict=messages.REPORTS_NO_DATA,
+                lang=from_user.language_code
+            ),
+        )
+
+    async def _per_category_text_records(
+        self,
+        book: Any,
+        category_type: CategoryType,
+        year: int,
+        month: int,
+        day: int
+    ) -> tuple[list[Any], dict[int, float]]:
+        """Returns expenses per category for the day and for its month so far."""
+        records = await self.db.get_expenses_per_category(
+            book_id=book.id,
+            category_type=category_type,
+            year=year,
+            month=month,
+            day=day
+        )
+        monthly_records = await self.db.get_expenses_per_category(
+            book_id=book.id,
+            category_type=category_type,
+            year=year,
+            month=month
+        )
+        records = [record for record in records if record.amount]
+        monthly_amounts = {record.category_id: record.amount for record in monthly_records}
+        return records, monthly_amounts
+
+    def _per_category_text(
+        self,
         from_user: User,
         book: Any,
         category_type: CategoryType,
-        year: Optional[int] = None,
+        period: str,
+        records: list[Any],
+        monthly_amounts: dict[int, float]
+    ) -> str:
+        """Per category expenses as HTML table.
+
+        Expense categories that exceeded their monthly limit are marked red,
+        ones that reached 80% of it are marked yellow.
+        """
+        rows = []
+        for record in sorted(records, key=lambda record: record.amount, reverse=True):
+            title = record.category_title or 'Uncategorized'
+            if len(title) > TEXT_REPORT_TITLE_WIDTH:
+                title = title[:TEXT_REPORT_TITLE_WIDTH - 1] + '…'
+            marker = ''
+            monthly_limit = record.monthly_limit
+            if monthly_limit and category_type == CategoryType.EXPENSE:
+                monthly_amount = monthly_amounts.get(record.category_id, record.amount)
+                if monthly_amount > monthly_limit:
+                    marker = ' 🔴'
+                elif monthly_amount > monthly_limit * 0.8:
+                    marker = ' 🟡'
+            rows.append((title, f'{record.amount:.2f}', marker))
+        total_label = __(messages.TOTAL, lang=from_user.language_code)
+        total_amount = f'{sum(record.amount for record in records):.2f}'
+        title_width = max(len(title) for title, _, _ in rows + [(total_label, '', '')])
+        amount_width = max(len(amount) for _, amount, _ in rows + [('', total_amount, '')])
+        lines = [
+            f'{html.escape(title.ljust(title_width))} {amount.rjust(amount_width)}{marker}'
+            for title, amount, marker in rows
+        ]
+        lines.append(f'{total_label.ljust(title_width)} {total_amount.rjust(amount_width)}')
+        header = __(
+            text_dict=messages.REPORTS_BOOK_AND_PERIOD,
+            lang=from_user.language_code
+        ).format(
+            book_title=book.title,
+            currency=book.currency,
+            period=period,
+            category_type=self._category_type_label(category_type, from_user.language_code)
+        )
+        lines_text = '\n'.join(lines)
+        return f'<strong>{html.escape(header)}</strong>\n<pre>{lines_text}</pre>'
+
+    async def _charts(
+        self,
+        book: Any,
+        lang: Optional[str],
+        specs: list[ChartSpec]
+    ) -> list[charts.Chart]:
+        """Returns charts of the report that have data, from cache or rendered.
+
+        Key includes book data version, so charts built before any change
+        of expenses, categories or book itself are never returned. DB calls
+        share connection of the unit of work, so data of missing charts is
+        loaded one chart after another, only rendering runs concurrently.
+        """
+        data_version = await self.db.get_book_data_version(book.id)
+        chart_list: list[Optional[charts.Chart]] = []
+        renders: dict[int, tuple[Hashable, ChartRender]] = {}
+        for (kind, period, category_type), load in specs:
+            key = (book.id, kind, period, category_type, lang, data_version)
+            chart = self.charts_cache.get(key, _NOT_CACHED)
+            if chart is _NOT_CACHED:
+                chart = None
+                render = await load()
+                if render is None:
+                    # Missing charts are cached too.
+                    self.charts_cache.set(key, None)
+                else:
+                    renders[len(chart_list)] = (key, render)
+            chart_list.append(chart)
+        rendered = await asyncio.gather(*(
+            self._render_chart(key, render) for key, render in renders.values()
+        ))
+        for index, chart in zip(renders, rendered):
+            chart_list[index] = chart
+        return [chart for chart in chart_list if chart]
+
+    async def _render_chart(self, key: Hashable, render: ChartRender) -> charts.Chart:
+        """Renders chart and caches it, concurrent renders of the same chart share one."""
+        chart = await self.charts_flights.run(key, render)
+        self.charts_cache.set(key, chart)
+        return chart
+
+    async def _charts_cached(
+        self,
+        book: Any,
+        lang: Optional[str],
+        chart_keys: list[ChartKey]
+    ) -> bool:
+        """Returns True if all given charts are cached, see _charts."""
+        data_version = await self.db.get_book_data_version(book.id)
+        return all(
+            (book.id, kind, period, category_type, lang, data_version) in self.charts_cache
+            for kind, period, category_type in chart_keys
+        )
+
+    def stats(self) -> dict[str, dict[str, Any]]:
+        """Returns counters of charts cache, coalesced builds and scheduler."""
+        return {
+            'charts_cache': self.charts_cache.stats(),
+            'charts_flights': self.charts_flights.stats(),
+            'scheduler': self.scheduler.stats(),
+        }
+
+    async def _send_charts(self, message: Message, chart_list: list[charts.Chart]) -> None:
+        """Sends charts as one album, reusing file_id of PNGs uploaded before."""
+        if not chart_list:
+            return
+        content_hashes = [hashlib.sha256(chart.image_png).hexdigest() for chart in chart_list]
+        file_ids = [
+            await self.db.get_telegram_file_id(content_hash)
+            for content_hash in content_hashes
+        ]
+        try:
+            sent_messages = await self._answer_charts(message, chart_list, file_ids)
+        except TelegramBadRequest:
+            if not any(file_ids):
+                raise
+            # Some of files are no longer available, upload all of them again.
+            file_ids = [None] * len(chart_list)
+            sent_messages = await self._answer_charts(message, chart_list, file_ids)
+        for content_hash, file_id, sent_message in zip(content_hashes, file_ids, sent_messages):
+            if not file_id:
+                await self.db.set_telegram_file_id(content_hash, sent_message.photo[-1].file_id)
+
+    async def _answer_charts(
+        self,
+        message: Message,
+        chart_list: list[charts.Chart],
+        file_ids: list[Optional[str]]
+    ) -> list[Message]:
+        """Sends charts as single photo or media group.
+
+        Charts answer user's own command, so they are sent with interactive
+        priority, in order with other replies to the chat.
+        """
+        photos = [
+            file_id or BufferedInputFile(file=chart.image_png, filename='report.png')
+            for chart, file_id in zip(chart_list, file_ids)
+        ]
+        if len(chart_list) == 1:
+            return [await message.answer_photo(photo=photos[0], caption=chart_list[0].caption)]
+        return await message.answer_media_group(media=[
+            InputMediaPhoto(media=photo, caption=chart.caption)
+            for chart, photo in zip(chart_list, photos)
+        ])
+
+    def _category_type_label(self, category_type: CategoryType, lang: Optional[str]) -> str:
+        """Returns label of category type."""
+        if category_type == CategoryType.INCOME:
+            return __(messages.REPORTS_INCOME, lang=lang)
+        return __(messages.REPORTS_EXPENSE, lang=lang)
+
+    def _chart_titles(
+        self,
+        from_user: User,
+        book: Any,
+        category_type: CategoryType,
+        period: str,
+        total_amount: float
+    ) -> dict[str, str]:
+        """Returns title, subtitle and caption of the chart."""
+        category_type_label = self._category_type_label(category_type, from_user.language_code)
+        total_label = __(messages.TOTAL, lang=from_user.language_code)
+        return {
+            'title': __(
+                text_dict=messages.REPORTS_BOOK_AND_PERIOD,
+                lang=from_user.language_code
+            ).format(
+                book_title=book.title,
+                currency=book.currency,
+                period=period,
+                category_type=category_type_label
+            ),
+            'subtitle': f'{total_label}: {total_amount:.2f} {book.currency}',
+            'caption': __(
+                text_dict=messages.REPORTS_CAPTION,
+                lang=from_user.language_code
+            ).format(
+                category_type=category_type_label,
+                period=period,
+                total_label=total_label,
+                total_amount=total_amount,
+                currency=book.currency
+            ),
+        }
+
+    async def _render(
+        self,
+        chart: Callable[..., bytes],
+        caption: str,
+        **kwargs: Any
+    ) -> charts.Chart:
+        """Renders chart with specified arguments."""
+        image_png = await self.renderer.render(chart, **kwargs)
+        return charts.Chart(image_png=image_png, caption=caption)
+
+    def per_category_chart(
+        self,
+        from_user: User,
+        book: Any,
+        category_type: CategoryType,
+        year: int,
         month: Optional[int] = None,
         day: Optional[int] = None
-    ) -> bool:
-        """Per category expenses."""
-        from_user = from_user or message.from_user
+    ) -> ChartSpec:
+        """Per category expenses chart of the report, see _charts."""
         monthly_report = False
-        if year is not None and month is not None and day is not None:
+        if month is not None and day is not None:
             period = f'{year}-{month:02}-{day:02}'
-        elif year is not None and month is not None:
+        elif month is not None:
             period = '{month}, {year}'.format(
                 month=__(MONTH_LABELS[month], from_user.language_code),
                 year=year
             )
             monthly_report = True
-        elif year is not None:
-            period = f'{year}'
-        else:
-            self._invalid_request(message, state=state)
-            return False
-        if category_type == CategoryType.INCOME:
-            category_type_label = __(messages.REPORTS_INCOME, lang=from_user.language_code)
         else:
-            category_type_label = __(messages.REPORTS_EXPENSE, lang=from_user.language_code)
-        records = self.db.get_expenses_per_category(
+            period = f'{year}'
+        return (
+            ('per_category', (year, month, day), category_type),
+            functools.partial(
+                self._per_category_chart,
+                from_user=from_user,
+                book=book,
+                category_type=category_type,
+                period=period,
+                monthly_report=monthly_report,
+                year=year,
+                month=month,
+                day=day
+            )
+        )
+
+    async def _per_category_chart(
+        self,
+        from_user: User,
+        book: Any,
+        category_type: CategoryType,
+        period: str,
+        monthly_report: bool,
+        year: int,
+        month: Optional[int] = None,
+        day: Optional[int] = None
+    ) -> Optional[ChartRender]:
+        """Loads expenses and returns render of per category chart, None if there are none."""
+        records = await self.db.get_expenses_per_category(
             book_id=book.id,
             category_type=category_type,
             year=year,
@@ -493,16 +987,8 @@ class Reports(HandlerBase):
                     categories.append(record.category_title)
                 else:
                     categories.append('Uncategorized')
-                category = self.db.get_category_by(
-                    book_id = book.id,
-                    id = record.category_id,
-                )
                 if monthly_report:
-                    try:
-                        options = json.loads(category.options)
-                    except Exception:
-                        options = {}
-                    monthly_limit = options.get('monthly_limit')
+                    monthly_limit = record.monthly_limit
                     if monthly_limit:
                         if record.amount > monthly_limit:
                             colors.append('#FC9272')
@@ -516,171 +1002,120 @@ class Reports(HandlerBase):
                     colors.append('#6BAED6')
 
         if not categories:
-            return False
-        total_amount = sum(amounts)
-        max_amount = max(amounts)
-
-        fig, ax = plt.subplots()
-        bars = ax.barh(categories, amounts, label=categories, color=colors)
-        fig.suptitle(
-            __(
-                text_dict=messages.REPORTS_BOOK_AND_PERIOD,
-                lang=from_user.language_code
-            ).format(
-                book_title=book.title,
-                currency=book.currency,
-                period=period,
-                category_type=category_type_label
-            )
+            return None
+        titles = self._chart_titles(from_user, book, category_type, period, sum(amounts))
+        return functools.partial(
+            self._render,
+            charts.per_category_chart,
+            caption=titles['caption'],
+            title=titles['title'],
+            subtitle=titles['subtitle'],
+            categories=categories,
+            amounts=amounts,
+            colors=colors,
+            currency=book.currency
         )
-        total_label = __(messages.TOTAL, lang=from_user.language_code)
-        ax.set_title(f'{total_label}: {total_amount:.2f} {book.currency}', fontweight='bold')
-        if len(categories) < 10:
-            label_size = 12
-        elif len(categories) < 20:
-            label_size = 10
-        else:
-            label_size = 8
-        low_values = [f'{v:.2f}' if v < 0.15 * max_amount else '' for v in amounts]
-        nonlow_values = [f'{v:.2f}' if v >= 0.15 * max_amount else '' for v in amounts]
-        ax.bar_label(bars, nonlow_values, size=label_size,
-                     label_type='center', color='white')
-        ax.bar_label(bars, low_values, size=label_size,
-                     label_type='edge', color='grey', padding=3)
-        ax.set_xlabel(book.currency)
-        buffer = BytesIO()
-        plt.savefig(buffer, format='png', bbox_inches='tight')
-        buffer.seek(0)
-        image_png = buffer.getvalue()
-        buffer.close()
-        await message.answer_photo(
-            photo=BufferedInputFile(file=image_png, filename='report.png')
+
+    def per_day_chart(
+        self,
+        from_user: User,
+        book: Any,
+        category_type: CategoryType,
+        year: int,
+        month: int
+    ) -> ChartSpec:
+        """Per day expenses chart of the report, see _charts."""
+        return (
+            ('per_day', (year, month, None), category_type),
+            functools.partial(
+                self._per_day_chart,
+                from_user=from_user,
+                book=book,
+                category_type=category_type,
+                year=year,
+                month=month
+            )
         )
-        return True
 
-    async def per_day_report(
+    async def _per_day_chart(
         self,
-        message: Message,
         from_user: User,
         book: Any,
         category_type: CategoryType,
         year: int,
         month: int
-    ) -> None:
-        """Per day expenses."""
-        from_user = from_user or message.from_user
-        records = self.db.get_expenses_per_day(
+    ) -> Optional[ChartRender]:
+        """Loads expenses and returns render of per day chart, None if there are none."""
+        records = await self.db.get_expenses_per_day(
             book_id=book.id, category_type=category_type, year=year, month=month)
         if not records:
-            return
+            return None
         _, last_day = calendar.monthrange(year, month)
-        days = [day for day in range(1, last_day + 1)]
         amounts = [0]*last_day
         for record in records:
             amounts[record.day-1] = record.amount
 
-        total_amount = sum(amounts)
-        max_amount = max(amounts)
         period = '{month}, {year}'.format(
             month=__(MONTH_LABELS[month], from_user.language_code),
             year=year
         )
-        if category_type == CategoryType.INCOME:
-            category_type_label = __(messages.REPORTS_INCOME, lang=from_user.language_code)
-        else:
-            category_type_label = __(messages.REPORTS_EXPENSE, lang=from_user.language_code)
-        fig, ax = plt.subplots()
-        bars = ax.bar(days, amounts, label=days, align='center', color='#6BAED6')
-        fig.suptitle(
-            __(
-                text_dict=messages.REPORTS_BOOK_AND_PERIOD,
-                lang=from_user.language_code
-            ).format(
-                book_title=book.title,
-                currency=book.currency,
-                period=period,
-                category_type=category_type_label
-            )
+        titles = self._chart_titles(from_user, book, category_type, period, sum(amounts))
+        return functools.partial(
+            self._render,
+            charts.per_day_chart,
+            caption=titles['caption'],
+            title=titles['title'],
+            subtitle=titles['subtitle'],
+            period=period,
+            amounts=amounts,
+            currency=book.currency
         )
-        total_label = __(messages.TOTAL, lang=from_user.language_code)
-        ax.set_title(f'{total_label}: {total_amount:.2f} {book.currency}', fontweight='bold')
-
-        low_values = [f'{v:.2f}' if v < 0.15 * max_amount else '' for v in amounts]
-        nonlow_values = [f'{v:.2f}' if v >= 0.15 * max_amount else '' for v in amounts]
-        ax.bar_label(bars, nonlow_values, size='8', color='white',
-                     label_type='center', rotation='vertical')
-        ax.bar_label(bars, low_values, size='8', color='gray',
-                     label_type='edge', rotation='vertical', padding=5)
-        ax.set_xlim(0.5, last_day + 0.5)
-        ax.set_ylabel(book.currency)
-        ax.set_xlabel(period)
-        plt.xticks(days, size='8')
-        buffer = BytesIO()
-        plt.savefig(buffer, format='png', bbox_inches='tight')
-        buffer.seek(0)
-        image_png = buffer.getvalue()
-        buffer.close()
-        await message.answer_photo(
-            photo=BufferedInputFile(file=image_png, filename='report.png')
+
+    def per_month_chart(
+        self,
+        from_user: User,
+        book: Any,
+        category_type: CategoryType,
+        year: int
+    ) -> ChartSpec:
+        """Per month expenses chart of the report, see _charts."""
+        return (
+            ('per_month', (year, None, None), category_type),
+            functools.partial(
+                self._per_month_chart,
+                from_user=from_user,
+                book=book,
+                category_type=category_type,
+                year=year
+            )
         )
 
-    async def per_month_report(
+    async def _per_month_chart(
         self,
-        message: Message,
         from_user: User,
         book: Any,
         category_type: CategoryType,
         year: int
-    ) -> None:
-        """Per month expenses."""
-        from_user = from_user or message.from_user
-        records = self.db.get_expenses_per_month(book_id=book.id, category_type=category_type, year=year)
+    ) -> Optional[ChartRender]:
+        """Loads expenses and returns render of per month chart, None if there are none."""
+        records = await self.db.get_expenses_per_month(book_id=book.id, category_type=category_type, year=year)
         if not records:
-            return
-        months = [month for month in range(1, 13)]
+            return None
         month_labels = [__(MONTH_LABELS[month], from_user.language_code) for month in range(1, 13)]
         amounts = [0]*12
         for record in records:
             amounts[record.month-1] = record.amount
 
-        total_amount = sum(amounts)
-        max_amount = max(amounts)
         period = f'{year}'
-        if category_type == CategoryType.INCOME:
-            category_type_label = __(messages.REPORTS_INCOME, lang=from_user.language_code)
-        else:
-            category_type_label = __(messages.REPORTS_EXPENSE, lang=from_user.language_code)
-        fig, ax = plt.subplots()
-        bars = ax.bar(months, amounts, label=month_labels, align='center', color='#6BAED6')
-        fig.suptitle(
-            __(
-                text_dict=messages.REPORTS_BOOK_AND_PERIOD,
-                lang=from_user.language_code
-            ).format(
-                book_title=book.title,
-                currency=book.currency,
-                period=period,
-                category_type=category_type_label
-            )
-        )
-        total_label = __(messages.TOTAL, lang=from_user.language_code)
-        ax.set_title(f'{total_label}: {total_amount:.2f} {book.currency}', fontweight='bold')
-
-        low_values = [f'{v:.2f}' if v < 0.15 * max_amount else '' for v in amounts]
-        nonlow_values = [f'{v:.2f}' if v >= 0.15 * max_amount else '' for v in amounts]
-        ax.bar_label(bars, nonlow_values, color='white',
-                     label_type='center', rotation='vertical')
-        ax.bar_label(bars, low_values, color='gray',
-                     label_type='edge', rotation='vertical', padding=5)
-        ax.set_xlim(0.5, 12.5)
-        ax.set_ylabel(book.currency)
-        ax.set_xlabel(period)
-        plt.xticks(months, month_labels, rotation='vertical')
-        buffer = BytesIO()
-        plt.savefig(buffer, format='png', bbox_inches='tight')
-        buffer.seek(0)
-        image_png = buffer.getvalue()
-        buffer.close()
-        await message.answer_photo(
-            photo=BufferedInputFile(file=image_png, filename='report.png')
+        titles = self._chart_titles(from_user, book, category_type, period, sum(amounts))
+        return functools.partial(
+            self._render,
+            charts.per_month_chart,
+            caption=titles['caption'],
+            title=titles['title'],
+            subtitle=titles['subtitle'],
+            period=period,
+            month_labels=month_labels,
+            amounts=amounts,
+            currency=book.currency
         )
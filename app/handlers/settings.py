@@ -0,0 +1,85 @@
+"""Handlers for /settings workflow."""
+
+from typing import Optional
+
+from aiogram import Dispatcher, Router
+from aiogram.filters import Command
+from aiogram.fsm.context import FSMContext
+from aiogram.fsm.state import State, StatesGroup
+from aiogram.types import (
+    Message,
+    CallbackQuery,
+    InlineKeyboardButton,
+    InlineKeyboardMarkup,
+)
+from aiogram.types.user import User
+
+from handlers import HandlerBase, DBUser
+from utils import messages
+from utils import models
+from utils import __, REPORT_MODES
+
+
+class SettingsState(StatesGroup):
+    """State for settings."""
+    report_mode = State()
+
+
+class Settings(HandlerBase):
+    """Handler class for /settings workflow."""
+
+    def __init__(self, db: models.AsyncDB, dp: Dispatcher, router: Router) -> None:
+        super().__init__(db)
+        dp.message.register(self.settings, Command('settings'))
+        router.callback_query.register(self.report_mode_callback, SettingsState.report_mode)
+
+    async def settings(
+        self,
+        message: Message,
+        state: FSMContext,
+        from_user: Optional[User] = None
+    ) -> None:
+        """Entrypoint for '/settings' command."""
+        await state.clear()
+        await state.set_state(SettingsState.report_mode)
+        from_user = from_user or message.from_user
+        dbuser = await DBUser.load(self.db, from_user)
+        report_mode = dbuser.user_options['report_mode']
+        button_groups = []
+        for mode, label in REPORT_MODES.items():
+            if mode == report_mode:
+                selected_mark = '✅ '
+            else:
+                selected_mark = ''
+            button_groups.append([
+                InlineKeyboardButton(
+                    text=f'{selected_mark}{__(label, from_user.language_code)}',
+                    callback_data=mode
+                )
+            ])
+        keyboard_inline = InlineKeyboardMarkup(inline_keyboard=button_groups)
+        await self.show(
+            message,
+            text=__(
+                text_dict=messages.SETTINGS_SELECT_REPORT_MODE,
+                lang=from_user.language_code
+            ).format(report_mode=__(REPORT_MODES[report_mode], from_user.language_code)),
+            reply_markup=keyboard_inline,
+        )
+
+    async def report_mode_callback(self, call: CallbackQuery, state: FSMContext) -> None:
+        """Callback for report mode selector."""
+        await state.clear()
+        if call.data not in REPORT_MODES:
+            await self._invalid_request(call.message, state)
+            return
+        dbuser = await DBUser.load(self.db, call.from_user)
+        await dbuser.update_report_mode(call.data)
+        await self.commit()
+        await self.show(
+            call.message,
+            text=__(
+                text_dict=messages.SETTINGS_REPORT_MODE_UPDATED,
+                lang=call.from_user.language_code
+            ).format(report_mode=__(REPORT_MODES[call.data], call.from_user.language_code)),
+        )
@@ -14,7 +14,7 @@ from utils import __
 class Start(HandlerBase):
     """Handler class for /start workflow."""
 
-    def __init__(self, db: models.DB, dp: Dispatcher) -> None:
+    def __init__(self, db: models.AsyncDB, dp: Dispatcher) -> None:
         super().__init__(db)
         dp.message.register(self.start, Command('start'))
 
@@ -1,16 +1,27 @@
 """Telegram bot that allows to track your expenses."""
 
 import asyncio
+import functools
 import logging
+import multiprocessing
 import os
+import signal
 import sys
+import tempfile
+import time
 
 from datetime import datetime
+from typing import Any, Callable
 
 from aiogram import Bot, Dispatcher, Router
 from aiogram.client.default import DefaultBotProperties
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
 from aiogram.enums import ParseMode
+from aiogram.fsm.storage.memory import MemoryStorage
 from aiogram.types.bot_command import BotCommand
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from aiohttp import web
 
 from google.oauth2 import service_account
 from googleapiclient import discovery, http
@@ -18,14 +29,48 @@ from googleapiclient import discovery, http
 from handlers.books import Books
 from handlers.expenses import Expenses
 from handlers.reports import Reports
+from handlers.settings import Settings
 from handlers.start import Start
+from utils import charts
 from utils import models
+from utils.middlewares import RoutingMiddleware, UnitOfWorkMiddleware
+from utils.sharding import ShardConsumer, ShardRouter
+from utils.storage import DBStorage
+from utils.throttling import SendLimiter
 
 DB_PATH = os.getenv(
     'DB_PATH',
     os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 )
 DB_FILE = 'count-account-db.sqlite3'
+# Threads running DB calls: one per unit of work, i.e. handled update, and
+# one more, see AsyncDB.
+DB_WORKERS = int(os.getenv('DB_WORKERS', '11'))
+SQLITE_PRAGMAS = {
+    'journal_mode': os.getenv('SQLITE_JOURNAL_MODE', 'WAL'),
+    'synchronous': os.getenv('SQLITE_SYNCHRONOUS', 'NORMAL'),
+    'mmap_size': int(os.getenv('SQLITE_MMAP_SIZE', '268435456')),
+    'cache_size': int(os.getenv('SQLITE_CACHE_SIZE', '-20000')),
+    'temp_store': os.getenv('SQLITE_TEMP_STORE', 'MEMORY'),
+    'busy_timeout': int(os.getenv('SQLITE_BUSY_TIMEOUT', '5000')),
+}
+CHART_WORKERS = int(os.getenv('CHART_WORKERS', '2'))
+# Start chart workers once polling is started rather than on first report,
+# '0' turns it off, e.g. to measure the difference.
+CHART_WARM_UP = os.getenv('CHART_WARM_UP', '1') != '0'
+CHARTS_CACHE_SIZE = int(os.getenv('CHARTS_CACHE_SIZE', str(32 * 1024 * 1024)))
+# Reports rendering charts at once and waiting for it. Waiting reports
+# don't hold updates being handled, daily ones are queued above the size.
+REPORT_CONCURRENCY = int(os.getenv('REPORT_CONCURRENCY', '2'))
+REPORT_QUEUE_SIZE = int(os.getenv('REPORT_QUEUE_SIZE', '20'))
+STATS_INTERVAL = int(os.getenv('STATS_INTERVAL', '3600'))
+# Either 'db' to keep dialog states in the database or 'memory'.
+FSM_STORAGE = os.getenv('FSM_STORAGE', 'db')
+FSM_FLUSH_INTERVAL = float(os.getenv('FSM_FLUSH_INTERVAL', '1'))
+FSM_TTL = int(os.getenv('FSM_TTL', '86400'))
+# Number of worker processes handling updates, users are spread between
+# them. With 1 everything runs in a single process.
+SHARDS = int(os.getenv('SHARDS', '1'))
 ENABLE_BACKUP = os.getenv('ENABLE_BACKUP')
 GOOGLE_CREDENTIALS_FILE = os.getenv(
     'GOOGLE_CREDENTIALS_FILE',
@@ -36,13 +81,31 @@ GOOGLE_CREDENTIALS_FILE = os.getenv(
 )
 GOOGLE_DRIVE_FOLDER_ID = os.getenv('GOOGLE_DRIVE_FOLDER_ID')
 TELEGRAM_TOKEN = os.getenv('TELEGRAM_TOKEN')
+# Base URL of Bot API server, e.g. local one from tools/fake_telegram.py.
+TELEGRAM_API_URL = os.getenv('TELEGRAM_API_URL')
+# Either 'polling' or 'webhook'.
+TELEGRAM_MODE = os.getenv('TELEGRAM_MODE', 'polling')
+# Max number of updates handled at once. Each of them takes a DB unit of
+# work, so it makes little sense to go above their number.
+UPDATES_CONCURRENCY = int(os.getenv('UPDATES_CONCURRENCY', '10'))
+# Public URL Telegram sends updates to, it must be proxied to WEBHOOK_PATH.
+WEBHOOK_URL = os.getenv('WEBHOOK_URL')
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/webhook')
+WEBHOOK_HOST = os.getenv('WEBHOOK_HOST', '0.0.0.0')
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', '8080'))
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET')
+# Outgoing messages per second for the whole bot and burst above it, shared
+# by shard workers. Telegram allows about 30, 0 disables the limits.
+SEND_RATE = float(os.getenv('SEND_RATE', '25'))
+SEND_BURST = float(os.getenv('SEND_BURST', '5'))
+# Outgoing messages per second to a single chat and burst above it, 0
+# disables the limit.
+SEND_CHAT_RATE = float(os.getenv('SEND_CHAT_RATE', '1'))
+SEND_CHAT_BURST = float(os.getenv('SEND_CHAT_BURST', '4'))
+# Times a message rejected by Telegram flood control is sent again.
+SEND_RETRIES = int(os.getenv('SEND_RETRIES', '3'))
 
-if not TELEGRAM_TOKEN:
-    sys.exit('Please make sure that you set TELEGRAM_TOKEN as environment varaible.')
-
-db = models.DB(f'sqlite:///{DB_PATH}/{DB_FILE}')
-
-async def task_backup():
+async def task_backup(db: models.AsyncDB):
     """Task to backup DB into Google Drive."""
     if not ENABLE_BACKUP:
         return
@@ -56,18 +119,80 @@ async def task_backup():
             file_metadata = {'name': f'count-account-db-{timeshot}.sqlite3'}
             if GOOGLE_DRIVE_FOLDER_ID:
                 file_metadata['parents'] = [GOOGLE_DRIVE_FOLDER_ID]
-            media = http.MediaFileUpload(os.path.join(DB_PATH, DB_FILE))
-            file = google_drive_service.files().create(body=file_metadata, media_body=media,
-                fields='id').execute()
+            with tempfile.TemporaryDirectory() as snapshot_dir:
+                snapshot_path = os.path.join(snapshot_dir, DB_FILE)
+                await db.backup(snapshot_path)
+                media = http.MediaFileUpload(snapshot_path)
+                file = google_drive_service.files().create(body=file_metadata, media_body=media,
+                    fields='id').execute()
             print(f'File ID: {file.get("id")}')
         except Exception as error:
             print(f'An error occurred: {error}')
             file = None
         await asyncio.sleep(86400)
 
-async def task_telegram():
-    """Task to run telegram polling."""
-    bot = Bot(token=TELEGRAM_TOKEN, default=DefaultBotProperties(parse_mode='HTML'))
+async def task_warm_up(renderer: charts.ChartRenderer, polling_started: asyncio.Event):
+    """Task to start chart workers in background once polling is started."""
+    if not CHART_WARM_UP:
+        return
+    await polling_started.wait()
+    started = time.perf_counter()
+    timings = await renderer.warm_up()
+    logging.info(
+        'Chart renderer warmed up in %.2f s, matplotlib ready in workers in %s s.',
+        time.perf_counter() - started,
+        ', '.join(f'{timing:.2f}' for timing in timings)
+    )
+
+async def task_stats(label: str, stats: Callable[[], Any]):
+    """Task to log counters periodically."""
+    if not STATS_INTERVAL:
+        return
+    while True:
+        await asyncio.sleep(STATS_INTERVAL)
+        logging.info('%s stats: %s', label, stats())
+
+def create_db() -> models.AsyncDB:
+    """Opens database."""
+    return models.AsyncDB(
+        models.DB(f'sqlite:///{DB_PATH}/{DB_FILE}', pragmas=SQLITE_PRAGMAS),
+        max_workers=DB_WORKERS,
+        max_units_of_work=max(DB_WORKERS - 1, 1)
+    )
+
+def create_bot() -> Bot:
+    """Creates bot talking to Telegram or to TELEGRAM_API_URL.
+
+    Bot sends messages within SEND_* limits, every shard worker gets its
+    share of the global one.
+    """
+    if TELEGRAM_API_URL:
+        session = AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_URL))
+    else:
+        session = AiohttpSession()
+    if SEND_RATE:
+        session.middleware(SendLimiter(
+            rate=SEND_RATE / SHARDS,
+            capacity=max(SEND_BURST / SHARDS, 1),
+            chat_rate=SEND_CHAT_RATE,
+            chat_capacity=SEND_CHAT_BURST,
+            max_retries=SEND_RETRIES
+        ))
+    return Bot(
+        token=TELEGRAM_TOKEN,
+        session=session,
+        default=DefaultBotProperties(parse_mode='HTML')
+    )
+
+def send_stats(bot: Bot) -> list[dict[str, Any]]:
+    """Returns counters of send limiter of the bot."""
+    return [
+        middleware.stats() for middleware in bot.session.middleware
+        if isinstance(middleware, SendLimiter)
+    ]
+
+async def set_commands(bot: Bot):
+    """Sets menu of bot commands."""
     await bot.set_my_commands([
         BotCommand(command='start', description='About Count Account'),
         BotCommand(command='books', description='Manage books'),
@@ -75,6 +200,7 @@ async def task_telegram():
         BotCommand(command='day', description='Report for the day'),
         BotCommand(command='month', description='Report for the month'),
         BotCommand(command='year', description='Report for the year'),
+        BotCommand(command='settings', description='Settings'),
     ])
     await bot.set_my_commands([
         BotCommand(command='start', description='О боте'),
@@ -83,21 +209,198 @@ async def task_telegram():
         BotCommand(command='day', description='Отчет за день'),
         BotCommand(command='month', description='Отчет за месяц'),
         BotCommand(command='year', description='Отчет за год'),
+        BotCommand(command='settings', description='Настройки'),
     ], language_code='ru')
-    dp = Dispatcher()
+
+def create_dispatcher(
+    db: models.AsyncDB,
+    renderer: charts.ChartRenderer
+) -> tuple[Dispatcher, Reports]:
+    """Creates dispatcher with all handlers registered."""
+    if FSM_STORAGE == 'db':
+        storage = DBStorage(db, flush_interval=FSM_FLUSH_INTERVAL, ttl=FSM_TTL)
+    else:
+        storage = MemoryStorage()
+    dp = Dispatcher(storage=storage)
+    dp.update.outer_middleware(UnitOfWorkMiddleware(db))
     form_router = Router()
     start_handler = Start(db, dp)
     books_handler = Books(db, dp, form_router)
-    reports_handler = Reports(db, dp, form_router)
+    reports_handler = Reports(
+        db,
+        dp,
+        form_router,
+        renderer,
+        CHARTS_CACHE_SIZE,
+        REPORT_CONCURRENCY,
+        REPORT_QUEUE_SIZE
+    )
     expenses_handler = Expenses(db, dp, form_router)
+    settings_handler = Settings(db, dp, form_router)
     dp.include_router(form_router)
+    return dp, reports_handler
+
+async def task_telegram(
+    db: models.AsyncDB,
+    renderer: charts.ChartRenderer,
+    polling_started: asyncio.Event
+):
+    """Task to run telegram bot."""
+    bot = create_bot()
+    await set_commands(bot)
+    dp, reports_handler = create_dispatcher(db, renderer)
+
+    async def on_startup():
+        polling_started.set()
+
+    dp.startup.register(on_startup)
+    stats_tasks = [
+        asyncio.create_task(task_stats('Reports', reports_handler.stats)),
+        asyncio.create_task(task_stats('Sending', functools.partial(send_stats, bot))),
+    ]
+    try:
+        await receive_updates(dp, bot)
+    finally:
+        for stats_task in stats_tasks:
+            stats_task.cancel()
+        await reports_handler.close()
+        # Dispatcher closes storage on shutdown, while updates and reports
+        # may still be changing states.
+        await dp.storage.close()
+
+async def task_front():
+    """Task to receive updates and route them to shard workers."""
+    bot = create_bot()
+    await set_commands(bot)
+    router = ShardRouter(SHARDS, shard_worker)
+    router.start()
+    dp = Dispatcher()
+    dp.update.outer_middleware(RoutingMiddleware(router))
+    stats_task = asyncio.create_task(task_stats('Router', router.stats))
+    try:
+        # Routing is instant, handling updates one by one keeps their order.
+        await receive_updates(dp, bot, handle_as_tasks=False)
+    finally:
+        stats_task.cancel()
+        await asyncio.to_thread(router.stop)
 
-    await dp.start_polling(bot)
+async def task_shard(shard: int, inbox: multiprocessing.Queue, bus: multiprocessing.Queue):
+    """Task to handle updates routed to the shard worker."""
+    consumer = ShardConsumer(shard, inbox, bus, UPDATES_CONCURRENCY)
+    db = create_db()
+    db.db.invalidation_listener = consumer.publish_invalidation
+    renderer = charts.ChartRenderer(max_workers=CHART_WORKERS)
+    bot = create_bot()
+    dp, reports_handler = create_dispatcher(db, renderer)
+    started = asyncio.Event()
+    started.set()
+    tasks = [
+        asyncio.create_task(task_warm_up(renderer, started)),
+        asyncio.create_task(task_stats(f'Shard {shard} reports', reports_handler.stats)),
+        asyncio.create_task(task_stats(
+            f'Shard {shard} sending',
+            functools.partial(send_stats, bot)
+        )),
+    ]
+    try:
+        await consumer.run(functools.partial(dp.feed_raw_update, bot), db.db.drop_cached)
+    finally:
+        for task in tasks:
+            task.cancel()
+        await reports_handler.close()
+        await dp.storage.close()
+        await bot.session.close()
+        renderer.shutdown()
+
+def shard_worker(shard: int, inbox: multiprocessing.Queue, bus: multiprocessing.Queue):
+    """Entry point of shard worker process."""
+    logging.basicConfig(
+        level=logging.INFO,
+        stream=sys.stdout,
+        format=f'shard-{shard}:%(levelname)s:%(name)s:%(message)s'
+    )
+    asyncio.run(task_shard(shard, inbox, bus))
+
+async def receive_updates(dp: Dispatcher, bot: Bot, handle_as_tasks: bool = True):
+    """Feeds updates to dispatcher, with long polling or from webhook."""
+    if TELEGRAM_MODE == 'webhook':
+        await run_webhook(dp, bot)
+    else:
+        await run_polling(dp, bot, handle_as_tasks)
+
+async def run_polling(dp: Dispatcher, bot: Bot, handle_as_tasks: bool = True):
+    """Receives updates with long polling."""
+    await bot.delete_webhook()
+    await dp.start_polling(
+        bot,
+        handle_as_tasks=handle_as_tasks,
+        tasks_concurrency_limit=UPDATES_CONCURRENCY
+    )
+
+async def run_webhook(dp: Dispatcher, bot: Bot):
+    """Receives updates sent by Telegram to the webhook."""
+    app = web.Application()
+    # Update is handled before the response is sent, so Telegram keeps
+    # no more than max_connections updates in flight.
+    SimpleRequestHandler(
+        dispatcher=dp,
+        bot=bot,
+        handle_in_background=False,
+        secret_token=WEBHOOK_SECRET
+    ).register(app, path=WEBHOOK_PATH)
+    setup_application(app, dp, bot=bot)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    # Stops like polling does, on SIGINT or SIGTERM.
+    loop = asyncio.get_running_loop()
+    stopped = asyncio.Event()
+    for signal_number in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signal_number, stopped.set)
+    try:
+        await web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT).start()
+        logging.info('Webhook is listening on %s:%s%s', WEBHOOK_HOST, WEBHOOK_PORT, WEBHOOK_PATH)
+        await bot.set_webhook(
+            WEBHOOK_URL,
+            secret_token=WEBHOOK_SECRET,
+            max_connections=UPDATES_CONCURRENCY
+        )
+        await stopped.wait()
+        logging.info('Webhook is stopped')
+    finally:
+        for signal_number in (signal.SIGINT, signal.SIGTERM):
+            loop.remove_signal_handler(signal_number)
+        # Runs shutdown of dispatcher, then waits for updates being handled,
+        # which may still change states after storage is closed by it.
+        await runner.cleanup()
+        await dp.storage.close()
 
 async def main():
     """Main method."""
-    await asyncio.gather(task_backup(), task_telegram())
+    # Schema is migrated here, before shard workers open the database.
+    db = create_db()
+    if SHARDS > 1:
+        await asyncio.gather(
+            task_backup(db),
+            task_front()
+        )
+        return
+    renderer = charts.ChartRenderer(max_workers=CHART_WORKERS)
+    polling_started = asyncio.Event()
+    try:
+        await asyncio.gather(
+            task_backup(db),
+            task_telegram(db, renderer, polling_started),
+            task_warm_up(renderer, polling_started)
+        )
+    finally:
+        renderer.shutdown()
 
 if __name__ == "__main__":
+    # Chart and shard workers import this module again, so it must stay free of
+    # side effects outside of this block.
+    if not TELEGRAM_TOKEN:
+        sys.exit('Please make sure that you set TELEGRAM_TOKEN as environment varaible.')
+    if TELEGRAM_MODE == 'webhook' and not WEBHOOK_URL:
+        sys.exit('Please make sure that you set WEBHOOK_URL as environment varaible.')
     logging.basicConfig(level=logging.INFO, stream=sys.stdout)
     asyncio.run(main())
@@ -0,0 +1,36 @@
+"""Maintenance commands for Count Account database."""
+
+import argparse
+import os
+
+from utils import models
+
+DB_PATH = os.getenv(
+    'DB_PATH',
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+)
+DB_FILE = 'count-account-db.sqlite3'
+
+
+def backfill_rollups(db: models.DB) -> None:
+    """Rebuild monthly expense rollups from expenses table."""
+    db.rebuild_expense_rollups()
+    print('Expense rollups successfully rebuilt.')
+
+
+COMMANDS = {
+    'backfill-rollups': backfill_rollups,
+}
+
+
+def main():
+    """Main method."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('command', choices=COMMANDS.keys())
+    args = parser.parse_args()
+    db = models.DB(f'sqlite:///{DB_PATH}/{DB_FILE}')
+    COMMANDS[args.command](db)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1 @@
+"""Tools for local development and load testing."""
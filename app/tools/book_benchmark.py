@@ -0,0 +1,97 @@
+"""Benchmark of book creation with default categories.
+
+Creates books with default expense and income categories, seeding them
+one INSERT per tree level as DB.add_book does, and one INSERT per
+category as it used to, each on a fresh database file and in a process
+of its own, as DB tables are defined once per process:
+
+    python -m tools.book_benchmark --books 200
+"""
+
+import argparse
+import multiprocessing
+import os
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from typing import Any
+
+from sqlalchemy import event, insert
+from sqlalchemy.engine import Connection
+
+from utils import __, CategoryType, DEFAULT_EXPENSE_CATEGORIES, DEFAULT_INCOME_CATEGORIES
+from utils import models
+
+
+def _add_categories_row_by_row(
+        db: models.DB,
+        connection: Connection,
+        book_id: int,
+        categories: dict[CategoryType, dict[str, Any]]
+) -> None:
+    """Adds category trees one INSERT per category, the way add_book used to."""
+    def add(category_type: CategoryType, parent_id: int, subcategories: dict[str, Any]) -> None:
+        for title, children in subcategories.items():
+            id = connection.execute(insert(db.category_table).values(
+                book_id=book_id,
+                parent_id=parent_id,
+                category_type=category_type,
+                title=title,
+                deleted=False
+            )).inserted_primary_key.id
+            add(category_type, id, children)
+
+    for category_type, subcategories in categories.items():
+        add(category_type, 0, subcategories)
+
+
+def run(database: str, row_by_row: bool, books: int, lang: str) -> tuple[float, float]:
+    """Returns milliseconds and SQL statements per created book."""
+    db = models.DB(f'sqlite:///{database}')
+    if row_by_row:
+        db._add_categories = lambda **kwargs: _add_categories_row_by_row(db, **kwargs)
+    statements = 0
+
+    def count(*args: Any) -> None:
+        nonlocal statements
+        statements += 1
+
+    event.listen(db.engine, 'before_cursor_execute', count)
+    started = time.perf_counter()
+    for number in range(books):
+        db.add_book(
+            user_id=1,
+            title=f'Book {number}',
+            currency='EUR',
+            created=datetime.utcnow(),
+            default_expense_categories=__(text_dict=DEFAULT_EXPENSE_CATEGORIES, lang=lang),
+            default_income_categories=__(text_dict=DEFAULT_INCOME_CATEGORIES, lang=lang)
+        )
+    elapsed = time.perf_counter() - started
+    db.engine.dispose()
+    return elapsed * 1000 / books, statements / books
+
+
+def main() -> None:
+    """Runs benchmark with both ways of seeding."""
+    parser = argparse.ArgumentParser(description=__doc__.split('\n', maxsplit=1)[0])
+    parser.add_argument('--books', type=int, default=200)
+    parser.add_argument('--lang', default='en', help='language of default categories')
+    args = parser.parse_args()
+    context = multiprocessing.get_context('spawn')
+    with tempfile.TemporaryDirectory() as db_path:
+        for name, row_by_row in (('per row', True), ('per level', False)):
+            with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+                milliseconds, statements = executor.submit(
+                    run,
+                    os.path.join(db_path, f'{row_by_row}.sqlite3'),
+                    row_by_row,
+                    args.books,
+                    args.lang
+                ).result()
+            print(f'{name:<10} {milliseconds:>8.1f} ms/book {statements:>6.0f} statements/book')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,93 @@
+"""Soak test of chart rendering memory.
+
+Renders charts of all kinds in a loop, the way a chart worker process
+does, and prints resident memory every few hundred charts:
+
+    python -m tools.chart_soak --charts 6000
+
+Memory must stay flat once matplotlib caches are warm. Exits with status
+1 if it grows more than --max-growth MiB after the warm up.
+"""
+
+import argparse
+import os
+import random
+import resource
+import sys
+
+from utils import charts
+
+MONTH_LABELS = ['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun',
+                'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec']
+
+
+def rss_mib() -> float:
+    """Returns current resident memory of the process, peak one if unknown."""
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2 ** 20
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def render(number: int) -> bytes:
+    """Renders chart of the kind chosen by its number, with random data."""
+    kind = number % 3
+    if kind == 0:
+        count = random.randint(1, 25)
+        return charts.per_category_chart(
+            title='Book (EUR)',
+            subtitle='Expenses',
+            categories=[f'Category {index}' for index in range(count)],
+            amounts=[random.uniform(1, 500) for _ in range(count)],
+            colors=['#6BAED6'] * count,
+            currency='EUR'
+        )
+    if kind == 1:
+        return charts.per_day_chart(
+            title='Book (EUR)',
+            subtitle='Expenses',
+            period='2024-05',
+            amounts=[random.uniform(0, 500) for _ in range(random.randint(28, 31))],
+            currency='EUR'
+        )
+    return charts.per_month_chart(
+        title='Book (EUR)',
+        subtitle='Expenses',
+        period='2024',
+        month_labels=MONTH_LABELS,
+        amounts=[random.uniform(0, 5000) for _ in MONTH_LABELS],
+        currency='EUR'
+    )
+
+
+def main() -> None:
+    """Renders charts and checks memory growth."""
+    parser = argparse.ArgumentParser(description=__doc__.split('\n', maxsplit=1)[0])
+    parser.add_argument('--charts', type=int, default=3000)
+    parser.add_argument('--warm-up', type=int, default=300,
+                        help='charts rendered before memory is taken as baseline')
+    parser.add_argument('--every', type=int, default=300, help='charts between memory reports')
+    parser.add_argument('--max-growth', type=float, default=16, help='MiB allowed after warm up')
+    args = parser.parse_args()
+    random.seed(0)
+    charts.warm_up()
+    print(f'{0:>8} charts {rss_mib():>8.1f} MiB')
+    baseline = None
+    for number in range(1, args.charts + 1):
+        render(number)
+        if number == args.warm_up:
+            baseline = rss_mib()
+        if not number % args.every:
+            print(f'{number:>8} charts {rss_mib():>8.1f} MiB', flush=True)
+    if baseline is None:
+        print('Too few charts to measure growth after warm up.')
+        return
+    growth = rss_mib() - baseline
+    print(f'Growth after {args.warm_up} charts: {growth:.1f} MiB')
+    if growth > args.max_growth:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
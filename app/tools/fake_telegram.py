@@ -0,0 +1,594 @@
+"""Local stand-in for Telegram Bot API to load test the bot without network.
+
+Serves the subset of Bot API methods used by the bot, delivers updates
+either to the webhook registered by the bot or via getUpdates, and drives
+a number of simulated users through a typical session: create a book,
+add some expenses and request today's report. Latency between an update
+and the first bot reply, or the report itself for a report request, is
+reported per step once all users are done.
+
+Start it and point the bot to it:
+
+    python -m tools.fake_telegram --users 50
+    TELEGRAM_API_URL=http://127.0.0.1:8081 TELEGRAM_TOKEN=1:fake python main.py
+"""
+
+import argparse
+import asyncio
+import collections
+import itertools
+import json
+import statistics
+import time
+from typing import Any, Awaitable, Optional
+
+from aiohttp import ClientError, ClientSession, ClientTimeout, web
+
+BOT_USER = {
+    'id': 1,
+    'is_bot': True,
+    'first_name': 'Count Account',
+    'username': 'count_account_bot',
+}
+JSON_PARAMS = ('reply_markup', 'media', 'commands', 'allowed_updates', 'entities')
+# Telegram default for max_connections of a webhook.
+DEFAULT_MAX_CONNECTIONS = 40
+# Failed webhook requests are retried like Telegram does.
+WEBHOOK_RETRIES = 10
+WEBHOOK_RETRY_DELAY = 0.5
+# Flood control, if enabled, allows this many messages within a second
+# overall and to a single chat, and rejects the rest with RetryAfter.
+FLOOD_LIMIT = 30
+FLOOD_CHAT_LIMIT = 5
+FLOOD_METHODS = (
+    'sendmessage',
+    'sendphoto',
+    'sendmediagroup',
+    'editmessagetext',
+    'editmessagereplymarkup',
+)
+# Beginning of replies to a report request which are not the report, see
+# REPORTS_QUEUED and REPORTS_BUSY messages of the bot.
+REPORT_QUEUED = 'Your report is queued'
+REPORT_BUSY = 'Too many reports'
+
+
+class FakeTelegram:
+    """Keeps chats, pending updates and webhook of a single bot."""
+    webhook_url: Optional[str]
+    webhook_secret: Optional[str]
+    webhook_slots: Optional[asyncio.Semaphore]
+    bot_ready: asyncio.Event
+    updates: list[dict[str, Any]]
+    messages: dict[tuple[int, int], dict[str, Any]]
+    inboxes: dict[int, asyncio.Queue]
+    calls: dict[str, int]
+    flood_control: bool
+    flood_errors: int
+
+    def __init__(self, flood_control: bool = False) -> None:
+        self.webhook_url = None
+        self.webhook_secret = None
+        self.webhook_slots = None
+        self.bot_ready = asyncio.Event()
+        self.updates = []
+        self.messages = {}
+        self.inboxes = {}
+        self.calls = {}
+        self.flood_control = flood_control
+        self.flood_errors = 0
+        self._sent: collections.deque[float] = collections.deque()
+        self._sent_to_chat: dict[int, collections.deque[float]] = {}
+        self._updates_changed = asyncio.Event()
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+        self._file_ids = itertools.count(1)
+        self._deliveries: set[asyncio.Task] = set()
+        self._client: Optional[ClientSession] = None
+
+    def inbox(self, chat_id: int) -> asyncio.Queue:
+        """Returns queue of new bot messages sent to the chat."""
+        return self.inboxes.setdefault(chat_id, asyncio.Queue())
+
+    async def handle(self, request: web.Request) -> web.Response:
+        """Handles Bot API request."""
+        method = request.match_info['method']
+        self.calls[method] = self.calls.get(method, 0) + 1
+        params = {}
+        for key, value in (await request.post()).items():
+            if isinstance(value, web.FileField):
+                params[key] = value.file.read()
+            elif key in JSON_PARAMS:
+                params[key] = json.loads(value)
+            else:
+                params[key] = value
+        params.update(request.query)
+        if self.flood_control and method.lower() in FLOOD_METHODS:
+            cost = len(params['media']) if 'media' in params else 1
+            if not self._within_flood_limits(int(params['chat_id']), cost):
+                self.flood_errors += 1
+                return web.json_response({
+                    'ok': False,
+                    'error_code': 429,
+                    'description': 'Too Many Requests: retry after 1',
+                    'parameters': {'retry_after': 1},
+                })
+        handler = getattr(self, f'method_{method.lower()}', None)
+        if handler is None:
+            return web.json_response({'ok': True, 'result': True})
+        try:
+            result = await handler(params)
+        except LookupError as error:
+            return web.json_response({
+                'ok': False,
+                'error_code': 400,
+                'description': f'Bad Request: {error.args[0]}',
+            })
+        return web.json_response({'ok': True, 'result': result})
+
+    def _within_flood_limits(self, chat_id: int, cost: int) -> bool:
+        """Counts messages sent within the last second, if they are allowed."""
+        now = time.monotonic()
+        sent_to_chat = self._sent_to_chat.setdefault(chat_id, collections.deque())
+        for sent in (self._sent, sent_to_chat):
+            while sent and sent[0] <= now - 1:
+                sent.popleft()
+        if len(self._sent) + cost > FLOOD_LIMIT or len(sent_to_chat) + cost > FLOOD_CHAT_LIMIT:
+            return False
+        self._sent.extend([now] * cost)
+        sent_to_chat.extend([now] * cost)
+        return True
+
+    async def method_getme(self, params: dict[str, Any]) -> dict[str, Any]:
+        """Returns bot user."""
+        return BOT_USER
+
+    async def method_setwebhook(self, params: dict[str, Any]) -> bool:
+        """Registers webhook, updates are pushed to it from now on."""
+        self.webhook_url = params['url']
+        self.webhook_secret = params.get('secret_token')
+        self.webhook_slots = asyncio.Semaphore(
+            int(params.get('max_connections', DEFAULT_MAX_CONNECTIONS))
+        )
+        self.bot_ready.set()
+        return True
+
+    async def method_deletewebhook(self, params: dict[str, Any]) -> bool:
+        """Removes webhook, updates are returned by getUpdates from now on."""
+        self.webhook_url = None
+        return True
+
+    async def method_getupdates(self, params: dict[str, Any]) -> list[dict[str, Any]]:
+        """Returns pending updates, waiting for them up to timeout seconds."""
+        self.bot_ready.set()
+        offset = int(params.get('offset', 0))
+        self.updates = [update for update in self.updates if update['update_id'] >= offset]
+        if not self.updates:
+            self._updates_changed.clear()
+            try:
+                await asyncio.wait_for(
+                    self._updates_changed.wait(),
+                    timeout=float(params.get('timeout', 0))
+                )
+            except asyncio.TimeoutError:
+                pass
+        return self.updates[:int(params.get('limit', 100))]
+
+    async def method_sendmessage(self, params: dict[str, Any]) -> dict[str, Any]:
+        """Sends text message."""
+        return self._new_message(params, text=params['text'])
+
+    async def method_sendphoto(self, params: dict[str, Any]) -> dict[str, Any]:
+        """Sends photo, uploaded or referenced by file_id."""
+        return self._new_message(
+            params,
+            photo=self._photo(params['photo']),
+            caption=params.get('caption')
+        )
+
+    async def method_sendmediagroup(self, params: dict[str, Any]) -> list[dict[str, Any]]:
+        """Sends album of photos."""
+        messages = []
+        for media in params['media']:
+            photo = media['media']
+            if photo.startswith('attach://'):
+                photo = params[photo[len('attach://'):]]
+            messages.append(self._new_message(
+                params,
+                photo=self._photo(photo),
+                caption=media.get('caption')
+            ))
+        return messages
+
+    async def method_editmessagetext(self, params: dict[str, Any]) -> dict[str, Any]:
+        """Replaces text and keyboard of the message, user sees it as a reply."""
+        message = self._message(params)
+        message['text'] = params['text']
+        message['edit_date'] = int(time.time())
+        self._set_markup(message, params)
+        self.inbox(message['chat']['id']).put_nowait(message)
+        return message
+
+    async def method_editmessagereplymarkup(self, params: dict[str, Any]) -> dict[str, Any]:
+        """Replaces keyboard of the message."""
+        message = self._message(params)
+        message['edit_date'] = int(time.time())
+        self._set_markup(message, params)
+        return message
+
+    async def method_answercallbackquery(self, params: dict[str, Any]) -> bool:
+        """Confirms callback query."""
+        return True
+
+    def _new_message(self, params: dict[str, Any], **fields: Any) -> dict[str, Any]:
+        """Stores message sent by bot and puts it into chat inbox."""
+        chat_id = int(params['chat_id'])
+        message = {
+            'message_id': next(self._message_ids),
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private'},
+            'from': BOT_USER,
+        }
+        message.update({key: value for key, value in fields.items() if value is not None})
+        self._set_markup(message, params)
+        self.messages[(chat_id, message['message_id'])] = message
+        self.inbox(chat_id).put_nowait(message)
+        return message
+
+    def _message(self, params: dict[str, Any]) -> dict[str, Any]:
+        """Returns message referenced by request."""
+        key = (int(params['chat_id']), int(params['message_id']))
+        if key not in self.messages:
+            raise LookupError('message to edit not found')
+        return self.messages[key]
+
+    def _photo(self, photo: Any) -> list[dict[str, Any]]:
+        """Returns photo sizes for uploaded file or file_id."""
+        if isinstance(photo, bytes):
+            file_id = f'photo-{next(self._file_ids)}'
+        else:
+            file_id = photo
+        return [{'file_id': file_id, 'file_unique_id': file_id, 'width': 640, 'height': 480}]
+
+    @staticmethod
+    def _set_markup(message: dict[str, Any], params: dict[str, Any]) -> None:
+        """Sets inline keyboard of the message from request."""
+        markup = params.get('reply_markup')
+        if markup and 'inline_keyboard' in markup:
+            message['reply_markup'] = markup
+        else:
+            message.pop('reply_markup', None)
+
+    def push(self, update: dict[str, Any]) -> None:
+        """Delivers update to the bot in background."""
+        update['update_id'] = next(self._update_ids)
+        if self.webhook_url is None:
+            self.updates.append(update)
+            self._updates_changed.set()
+            return
+        task = asyncio.create_task(self._post(update))
+        self._deliveries.add(task)
+        task.add_done_callback(self._deliveries.discard)
+
+    async def _post(self, update: dict[str, Any]) -> None:
+        """Posts update to webhook, keeping at most max_connections in flight."""
+        if self._client is None:
+            self._client = ClientSession(timeout=ClientTimeout(total=60))
+        headers = {}
+        if self.webhook_secret:
+            headers['X-Telegram-Bot-Api-Secret-Token'] = self.webhook_secret
+        for _ in range(WEBHOOK_RETRIES):
+            try:
+                async with self.webhook_slots:
+                    async with self._client.post(
+                        self.webhook_url,
+                        json=update,
+                        headers=headers
+                    ) as response:
+                        await response.read()
+                        if response.status == 200:
+                            return
+            except ClientError:
+                pass
+            await asyncio.sleep(WEBHOOK_RETRY_DELAY)
+        print(f'Update {update["update_id"]} is not delivered to webhook')
+
+    async def close(self) -> None:
+        """Closes webhook client."""
+        if self._client is not None:
+            await self._client.close()
+
+
+class SimulatedUser:
+    """Telegram user talking to the bot in a private chat."""
+    server: FakeTelegram
+    user_id: int
+    timeout: float
+    latencies: dict[str, list[float]]
+    timeouts: int
+    queued_reports: int
+    busy_reports: int
+    failed: bool
+    last_reply: Optional[dict[str, Any]]
+
+    def __init__(self, server: FakeTelegram, user_id: int, timeout: float) -> None:
+        self.server = server
+        self.user_id = user_id
+        self.timeout = timeout
+        self.latencies = {}
+        self.timeouts = 0
+        self.queued_reports = 0
+        self.busy_reports = 0
+        self.failed = False
+        self.last_reply = None
+
+    @property
+    def user(self) -> dict[str, Any]:
+        """Telegram user object."""
+        return {
+            'id': self.user_id,
+            'is_bot': False,
+            'first_name': f'User {self.user_id}',
+            'language_code': 'en',
+        }
+
+    async def send(
+        self,
+        text: str,
+        step: Optional[str] = None,
+        replies: int = 1
+    ) -> Optional[dict[str, Any]]:
+        """Sends text message to the bot and returns its last reply."""
+        step = step or ('command' if text.startswith('/') else 'text')
+        return await self._exchange(step, replies, self._text_update(text))
+
+    async def request_report(self, text: str, step: str = 'report') -> Optional[dict[str, Any]]:
+        """Requests report and returns it: a photo, first photo of an album or text.
+
+        Latency is measured until the report itself, notices of the report
+        being queued are skipped. User gives up if report is rejected.
+        """
+        started = time.perf_counter()
+        inbox = self._push(self._text_update(text))
+        while True:
+            try:
+                reply = await asyncio.wait_for(inbox.get(), timeout=self.timeout)
+            except asyncio.TimeoutError:
+                self.timeouts += 1
+                return None
+            self.last_reply = reply
+            if reply.get('text', '').startswith(REPORT_QUEUED):
+                self.queued_reports += 1
+                continue
+            if reply.get('text', '').startswith(REPORT_BUSY):
+                self.busy_reports += 1
+                raise LookupError(f'User {self.user_id} got no report: {reply["text"]}')
+            self.latencies.setdefault(step, []).append(time.perf_counter() - started)
+            return reply
+
+    def _text_update(self, text: str) -> dict[str, Any]:
+        """Returns update with text message from the user."""
+        return {
+            'message': {
+                'message_id': 0,
+                'date': int(time.time()),
+                'chat': {'id': self.user_id, 'type': 'private'},
+                'from': self.user,
+                'text': text,
+            },
+        }
+
+    async def click(self, label: str, replies: int = 1) -> Optional[dict[str, Any]]:
+        """Taps inline button in the latest bot message having it.
+
+        Button is found by its callback data or text.
+        """
+        for (chat_id, _), message in reversed(self.server.messages.items()):
+            if chat_id != self.user_id:
+                continue
+            buttons = itertools.chain(*message.get('reply_markup', {}).get('inline_keyboard', []))
+            data = next((
+                button['callback_data'] for button in buttons
+                if label in (button.get('callback_data'), button.get('text'))
+            ), None)
+            if data is not None:
+                break
+        else:
+            raise LookupError(
+                f'User {self.user_id} has no button {label}, last reply: {self.last_reply}'
+            )
+        return await self._exchange('callback', replies, {
+            'callback_query': {
+                'id': f'{self.user_id}-{time.monotonic_ns()}',
+                'from': self.user,
+                'chat_instance': str(self.user_id),
+                'message': message,
+                'data': data,
+            },
+        })
+
+    async def _exchange(
+        self,
+        step: str,
+        replies: int,
+        update: dict[str, Any]
+    ) -> Optional[dict[str, Any]]:
+        """Pushes update and waits for the expected number of new or edited bot messages.
+
+        Latency is measured until the first of them.
+        """
+        started = time.perf_counter()
+        inbox = self._push(update)
+        for number in range(replies):
+            try:
+                reply = await asyncio.wait_for(inbox.get(), timeout=self.timeout)
+            except asyncio.TimeoutError:
+                self.timeouts += 1
+                return None
+            if not number:
+                self.latencies.setdefault(step, []).append(time.perf_counter() - started)
+            self.last_reply = reply
+        return reply
+
+    def _push(self, update: dict[str, Any]) -> asyncio.Queue:
+        """Sends update to the bot and returns inbox cleared of earlier replies."""
+        inbox = self.server.inbox(self.user_id)
+        while not inbox.empty():
+            inbox.get_nowait()
+        self.server.push(update)
+        return inbox
+
+    async def session(self, scenario: Awaitable[Any]) -> None:
+        """Runs scenario, user gives up if expected button or report is not there."""
+        try:
+            await scenario
+        except LookupError as error:
+            print(error)
+            self.failed = True
+
+    async def scenario(self, expenses: int) -> None:
+        """Creates a book, adds expenses and requests today's report.
+
+        Every second expense is entered with its category in one message.
+        """
+        await self.create_book()
+        for number in range(expenses):
+            if number % 2:
+                await self.send(f'{number + 1}.50 taxi', step='quick')
+                continue
+            await self.send(f'{number + 1}.50', replies=2)
+            await self.click('EXPENSE')
+            await self.click('/submit')
+        await self.request_report('/today')
+
+    async def create_book(self) -> None:
+        """Starts the bot, creates a book and joins it."""
+        await self.send('/start')
+        await self.send('/books')
+        await self.click('/new')
+        await self.send(f'Book {self.user_id}')
+        await self.click('EUR')
+        await self.click('/yes', replies=2)
+        await self.click(f'Book {self.user_id}')
+        await self.click('/join')
+
+    async def add_expenses(self, expenses: int, step: str = 'quick') -> None:
+        """Adds expenses, each with its category in one message."""
+        for number in range(expenses):
+            await self.send(f'{number + 1}.50 taxi', step=step)
+
+
+def _report(users: list[SimulatedUser], elapsed: float) -> str:
+    """Returns latency summary per step."""
+    latencies: dict[str, list[float]] = {}
+    for user in users:
+        for step, values in user.latencies.items():
+            latencies.setdefault(step, []).extend(values)
+    total = sum(len(values) for values in latencies.values())
+    lines = [
+        f'{len(users)} users, {total} updates in {elapsed:.2f} s, '
+        f'{total / elapsed:.1f} updates/s, {sum(user.timeouts for user in users)} timeouts, '
+        f'{sum(user.failed for user in users)} failed sessions',
+        f'{sum(user.busy_reports for user in users)} reports rejected as busy, '
+        f'{sum(user.queued_reports for user in users)} queued',
+        f'{"step":<10}{"count":>8}{"p50 ms":>10}{"p95 ms":>10}{"max ms":>10}',
+    ]
+    for step, values in sorted(latencies.items()):
+        values.sort()
+        lines.append(
+            f'{step:<10}{len(values):>8}'
+            f'{statistics.median(values) * 1000:>10.1f}'
+            f'{values[int(len(values) * 0.95)] * 1000:>10.1f}'
+            f'{values[-1] * 1000:>10.1f}'
+        )
+    return '\n'.join(lines)
+
+
+async def serve(
+    host: str,
+    port: int,
+    flood_control: bool = False
+) -> tuple[FakeTelegram, web.AppRunner]:
+    """Starts fake Bot API server."""
+    server = FakeTelegram(flood_control)
+    app = web.Application()
+    app.router.add_route('*', '/bot{token}/{method}', server.handle)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return server, runner
+
+
+async def simulate(
+    server: FakeTelegram,
+    users: int,
+    expenses: int,
+    timeout: float,
+    year_reports: int = 0
+) -> str:
+    """Runs sessions of simulated users at once and returns latency summary.
+
+    With year_reports, users create books with an expense first. Then that
+    many of them request yearly report at once, while the rest add their
+    expenses, so 'quick' step shows expense entry during a burst of reports.
+    """
+    simulated_users = [SimulatedUser(server, 1000 + number, timeout) for number in range(users)]
+    started = time.perf_counter()
+    if not year_reports:
+        await asyncio.gather(*(user.session(user.scenario(expenses)) for user in simulated_users))
+    else:
+        async def prepare(user: SimulatedUser) -> None:
+            await user.create_book()
+            await user.add_expenses(1, step='setup')
+
+        await asyncio.gather(*(user.session(prepare(user)) for user in simulated_users))
+        await asyncio.gather(*(
+            user.session(
+                user.request_report('/year', step='year') if number < year_reports
+                else user.add_expenses(expenses)
+            )
+            for number, user in enumerate(simulated_users) if not user.failed
+        ))
+    report = _report(simulated_users, time.perf_counter() - started)
+    report += '\nBot API calls: ' + ', '.join(
+        f'{method} {count}' for method, count in sorted(server.calls.items())
+    )
+    if server.flood_control:
+        report += f'\n{server.flood_errors} requests rejected by flood control'
+    return report
+
+
+async def main() -> None:
+    """Runs fake Bot API server and simulated users."""
+    parser = argparse.ArgumentParser(description=__doc__.split('\n', maxsplit=1)[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8081)
+    parser.add_argument('--users', type=int, default=20,
+                        help='simulated users, 0 to only serve Bot API')
+    parser.add_argument('--expenses', type=int, default=5, help='expenses added by every user')
+    parser.add_argument('--year-reports', type=int, default=0,
+                        help='users requesting yearly report at once while the rest add expenses')
+    parser.add_argument('--timeout', type=float, default=30, help='seconds to wait for reply')
+    parser.add_argument('--delay', type=float, default=0,
+                        help='seconds to wait after bot is connected, e.g. for warm up')
+    parser.add_argument('--flood-control', action='store_true',
+                        help='reject messages above Telegram limits with RetryAfter')
+    args = parser.parse_args()
+
+    server, runner = await serve(args.host, args.port, args.flood_control)
+    print(f'Fake Bot API is listening on http://{args.host}:{args.port}')
+    try:
+        if not args.users:
+            await asyncio.Event().wait()
+        await server.bot_ready.wait()
+        await asyncio.sleep(args.delay)
+        mode = 'polling' if server.webhook_url is None else f'webhook {server.webhook_url}'
+        print(f'Bot connected ({mode}), starting {args.users} users')
+        print(await simulate(server, args.users, args.expenses, args.timeout, args.year_reports))
+    finally:
+        await server.close()
+        await runner.cleanup()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,82 @@
+"""Load test of the bot with different number of shard workers.
+
+For every number of shards starts the bot against fake Bot API with a
+fresh database, runs simulated users and prints their latency summary:
+
+    python -m tools.load_test --shards 1 2 4 --users 100
+
+With --year-reports, that many users request yearly report at once while
+the rest add expenses, to see expense entry is not held up by reports:
+
+    python -m tools.load_test --shards 1 --users 40 --year-reports 20
+
+Environment is passed to the bot, so its settings, e.g. CHART_WORKERS or
+SQLITE_BUSY_TIMEOUT, can be tuned the usual way.
+"""
+
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+
+from tools.fake_telegram import serve, simulate
+
+APP_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+async def run(shards: int, args: argparse.Namespace) -> str:
+    """Runs the bot with given number of shards and returns latency summary."""
+    server, runner = await serve(args.host, args.port, args.flood_control)
+    with tempfile.TemporaryDirectory() as db_path:
+        env = dict(
+            os.environ,
+            DB_PATH=db_path,
+            SHARDS=str(shards),
+            TELEGRAM_TOKEN='1:fake',
+            TELEGRAM_API_URL=f'http://{args.host}:{args.port}',
+            TELEGRAM_MODE='polling',
+            ENABLE_BACKUP='',
+        )
+        bot = await asyncio.create_subprocess_exec(
+            sys.executable, os.path.join(APP_PATH, 'main.py'),
+            env=env,
+            cwd=APP_PATH,
+            stdout=asyncio.subprocess.DEVNULL if not args.verbose else None
+        )
+        try:
+            await server.bot_ready.wait()
+            await asyncio.sleep(args.delay)
+            return await simulate(
+                server, args.users, args.expenses, args.timeout, args.year_reports)
+        finally:
+            bot.terminate()
+            await bot.wait()
+            await server.close()
+            await runner.cleanup()
+
+
+async def main() -> None:
+    """Runs load test for every number of shards."""
+    parser = argparse.ArgumentParser(description=__doc__.split('\n', maxsplit=1)[0])
+    parser.add_argument('--shards', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8081)
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--expenses', type=int, default=5, help='expenses added by every user')
+    parser.add_argument('--year-reports', type=int, default=0,
+                        help='users requesting yearly report at once while the rest add expenses')
+    parser.add_argument('--timeout', type=float, default=30, help='seconds to wait for reply')
+    parser.add_argument('--delay', type=float, default=15,
+                        help='seconds to wait after bot is connected, for workers to warm up')
+    parser.add_argument('--flood-control', action='store_true',
+                        help='reject messages above Telegram limits with RetryAfter')
+    parser.add_argument('--verbose', action='store_true', help='show output of the bot')
+    args = parser.parse_args()
+    for shards in args.shards:
+        print(f'== {shards} shard(s), {os.cpu_count()} CPU(s)')
+        print(await run(shards, args), flush=True)
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,109 @@
+"""Check of query plans of expense reports.
+
+Runs every query reading expenses or their monthly rollups through
+EXPLAIN QUERY PLAN and checks that both tables are read with a covering
+index only. Expense queries must also compare deleted with literal 0,
+otherwise SQLite can't use the partial index on not deleted expenses:
+
+    python -m tools.query_plans
+    python -m tools.query_plans --database ../count-account-db.sqlite3
+
+Exits with status 1 if any plan reads a table itself.
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+from typing import Any, Callable
+
+from sqlalchemy import event
+
+from utils import CategoryType
+from utils import models
+
+# Tables every report query must read through a covering index only.
+COVERED_TABLES = ('expenses', 'expense_rollups')
+YEAR = 2024
+MONTH = 5
+DAY = 17
+
+
+def queries(db: models.DB) -> dict[str, Callable[[], Any]]:
+    """Returns DB calls to check by their names."""
+    return {
+        'get_expenses per day': lambda: db.get_expenses(
+            book_id=1, category_id=1, year=YEAR, month=MONTH, day=DAY),
+        'get_expenses per month, category limit': lambda: db.get_expenses(
+            book_id=1, category_id=1, year=YEAR, month=MONTH),
+        'get_expenses per year': lambda: db.get_expenses(book_id=1, year=YEAR),
+        'get_expenses_per_category per day': lambda: db.get_expenses_per_category(
+            book_id=1, category_type=CategoryType.EXPENSE, year=YEAR, month=MONTH, day=DAY),
+        'get_expenses_per_category per month': lambda: db.get_expenses_per_category(
+            book_id=1, category_type=CategoryType.EXPENSE, year=YEAR, month=MONTH),
+        'get_expenses_per_category per year': lambda: db.get_expenses_per_category(
+            book_id=1, category_type=CategoryType.EXPENSE, year=YEAR),
+        'get_expenses_per_day': lambda: db.get_expenses_per_day(
+            1, CategoryType.EXPENSE, YEAR, MONTH),
+        'get_expenses_per_day of all types': lambda: db.get_expenses_per_day(
+            1, None, YEAR, MONTH),
+        'get_expenses_per_month': lambda: db.get_expenses_per_month(
+            1, CategoryType.EXPENSE, YEAR),
+        'get_expenses_per_year': lambda: db.get_expenses_per_year(1, CategoryType.EXPENSE),
+    }
+
+
+def check(db: models.DB) -> list[str]:
+    """Prints plan of every query and returns problems found."""
+    statements: list[tuple[str, Any]] = []
+
+    def capture(connection, cursor, statement, parameters, context, executemany) -> None:
+        if statement.lstrip().upper().startswith('SELECT'):
+            statements.append((statement, parameters))
+
+    event.listen(db.engine, 'before_cursor_execute', capture)
+    problems = []
+    try:
+        for name, query in queries(db).items():
+            statements.clear()
+            query()
+            for statement, parameters in statements:
+                with db.engine.connect() as connection:
+                    plan = [row[-1] for row in connection.exec_driver_sql(
+                        f'EXPLAIN QUERY PLAN {statement}', parameters
+                    )]
+                print(f'== {name}')
+                print('\n'.join(f'  {step}' for step in plan))
+                for step in plan:
+                    words = step.split()
+                    if (
+                        words[0] in ('SCAN', 'SEARCH')
+                        and words[1] in COVERED_TABLES
+                        and 'USING COVERING INDEX' not in step
+                    ):
+                        problems.append(f'{name}: {step}')
+                if 'expenses.deleted' in statement and 'expenses.deleted = 0' not in statement:
+                    problems.append(f'{name}: deleted is not compared with literal 0')
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', capture)
+    return problems
+
+
+def main() -> None:
+    """Checks plans against given or fresh database."""
+    parser = argparse.ArgumentParser(description=__doc__.split('\n', maxsplit=1)[0])
+    parser.add_argument('--database', help='SQLite file to check, a fresh one by default')
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as db_path:
+        database = args.database or os.path.join(db_path, 'count-account-db.sqlite3')
+        db = models.DB(f'sqlite:///{database}')
+        problems = check(db)
+        db.engine.dispose()
+    if problems:
+        print('\nQueries not covered by index:\n' + '\n'.join(problems))
+        sys.exit(1)
+    print('\nAll queries are covered by index.')
+
+
+if __name__ == '__main__':
+    main()
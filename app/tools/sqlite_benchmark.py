@@ -0,0 +1,78 @@
+"""Benchmark of SQLite pragma profile.
+
+Adds expenses one by one, each in its own transaction as handlers do,
+then runs monthly report queries, with stock SQLite settings and with
+DEFAULT_SQLITE_PRAGMAS, each on a fresh database file and in a process
+of its own, as DB tables are defined once per process:
+
+    python -m tools.sqlite_benchmark --expenses 2000 --reports 500
+"""
+
+import argparse
+import multiprocessing
+import os
+import random
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+
+from utils import CategoryType
+from utils import models
+
+
+def run(database: str, pragmas: dict, expenses: int, reports: int) -> tuple[float, float]:
+    """Returns expenses added and report query pairs run per second."""
+    random.seed(0)
+    db = models.DB(f'sqlite:///{database}', pragmas=pragmas)
+    book_id = db.add_book(user_id=1, title='Book', currency='EUR', created=datetime.utcnow())['id']
+    started = time.perf_counter()
+    for _ in range(expenses):
+        created = datetime(2024, random.randint(1, 12), random.randint(1, 28))
+        db.add_expense(
+            user_id=1,
+            book_id=book_id,
+            category_id=random.randint(1, 20),
+            category_type=CategoryType.EXPENSE,
+            amount=random.uniform(1, 100),
+            year=created.year,
+            month=created.month,
+            day=created.day,
+            created=created,
+            deleted=False
+        )
+    inserts = expenses / (time.perf_counter() - started)
+    started = time.perf_counter()
+    for number in range(reports):
+        month = number % 12 + 1
+        db.get_expenses_per_category(
+            book_id=book_id, category_type=CategoryType.EXPENSE, year=2024, month=month)
+        db.get_expenses_per_day(book_id, CategoryType.EXPENSE, 2024, month)
+    queries = reports / (time.perf_counter() - started)
+    db.engine.dispose()
+    return inserts, queries
+
+
+def main() -> None:
+    """Runs benchmark with both profiles."""
+    parser = argparse.ArgumentParser(description=__doc__.split('\n', maxsplit=1)[0])
+    parser.add_argument('--expenses', type=int, default=2000)
+    parser.add_argument('--reports', type=int, default=500)
+    parser.add_argument('--path', help='directory for database files, e.g. on the production disk')
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory(dir=args.path) as db_path:
+        for name, pragmas in (('stock', {}), ('profile', models.DEFAULT_SQLITE_PRAGMAS)):
+            context = multiprocessing.get_context('spawn')
+            with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+                inserts, queries = executor.submit(
+                    run,
+                    os.path.join(db_path, f'{name}.sqlite3'),
+                    pragmas,
+                    args.expenses,
+                    args.reports
+                ).result()
+            print(f'{name:<8} {inserts:>8.0f} inserts/s {queries:>8.0f} report pairs/s')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,114 @@
+"""Benchmark of bot cold start and of the first report.
+
+Starts the bot against fake Bot API with a fresh database and an empty
+matplotlib config dir, so font cache is built from scratch, as after a
+deploy. Measures import of handlers.reports, time from process start to
+the first reply, and latency of the first /today chart requested --delay
+seconds after start, with chart workers warmed up and without it:
+
+    python -m tools.startup_benchmark --runs 3
+"""
+
+import argparse
+import asyncio
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+from tools.fake_telegram import SimulatedUser, serve
+
+APP_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+IMPORT_TIMER = (
+    'import time; started = time.perf_counter(); import handlers.reports; '
+    'print(time.perf_counter() - started)'
+)
+
+
+def import_seconds(config_dir: str) -> float:
+    """Returns seconds to import handlers.reports in a fresh interpreter."""
+    output = subprocess.run(
+        [sys.executable, '-c', IMPORT_TIMER],
+        env=dict(os.environ, MPLCONFIGDIR=config_dir),
+        cwd=APP_PATH,
+        check=True,
+        capture_output=True,
+        text=True
+    ).stdout
+    return float(output.split()[-1])
+
+
+async def run(warm_up: bool, args: argparse.Namespace) -> tuple[float, float]:
+    """Starts the bot and returns seconds to the first reply and to the first report."""
+    server, runner = await serve(args.host, args.port)
+    with tempfile.TemporaryDirectory() as db_path, tempfile.TemporaryDirectory() as config_dir:
+        env = dict(
+            os.environ,
+            DB_PATH=db_path,
+            MPLCONFIGDIR=config_dir,
+            CHART_WARM_UP='1' if warm_up else '0',
+            SHARDS='1',
+            STATS_INTERVAL='0',
+            TELEGRAM_TOKEN='1:fake',
+            TELEGRAM_API_URL=f'http://{args.host}:{args.port}',
+            TELEGRAM_MODE='polling',
+            ENABLE_BACKUP='',
+        )
+        user = SimulatedUser(server, 1000, args.timeout)
+        started = time.perf_counter()
+        bot = await asyncio.create_subprocess_exec(
+            sys.executable, os.path.join(APP_PATH, 'main.py'),
+            env=env,
+            cwd=APP_PATH,
+            stdout=asyncio.subprocess.DEVNULL if not args.verbose else None
+        )
+        try:
+            # Update waits for the bot to poll it, so the reply comes once
+            # the bot is up.
+            if await user.send('/start') is None:
+                raise TimeoutError('Bot did not reply to /start')
+            first_reply = time.perf_counter() - started
+            await user.create_book()
+            await user.add_expenses(1)
+            await asyncio.sleep(max(args.delay - (time.perf_counter() - started), 0))
+            if await user.request_report('/today') is None:
+                raise TimeoutError('Bot did not send the report')
+            return first_reply, user.latencies['report'][0]
+        finally:
+            bot.terminate()
+            await bot.wait()
+            await server.close()
+            await runner.cleanup()
+
+
+async def main() -> None:
+    """Runs benchmark with and without warm up."""
+    parser = argparse.ArgumentParser(description=__doc__.split('\n', maxsplit=1)[0])
+    parser.add_argument('--runs', type=int, default=3)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8081)
+    parser.add_argument('--delay', type=float, default=15,
+                        help='seconds from process start to the first report')
+    parser.add_argument('--timeout', type=float, default=60, help='seconds to wait for reply')
+    parser.add_argument('--verbose', action='store_true', help='show output of the bot')
+    args = parser.parse_args()
+    imports = []
+    for _ in range(args.runs):
+        with tempfile.TemporaryDirectory() as config_dir:
+            imports.append(import_seconds(config_dir))
+    print(f'handlers.reports import: {", ".join(f"{seconds:.2f}" for seconds in imports)} s')
+    for warm_up in (False, True):
+        results = [await run(warm_up, args) for _ in range(args.runs)]
+        print(
+            f'{"with" if warm_up else "without"} warm up: '
+            f'process start to first reply '
+            f'{", ".join(f"{first_reply:.2f}" for first_reply, _ in results)} s, '
+            f'first /today chart {args.delay:.0f} s after start '
+            f'{", ".join(f"{report * 1000:.0f}" for _, report in results)} ms',
+            flush=True
+        )
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
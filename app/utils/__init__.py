@@ -37,6 +37,12 @@ MONTH_LABELS = {
     12: messages.DECEMBER,
 }
 
+REPORT_MODES = {
+    'chart': messages.SETTINGS_REPORT_MODE_CHART,
+    'text': messages.SETTINGS_REPORT_MODE_TEXT,
+    'auto': messages.SETTINGS_REPORT_MODE_AUTO,
+}
+
 DEFAULT_INCOME_CATEGORIES = {
     'default': {
         'Benefits': {},
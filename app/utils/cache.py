@@ -0,0 +1,173 @@
+"""In-process caches."""
+
+import asyncio
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Hashable, Optional
+
+_MISSING = object()
+
+
+class LRUCache:
+    """Thread safe mapping that evicts least recently used entries.
+
+    Entries older than ttl seconds, if specified, are treated as missing.
+    If weigher is specified, maxsize bounds total weight of the values
+    instead of number of entries.
+    """
+    maxsize: int
+    ttl: Optional[float]
+    weigher: Callable[[Any], int]
+    weight: int
+    hits: int
+    misses: int
+
+    def __init__(
+        self,
+        maxsize: int = 128,
+        ttl: Optional[float] = None,
+        weigher: Optional[Callable[[Any], int]] = None
+    ) -> None:
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.weigher = weigher or (lambda value: 1)
+        self.weight = 0
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def __contains__(self, key: Hashable) -> bool:
+        """Returns True if value is cached and not expired, hits and misses are not counted."""
+        with self._lock:
+            entry = self._data.get(key)
+            return entry is not None and (entry[0] is None or entry[0] >= time.monotonic())
+
+    def _remove(self, key: Hashable) -> Any:
+        """Removes entry and returns its value, lock must be held."""
+        _, value, weight = self._data.pop(key)
+        self.weight -= weight
+        return value
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        """Returns cached value and marks it as recently used."""
+        with self._lock:
+            if key not in self._data:
+                self.misses += 1
+                return default
+            expires, value, _ = self._data[key]
+            if expires is not None and expires < time.monotonic():
+                self._remove(key)
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key: Hashable, value: Any) -> None:
+        """Stores value, evicting least recently used entries if needed."""
+        expires = None if self.ttl is None else time.monotonic() + self.ttl
+        weight = self.weigher(value)
+        with self._lock:
+            if key in self._data:
+                self._remove(key)
+            if weight > self.maxsize:
+                return
+            self._data[key] = (expires, value, weight)
+            self.weight += weight
+            while self.weight > self.maxsize:
+                self._remove(next(iter(self._data)))
+
+    def pop(self, key: Hashable) -> Any:
+        """Removes entry and returns its value."""
+        with self._lock:
+            if key not in self._data:
+                return None
+            return self._remove(key)
+
+    def pop_if(self, predicate: Callable[[Hashable, Any], bool]) -> None:
+        """Removes all entries matching predicate."""
+        with self._lock:
+            for key in [key for key, (_, value, _) in self._data.items() if predicate(key, value)]:
+                self._remove(key)
+
+    def clear(self) -> None:
+        """Removes all entries."""
+        with self._lock:
+            self._data.clear()
+            self.weight = 0
+
+    def get_or_set(self, key: Hashable, factory: Callable[[], Any]) -> Any:
+        """Returns cached value or stores the one built by factory."""
+        value = self.get(key, _MISSING)
+        if value is _MISSING:
+            value = factory()
+            self.set(key, value)
+        return value
+
+    def stats(self) -> dict[str, int]:
+        """Returns cache counters."""
+        return {
+            'entries': len(self._data),
+            'weight': self.weight,
+            'hits': self.hits,
+            'misses': self.misses,
+        }
+
+
+class SingleFlight:
+    """Shares one in-flight computation between concurrent callers.
+
+    The first caller with the key runs the factory, callers arriving
+    while it runs wait for its result instead of running it again.
+    """
+    calls: int
+    coalesced: int
+
+    def __init__(self) -> None:
+        self.calls = 0
+        self.coalesced = 0
+        self._flights: dict[Hashable, asyncio.Future] = {}
+
+    async def run(self, key: Hashable, factory: Callable[[], Awaitable[Any]]) -> Any:
+        """Returns result of the factory, shared with concurrent callers."""
+        self.calls += 1
+        while key in self._flights:
+            future = self._flights[key]
+            self.coalesced += 1
+            try:
+                return await asyncio.shield(future)
+            except asyncio.CancelledError:
+                if not future.cancelled():
+                    raise
+                # Caller that ran the factory was cancelled, try again.
+                self.coalesced -= 1
+        future = asyncio.get_running_loop().create_future()
+        # Retrieve exception even if nobody is waiting, to avoid warnings.
+        future.add_done_callback(lambda future: future.cancelled() or future.exception())
+        self._flights[key] = future
+        try:
+            result = await factory()
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as error:
+            future.set_exception(error)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            del self._flights[key]
+
+    def stats(self) -> dict[str, int]:
+        """Returns counters of calls."""
+        return {
+            'calls': self.calls,
+            'coalesced': self.coalesced,
+            'in_flight': len(self._flights),
+        }
@@ -0,0 +1,221 @@
+"""Report charts rendering."""
+
+import asyncio
+import functools
+import logging
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from io import BytesIO
+from typing import TYPE_CHECKING, Any, Callable, Optional
+
+# Matplotlib is imported by worker processes only, so it does not slow
+# down bot startup.
+if TYPE_CHECKING:
+    from matplotlib.axes import Axes
+    from matplotlib.figure import Figure
+
+# Figure kept by each worker process and reused between charts.
+_figure: Optional['Figure'] = None
+
+
+def _new_axes(reuse: bool = True) -> tuple['Figure', 'Axes']:
+    """Returns empty figure with single axes.
+
+    Figure is attached to Agg canvas directly, so it is never registered
+    in pyplot figure manager and is garbage collected as any other object.
+    If reuse is set, figure of the previous chart is cleared and returned.
+    """
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    from matplotlib.figure import Figure
+
+    global _figure
+    if reuse and _figure is not None:
+        _figure.clear()
+        figure = _figure
+    else:
+        figure = Figure()
+        FigureCanvasAgg(figure)
+        if reuse:
+            _figure = figure
+    return figure, figure.add_subplot()
+
+
+def per_category_chart(
+        title: str,
+        subtitle: str,
+        categories: list[str],
+        amounts: list[float],
+        colors: list[str],
+        currency: str
+) -> bytes:
+    """Returns PNG with horizontal bar per category."""
+    max_amount = max(amounts)
+    fig, ax = _new_axes()
+    bars = ax.barh(categories, amounts, label=categories, color=colors)
+    fig.suptitle(title)
+    ax.set_title(subtitle, fontweight='bold')
+    if len(categories) < 10:
+        label_size = 12
+    elif len(categories) < 20:
+        label_size = 10
+    else:
+        label_size = 8
+    low_values = [f'{v:.2f}' if v < 0.15 * max_amount else '' for v in amounts]
+    nonlow_values = [f'{v:.2f}' if v >= 0.15 * max_amount else '' for v in amounts]
+    ax.bar_label(bars, nonlow_values, size=label_size,
+                 label_type='center', color='white')
+    ax.bar_label(bars, low_values, size=label_size,
+                 label_type='edge', color='grey', padding=3)
+    ax.set_xlabel(currency)
+    return _to_png(fig)
+
+
+def per_day_chart(
+        title: str,
+        subtitle: str,
+        period: str,
+        amounts: list[float],
+        currency: str
+) -> bytes:
+    """Returns PNG with vertical bar per day of month."""
+    max_amount = max(amounts)
+    days = [day for day in range(1, len(amounts) + 1)]
+    fig, ax = _new_axes()
+    bars = ax.bar(days, amounts, label=days, align='center', color='#6BAED6')
+    fig.suptitle(title)
+    ax.set_title(subtitle, fontweight='bold')
+    low_values = [f'{v:.2f}' if v < 0.15 * max_amount else '' for v in amounts]
+    nonlow_values = [f'{v:.2f}' if v >= 0.15 * max_amount else '' for v in amounts]
+    ax.bar_label(bars, nonlow_values, size='8', color='white',
+                 label_type='center', rotation='vertical')
+    ax.bar_label(bars, low_values, size='8', color='gray',
+                 label_type='edge', rotation='vertical', padding=5)
+    ax.set_xlim(0.5, len(amounts) + 0.5)
+    ax.set_ylabel(currency)
+    ax.set_xlabel(period)
+    ax.set_xticks(days)
+    ax.tick_params(axis='x', labelsize='8')
+    return _to_png(fig)
+
+
+def per_month_chart(
+        title: str,
+        subtitle: str,
+        period: str,
+        month_labels: list[str],
+        amounts: list[float],
+        currency: str
+) -> bytes:
+    """Returns PNG with vertical bar per month of year."""
+    max_amount = max(amounts)
+    months = [month for month in range(1, len(amounts) + 1)]
+    fig, ax = _new_axes()
+    bars = ax.bar(months, amounts, label=month_labels, align='center', color='#6BAED6')
+    fig.suptitle(title)
+    ax.set_title(subtitle, fontweight='bold')
+    low_values = [f'{v:.2f}' if v < 0.15 * max_amount else '' for v in amounts]
+    nonlow_values = [f'{v:.2f}' if v >= 0.15 * max_amount else '' for v in amounts]
+    ax.bar_label(bars, nonlow_values, color='white',
+                 label_type='center', rotation='vertical')
+    ax.bar_label(bars, low_values, color='gray',
+                 label_type='edge', rotation='vertical', padding=5)
+    ax.set_xlim(0.5, len(amounts) + 0.5)
+    ax.set_ylabel(currency)
+    ax.set_xlabel(period)
+    ax.set_xticks(months, month_labels, rotation='vertical')
+    return _to_png(fig)
+
+
+def warm_up() -> float:
+    """Renders empty chart to load matplotlib and its font cache.
+
+    Returns seconds spent.
+    """
+    started = time.perf_counter()
+    fig, ax = _new_axes()
+    ax.set_title('0123456789', fontweight='bold')
+    _to_png(fig)
+    return time.perf_counter() - started
+
+
+def _to_png(fig: 'Figure') -> bytes:
+    """Returns figure as PNG."""
+    with BytesIO() as buffer:
+        fig.savefig(buffer, format='png', bbox_inches='tight')
+        return buffer.getvalue()
+
+
+class Chart:
+    """Rendered chart with its caption."""
+    image_png: bytes
+    caption: str
+
+    def __init__(self, image_png: bytes, caption: str) -> None:
+        self.image_png = image_png
+        self.caption = caption
+
+
+class ChartRenderer:
+    """Renders charts in a pool of worker processes.
+
+    Rendering is CPU bound, so running it in the event loop thread would
+    block all other updates until the chart is ready. If a worker dies,
+    e.g. killed for memory, the pool is replaced with a new one.
+    """
+    max_workers: int
+    executor: ProcessPoolExecutor
+
+    def __init__(self, max_workers: Optional[int] = None) -> None:
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self.executor = self._new_executor()
+
+    def _new_executor(self) -> ProcessPoolExecutor:
+        """Returns new pool of worker processes."""
+        # Workers are forked from a clean server process rather than from
+        # the bot process, which already runs threads and owns DB connections.
+        # The server imports matplotlib once and every worker inherits it.
+        context = multiprocessing.get_context('forkserver')
+        context.set_forkserver_preload([
+            __name__,
+            'matplotlib.figure',
+            'matplotlib.backends.backend_agg',
+        ])
+        return ProcessPoolExecutor(max_workers=self.max_workers, mp_context=context)
+
+    async def warm_up(self) -> list[float]:
+        """Starts all worker processes and loads matplotlib in each of them.
+
+        Returns seconds spent by every worker. Starting processes blocks,
+        so jobs are submitted from a thread to keep event loop responsive.
+        """
+        loop = asyncio.get_running_loop()
+        futures = await loop.run_in_executor(
+            None,
+            lambda: [self.executor.submit(warm_up) for _ in range(self.max_workers)]
+        )
+        return await asyncio.gather(*(asyncio.wrap_future(future) for future in futures))
+
+    async def render(self, chart: Callable[..., bytes], **kwargs: Any) -> bytes:
+        """Returns PNG rendered by chart function with specified arguments.
+
+        Chart is rendered once again in a new pool if the pool is broken.
+        """
+        loop = asyncio.get_running_loop()
+        job = functools.partial(chart, **kwargs)
+        executor = self.executor
+        try:
+            return await loop.run_in_executor(executor, job)
+        except BrokenProcessPool:
+            # Concurrent renders fail together, the first of them replaces the pool.
+            if self.executor is executor:
+                logging.warning('Chart worker process died, starting new workers')
+                executor.shutdown(wait=False, cancel_futures=True)
+                self.executor = self._new_executor()
+            return await loop.run_in_executor(self.executor, job)
+
+    def shutdown(self) -> None:
+        """Stops worker processes."""
+        self.executor.shutdown(wait=True, cancel_futures=True)
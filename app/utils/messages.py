@@ -359,6 +359,16 @@ REPORTS_BOOK_AND_PERIOD = {
     'ru': '{book_title} ({currency}). {category_type}. {period}',
 }
 
+REPORTS_CAPTION = {
+    'default': '{category_type}. {period}. {total_label}: {total_amount:.2f} {currency}',
+    'ru': '{category_type}. {period}. {total_label}: {total_amount:.2f} {currency}',
+}
+
+REPORTS_BUSY = {
+    'default': 'Too many reports are being prepared right now. Please try again in a minute.',
+    'ru': 'Сейчас готовится слишком много отчетов. Пожалуйста, повторите запрос через минуту.',
+}
+
 REPORTS_EXPENSE = {
     'default': 'Expenses',
     'ru': 'Расходы',
@@ -369,6 +379,11 @@ REPORTS_INCOME = {
     'ru': 'Доходы',
 }
 
+REPORTS_QUEUED = {
+    'default': 'Your report is queued, position {position}. It will be sent shortly.',
+    'ru': 'Ваш отчет в очереди, позиция {position}. Он будет отправлен в ближайшее время.',
+}
+
 REPORTS_SELECT_YEAR = {
     'default': 'Please select the year.',
     'ru': 'Пожалуйста, выберите год.',
@@ -422,6 +437,43 @@ SETTINGS_LANGUAGE_UPDATED = {
     ),
 }
 
+SETTINGS_SELECT_REPORT_MODE = {
+    'default': (
+        'Settings:\n\n'
+        'Reports: <strong>{report_mode}</strong>\n\n'
+        'Tap the button below to edit relevant parameter.'
+    ),
+    'ru': (
+        'Настройки:\n\n'
+        'Отчеты: <strong>{report_mode}</strong>\n\n'
+        'Тапните кнопку ниже, чтобы изменить соответствующие настройки.'
+    ),
+}
+
+SETTINGS_REPORT_MODE_UPDATED = {
+    'default': (
+        'Reports will be sent as <strong>{report_mode}</strong>.'
+    ),
+    'ru': (
+        'Отчеты будут отправляться в виде: <strong>{report_mode}</strong>.'
+    ),
+}
+
+SETTINGS_REPORT_MODE_CHART = {
+    'default': 'Charts',
+    'ru': 'Графики',
+}
+
+SETTINGS_REPORT_MODE_TEXT = {
+    'default': 'Text',
+    'ru': 'Текст',
+}
+
+SETTINGS_REPORT_MODE_AUTO = {
+    'default': 'Text for short reports, charts otherwise',
+    'ru': 'Текст для коротких отчетов, иначе графики',
+}
+
 ACTIVE_BOOK_REQUIRED = {
     'default': (
         'Make sure that you are joined existing book. You can do it through the menu '
@@ -0,0 +1,49 @@
+"""Middlewares for telegram bot dispatcher."""
+
+from typing import Any, Awaitable, Callable
+
+from aiogram import BaseMiddleware
+from aiogram.types import TelegramObject
+
+from utils import models
+from utils.sharding import ShardRouter
+
+
+class UnitOfWorkMiddleware(BaseMiddleware):
+    """Handles every update within one DB connection and transaction.
+
+    Changes are committed once the update is handled and rolled back if
+    handler raises an error.
+    """
+    db: models.AsyncDB
+
+    def __init__(self, db: models.AsyncDB) -> None:
+        self.db = db
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: dict[str, Any]
+    ) -> Any:
+        async with self.db.unit_of_work():
+            return await handler(event, data)
+
+
+class RoutingMiddleware(BaseMiddleware):
+    """Passes every update to the worker process of its user.
+
+    Update is not handled by this process at all.
+    """
+    router: ShardRouter
+
+    def __init__(self, router: ShardRouter) -> None:
+        self.router = router
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: dict[str, Any]
+    ) -> Any:
+        self.router.route(event.model_dump(mode='json', by_alias=True, exclude_none=True))
@@ -1,35 +1,237 @@
 """Defines class to work with database."""
 
+import asyncio
+import bisect
+import contextvars
+import difflib
+import functools
+import itertools
+import json
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager, contextmanager
+from datetime import datetime
 from secrets import token_urlsafe
-from typing import Any, Optional
+from typing import Any, AsyncIterator, Callable, Hashable, Iterator, Optional
 
 from sqlalchemy import Table, Index, Column
 from sqlalchemy import Integer, String, DateTime, Boolean, Text, Float, Enum, Text
-from sqlalchemy import MetaData, DDL
-from sqlalchemy import create_engine, Engine
-from sqlalchemy import select, insert, update, func, asc
+from sqlalchemy import MetaData, DDL, text
+from sqlalchemy import create_engine, event, Engine, inspect
+from sqlalchemy import select, insert, update, delete, func, asc, case, exists, or_
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from sqlalchemy.engine.base import Connection
 from sqlalchemy.exc import OperationalError
 
 from utils import CategoryType
+from utils.cache import LRUCache
+
+
+class UnitOfWork:
+    """Connection shared by all DB calls made within one unit of work."""
+    connection: Connection
+    on_end: list[Callable[[], None]]
+    on_commit: list[Callable[[], None]]
+
+    def __init__(self, connection: Connection) -> None:
+        self.connection = connection
+        self.on_end = []
+        self.on_commit = []
+
+
+# Minimal similarity of a mistyped category title to the real one.
+CATEGORY_MATCH_CUTOFF = 0.75
+
+
+def _normalize_title(title: str) -> str:
+    """Returns title in the form used to match it against user input."""
+    return ' '.join(title.casefold().replace('ё', 'е').replace('/', ' ').split())
+
+
+class CategoryTree:
+    """Active categories of the book indexed for navigation and search."""
+    nodes: dict[int, Any]
+    children: dict[tuple[int, CategoryType], list[Any]]
+
+    def __init__(self, categories: list[Any]) -> None:
+        self.nodes = {}
+        self.children = {}
+        self._options = {}
+        self._titles = None
+        for category in categories:
+            self.nodes[category.id] = category
+            self.children.setdefault(
+                (category.parent_id, category.category_type), []).append(category)
+
+    def get(self, id: int, category_type: Optional[CategoryType] = None) -> Any:
+        """Returns category by id, if it has specified type."""
+        category = self.nodes.get(id)
+        if category is None:
+            return None
+        if category_type is not None and category.category_type != category_type:
+            return None
+        return category
+
+    def get_children(self, parent_id: int, category_type: CategoryType) -> list[Any]:
+        """Returns subcategories ordered by title."""
+        return self.children.get((parent_id, category_type), [])
+
+    def get_child_by_title(
+            self,
+            parent_id: int,
+            category_type: CategoryType,
+            title: str
+    ) -> Any:
+        """Returns subcategory with specified title."""
+        for category in self.get_children(parent_id, category_type):
+            if category.title == title:
+                return category
+        return None
+
+    def find(self, text: str) -> list[Any]:
+        """Returns categories matching text typed by user.
+
+        Text is matched against titles and paths of categories, e.g.
+        'food restaurants', exactly, then as prefix of a title or of any of
+        its words, then as prefix of a path and finally fuzzily. The first
+        of them matching anything wins, so more than one category returned
+        means the text is ambiguous.
+        """
+        if self._titles is None:
+            self._build_index()
+        query = _normalize_title(text)
+        if not query:
+            return []
+        ids = self._titles.get(query, set()) | self._paths.get(query, set())
+        if not ids:
+            ids = self._ids_by_prefix(self._words, self._word_keys, query)
+        if not ids:
+            ids = self._ids_by_prefix(self._paths, self._path_keys, query)
+        if not ids:
+            for key in difflib.get_close_matches(
+                query,
+                [*self._titles, *self._paths],
+                n=3,
+                cutoff=CATEGORY_MATCH_CUTOFF
+            ):
+                ids |= self._titles.get(key, set()) | self._paths.get(key, set())
+        return [self.nodes[id] for id in sorted(ids)]
+
+    def _build_index(self) -> None:
+        """Indexes categories by normalized title, its word suffixes and path.
+
+        Keys are kept sorted too, so keys starting with a prefix are found
+        by bisect.
+        """
+        titles: dict[str, set[int]] = {}
+        words: dict[str, set[int]] = {}
+        paths: dict[str, set[int]] = {}
+        for category in self.nodes.values():
+            title = _normalize_title(category.title)
+            titles.setdefault(title, set()).add(category.id)
+            title_words = title.split()
+            for start in range(len(title_words)):
+                words.setdefault(' '.join(title_words[start:]), set()).add(category.id)
+            path = [title]
+            parent = self.nodes.get(category.parent_id)
+            while parent is not None:
+                path.insert(0, _normalize_title(parent.title))
+                parent = self.nodes.get(parent.parent_id)
+            if len(path) > 1:
+                paths.setdefault(' '.join(path), set()).add(category.id)
+        self._words, self._word_keys = words, sorted(words)
+        self._paths, self._path_keys = paths, sorted(paths)
+        self._titles = titles
+
+    @staticmethod
+    def _ids_by_prefix(
+            keys: dict[str, set[int]],
+            sorted_keys: list[str],
+            prefix: str
+    ) -> set[int]:
+        """Returns ids of categories having keys starting with prefix."""
+        ids = set()
+        for key in itertools.islice(sorted_keys, bisect.bisect_left(sorted_keys, prefix), None):
+            if not key.startswith(prefix):
+                break
+            ids |= keys[key]
+        return ids
+
+    def get_options(self, id: int) -> dict[str, Any]:
+        """Returns parsed options of the category."""
+        if id not in self._options:
+            try:
+                options = json.loads(self.nodes[id].options)
+            except Exception:
+                options = {}
+            self._options[id] = options if isinstance(options, dict) else {}
+        return self._options[id]
+
+
+USER_CACHE_SIZE = 4096
+USER_CACHE_TTL = 600
+
+DEFAULT_SQLITE_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'mmap_size': 268435456,
+    'cache_size': -20000,
+    'temp_store': 'MEMORY',
+    'busy_timeout': 5000,
+}
+
 
 class DB:
     """Definition of database tables."""
     metadata_obj: MetaData = MetaData()
     engine: Engine
+    pragmas: dict[str, Any]
+    category_trees: LRUCache
+    users: LRUCache
+    active_books: LRUCache
+    invalidation_listener: Optional[Callable[[str, Hashable], None]]
     log_table: Table
     user_table: Table
     book_table: Table
     category_table: Table
     expense_table: Table
+    expense_rollup_table: Table
     shared_book_table: Table
+    telegram_file_table: Table
+    fsm_state_table: Table
 
 
-    def __init__(self, database_url: str = 'sqlite:///db.sqlite3'):
+    def __init__(
+            self,
+            database_url: str = 'sqlite:///db.sqlite3',
+            pragmas: Optional[dict[str, Any]] = None
+    ):
         self.engine = create_engine(database_url)
+        self.pragmas = DEFAULT_SQLITE_PRAGMAS if pragmas is None else pragmas
+        event.listen(self.engine, 'connect', self._set_pragmas)
+        self.category_trees = LRUCache(maxsize=256)
+        self.users = LRUCache(maxsize=USER_CACHE_SIZE, ttl=USER_CACHE_TTL)
+        self.active_books = LRUCache(maxsize=USER_CACHE_SIZE, ttl=USER_CACHE_TTL)
+        # Called with cache name and key once change is committed, so other
+        # processes sharing the database can drop their copy with drop_cached.
+        self.invalidation_listener = None
+        self._unit_of_work = contextvars.ContextVar(
+            f'unit_of_work_{id(self)}', default=None)
         self._define_db_tables()
+        rollups_exist = inspect(self.engine).has_table(self.expense_rollup_table.name)
         self.metadata_obj.create_all(self.engine)
         self._alter_schema()
+        if not rollups_exist:
+            self.rebuild_expense_rollups()
+
+    def _set_pragmas(self, dbapi_connection: Any, connection_record: Any) -> None:
+        """Apply SQLite pragmas to every new connection."""
+        del connection_record
+        cursor = dbapi_connection.cursor()
+        for name, value in self.pragmas.items():
+            if value is not None:
+                cursor.execute(f'PRAGMA {name} = {value}')
+        cursor.close()
 
     def _define_db_tables(self) -> None:
         """Define required database tables."""
@@ -66,6 +268,7 @@ class DB:
             Column("currency", String(15)),
             Column("created", DateTime),
             Column("deleted", Boolean, default=False),
+            Column("data_version", Integer, default=0),
             Index("idx_books_user_id", "user_id"),
             Index("idx_books_book_uid", "book_uid"),
         )
@@ -97,10 +300,36 @@ class DB:
             Column("created", DateTime),
             Column("deleted", Boolean, default=False),
             Index("idx_expenses_user_id", "user_id"),
-            Index("idx_expenses_book_id", "book_id"),
             Index("idx_expenses_category_id", "category_id"),
             Index("idx_expenses_created", "created"),
-            Index("idx_expenses_date", "year", "month", "day"),
+            Index(
+                "idx_expenses_book_date",
+                "book_id", "year", "month", "day",
+                "category_type", "category_id", "amount", "deleted",
+                sqlite_where=text("deleted = 0")
+            ),
+        )
+        self.expense_rollup_table = Table(
+            "expense_rollups",
+            self.metadata_obj,
+            Column("id", Integer, primary_key=True),
+            Column("book_id", Integer),
+            Column("category_type", Enum(CategoryType), default=CategoryType.EXPENSE),
+            Column("category_id", Integer),
+            Column("year", Integer),
+            Column("month", Integer),
+            Column("amount", Float, default=0),
+            Column("count", Integer, default=0),
+            Index(
+                "idx_expense_rollups_key",
+                "book_id", "category_type", "year", "month", "category_id",
+                unique=True
+            ),
+            Index(
+                "idx_expense_rollups_book_date",
+                "book_id", "year", "month",
+                "category_type", "category_id", "amount"
+            ),
         )
         self.shared_book_table = Table(
             "shared_books",
@@ -113,6 +342,24 @@ class DB:
             Index("idx_shared_books_user_id", "user_id"),
             Index("idx_shared_books_book_id", "book_id"),
         )
+        self.telegram_file_table = Table(
+            "telegram_files",
+            self.metadata_obj,
+            Column("id", Integer, primary_key=True, autoincrement=True),
+            Column("content_hash", String(64)),
+            Column("file_id", String(255)),
+            Column("created", DateTime),
+            Index("idx_telegram_files_content_hash", "content_hash", unique=True),
+        )
+        self.fsm_state_table = Table(
+            "fsm_states",
+            self.metadata_obj,
+            Column("key", String(255), primary_key=True),
+            Column("state", String(255), nullable=True),
+            Column("data", Text),
+            Column("updated", DateTime),
+            Index("idx_fsm_states_updated", "updated"),
+        )
 
     def _alter_schema(self) -> None:
         """Alter database schema, if necessary."""
@@ -152,29 +399,175 @@ class DB:
                 connection.commit()
         except OperationalError:
             pass
+        column = Column("data_version", Integer, default=0)
+        column_name = column.compile(dialect=self.engine.dialect)
+        column_type = column.type.compile(self.engine.dialect)
+        try:
+            with self.engine.connect() as connection:
+                connection.execute(DDL(
+                    f"ALTER TABLE books ADD COLUMN {column_name} "
+                    f"{column_type} DEFAULT(0)"
+                ))
+                connection.commit()
+        except OperationalError:
+            pass
+        with self.engine.connect() as connection:
+            connection.execute(DDL("DROP INDEX IF EXISTS idx_expenses_date"))
+            connection.execute(DDL("DROP INDEX IF EXISTS idx_expenses_book_id"))
+            for table in (self.expense_table, self.expense_rollup_table):
+                for index in table.indexes:
+                    index.create(connection, checkfirst=True)
+            connection.commit()
+
+    @contextmanager
+    def _connect(self) -> Iterator[Connection]:
+        """Connection of current unit of work or a new one."""
+        unit_of_work = self._unit_of_work.get()
+        if unit_of_work is None:
+            with self.engine.connect() as connection:
+                yield connection
+            return
+        yield unit_of_work.connection
+
+    @contextmanager
+    def _transaction(self) -> Iterator[Connection]:
+        """Connection to write with.
+
+        Outside of a unit of work changes are committed on exit, otherwise
+        they are committed together with the whole unit of work.
+        """
+        unit_of_work = self._unit_of_work.get()
+        if unit_of_work is None:
+            with self.engine.begin() as connection:
+                yield connection
+            return
+        yield unit_of_work.connection
+
+    def _begin_unit_of_work(self) -> UnitOfWork:
+        """Open connection for new unit of work."""
+        return UnitOfWork(self.engine.connect())
+
+    def _end_unit_of_work(self, unit_of_work: UnitOfWork, commit: bool) -> None:
+        """Commit or rollback unit of work and close its connection."""
+        try:
+            with unit_of_work.connection as connection:
+                if commit:
+                    connection.commit()
+                else:
+                    connection.rollback()
+        finally:
+            for callback in unit_of_work.on_end:
+                callback()
+        if commit:
+            for callback in unit_of_work.on_commit:
+                callback()
+
+    def commit_unit_of_work(self) -> None:
+        """Commit changes made so far within current unit of work.
+
+        Unit of work goes on in a new transaction. Handlers call it after
+        their changes and before they reply to Telegram, so SQLite write
+        lock is not held during network round trips.
+        """
+        unit_of_work = self._unit_of_work.get()
+        if unit_of_work is None or not unit_of_work.connection.in_transaction():
+            return
+        unit_of_work.connection.commit()
+        on_commit, unit_of_work.on_commit = unit_of_work.on_commit, []
+        for callback in on_commit:
+            callback()
+
+    def _on_commit(self, callback: Callable[[], None]) -> None:
+        """Run callback now and once again when current unit of work ends.
+
+        Used to drop cached data: a reader within the unit of work could
+        cache changes that are not committed yet.
+        """
+        callback()
+        unit_of_work = self._unit_of_work.get()
+        if unit_of_work is not None:
+            unit_of_work.on_end.append(callback)
+
+    def _invalidate(self, cache: str, key: Hashable) -> None:
+        """Drop cached entry here and, once committed, in other processes."""
+        self._on_commit(functools.partial(self.drop_cached, cache, key))
+        if self.invalidation_listener is None:
+            return
+        notify = functools.partial(self.invalidation_listener, cache, key)
+        unit_of_work = self._unit_of_work.get()
+        if unit_of_work is None:
+            notify()
+        else:
+            unit_of_work.on_commit.append(notify)
+
+    def drop_cached(self, cache: str, key: Hashable) -> None:
+        """Drop cached entry.
+
+        Cache 'book_active_books' stands for active_books entries of all
+        users of the book with id passed as key.
+        """
+        if cache == 'book_active_books':
+            self.active_books.pop_if(lambda cached_key, _: cached_key[1] == key)
+        else:
+            getattr(self, cache).pop(key)
+
+    @contextmanager
+    def unit_of_work(self) -> Iterator[None]:
+        """Run all DB calls within the block in one transaction."""
+        unit_of_work = self._begin_unit_of_work()
+        token = self._unit_of_work.set(unit_of_work)
+        try:
+            yield
+        except BaseException:
+            self._end_unit_of_work(unit_of_work, commit=False)
+            raise
+        else:
+            self._end_unit_of_work(unit_of_work, commit=True)
+        finally:
+            self._unit_of_work.reset(token)
+
+    def backup(self, path: str) -> None:
+        """Save consistent snapshot of the database into specified file."""
+        with self.engine.connect() as connection:
+            source = connection.connection.driver_connection
+            target = sqlite3.connect(path)
+            try:
+                source.backup(target)
+            finally:
+                target.close()
 
     def add_log_record(self, **kwargs) -> int:
         """Insert new log record."""
-        with self.engine.connect() as connection:
+        with self._transaction() as connection:
             id = connection.execute(
                 insert(self.log_table).values(**kwargs)
             ).inserted_primary_key.id
-            connection.commit()
         return id
 
     def update_log_record(self, id: int, **kwargs):
         """Update log record."""
-        with self.engine.connect() as connection:
+        with self._transaction() as connection:
             connection.execute(update(self.log_table)
                 .where(self.log_table.c.id == id)
                 .values(**kwargs))
-            connection.commit()
 
     def get_user_by(self, *,
                     id: Optional[int] = None,
                     username: Optional[str] = None) -> Any:
+        """Get user from DB.
+
+        Lookups by id only are cached until the user is updated.
+        """
+        if id is not None and username is None:
+            return self.users.get_or_set(
+                id, functools.partial(self._get_user_by, id=id))
+        return self._get_user_by(id=id, username=username)
+
+    def _get_user_by(self, *,
+                     id: Optional[int] = None,
+                     username: Optional[str] = None) -> Any:
         """Get user from DB."""
-        with self.engine.connect() as connection:
+        with self._connect() as connection:
             statement = select(self.user_table)
             if id is not None:
                 statement = statement.where(self.user_table.c.id == id)
@@ -186,17 +579,17 @@ class DB:
 
     def add_user(self, **kwargs):
         """Insert new user."""
-        with self.engine.connect() as connection:
+        with self._transaction() as connection:
             connection.execute(insert(self.user_table).values(**kwargs))
-            connection.commit()
+        self._invalidate('users', kwargs['id'])
 
     def update_user(self, id: int, **kwargs):
         """Update user."""
-        with self.engine.connect() as connection:
+        with self._transaction() as connection:
             connection.execute(update(self.user_table)
                 .where(self.user_table.c.id == id)
                 .values(**kwargs))
-            connection.commit()
+        self._invalidate('users', id)
 
     def get_books_by(self, *,
                      user_id: Optional[int] = None,
@@ -204,7 +597,7 @@ class DB:
                      offset: Optional[int] = 0,
                      number: Optional[int] = 100) -> list[Any]:
         """Get books from DB."""
-        with self.engine.connect() as connection:
+        with self._connect() as connection:
             statement = (select(self.book_table)
                 .order_by(self.book_table.c.created.desc(),
                           self.book_table.c.id.desc())
@@ -224,7 +617,7 @@ class DB:
                     title: Optional[str] = None,
                     deleted: Optional[bool] = None) -> Any:
         """Get book from DB."""
-        with self.engine.connect() as connection:
+        with self._connect() as connection:
             statement = select(self.book_table)
             if id is not None:
                 statement = statement.where(self.book_table.c.id == id)
@@ -248,7 +641,7 @@ class DB:
         default_income_categories = {}
         if 'default_income_categories' in kwargs:
             default_income_categories = kwargs.pop('default_income_categories')
-        with self.engine.connect() as connection:
+        with self._transaction() as connection:
             id = connection.execute(
                 insert(self.book_table).values(**kwargs)).inserted_primary_key.id
             book_uid = f'{id}:' + token_urlsafe(12)
@@ -259,27 +652,68 @@ class DB:
             self._add_categories(
                 connection=connection,
                 book_id=id,
-                category_type=CategoryType.EXPENSE,
-                parent_id=0,
-                categories=default_expense_categories
-            )
-            self._add_categories(
-                connection=connection,
-                book_id=id,
-                category_type=CategoryType.INCOME,
-                parent_id=0,
-                categories=default_income_categories
+                categories={
+                    CategoryType.EXPENSE: default_expense_categories,
+                    CategoryType.INCOME: default_income_categories,
+                }
             )
-            connection.commit()
         return {'id': id, 'book_uid': book_uid}
 
     def update_book(self, id: int, **kwargs):
         """Update book."""
-        with self.engine.connect() as connection:
+        if 'title' in kwargs or 'currency' in kwargs:
+            kwargs['data_version'] = self.book_table.c.data_version + 1
+        with self._transaction() as connection:
             connection.execute(update(self.book_table)
                 .where(self.book_table.c.id == id)
                 .values(**kwargs))
-            connection.commit()
+        self._invalidate('book_active_books', id)
+
+    def get_book_data_version(self, id: int) -> int:
+        """Returns counter of changes to book data shown in reports.
+
+        Counter is read from DB every time, so it stays coherent with
+        changes made by other connections and processes.
+        """
+        with self._connect() as connection:
+            return connection.execute(
+                select(self.book_table.c.data_version)
+                .where(self.book_table.c.id == id)
+            ).scalar() or 0
+
+    def _bump_data_version(self, connection: Connection, book_id: int) -> None:
+        """Increments counter of changes to book data."""
+        connection.execute(update(self.book_table)
+            .where(self.book_table.c.id == book_id)
+            .values(data_version=self.book_table.c.data_version + 1))
+
+    def get_active_book(self, user_id: int, book_id: int) -> Any:
+        """Get book if it is available for the user.
+
+        Book is available when it is not deleted and the user either owns
+        it or is joined to it. Result is cached until book or membership
+        changes.
+        """
+        return self.active_books.get_or_set(
+            (user_id, book_id),
+            functools.partial(self._get_active_book, user_id, book_id)
+        )
+
+    def _get_active_book(self, user_id: int, book_id: int) -> Any:
+        """Get book if it is available for the user."""
+        with self._connect() as connection:
+            shared_book_exists = (exists()
+                .where(self.shared_book_table.c.book_id == self.book_table.c.id)
+                .where(self.shared_book_table.c.user_id == user_id)
+                .where(self.shared_book_table.c.disabled == False)
+                .where(self.shared_book_table.c.deleted == False))
+            statement = (select(self.book_table)
+                .where(self.book_table.c.id == book_id)
+                .where(self.book_table.c.deleted == False)
+                .where(or_(self.book_table.c.user_id == user_id, shared_book_exists))
+                .limit(1))
+            book_record = connection.execute(statement).first()
+        return book_record
 
     def get_categories_by(self, *,
                         book_id: int,
@@ -289,7 +723,7 @@ class DB:
                         offset: Optional[int] = 0,
                         number: Optional[int] = 100) -> list[Any]:
         """Get categories from DB."""
-        with self.engine.connect() as connection:
+        with self._connect() as connection:
             statement = (select(self.category_table)
                 .where(self.category_table.c.book_id == book_id)
                 .order_by(self.category_table.c.title.asc())
@@ -312,7 +746,7 @@ class DB:
                         title: Optional[str] = None,
                         deleted: Optional[bool] = None) -> Any:
         """Get category from DB."""
-        with self.engine.connect() as connection:
+        with self._connect() as connection:
             statement = select(self.category_table).where(self.category_table.c.book_id == book_id)
             if id is not None:
                 statement = statement.where(self.category_table.c.id == id)
@@ -328,74 +762,186 @@ class DB:
             category_record = connection.execute(statement).first()
         return category_record
 
+    def get_category_tree(self, book_id: int) -> CategoryTree:
+        """Get active categories of the book, cached until they change."""
+        return self.category_trees.get_or_set(
+            book_id, functools.partial(self._load_category_tree, book_id))
+
+    def _load_category_tree(self, book_id: int) -> CategoryTree:
+        """Load active categories of the book."""
+        with self._connect() as connection:
+            statement = (select(self.category_table)
+                .where(self.category_table.c.book_id == book_id)
+                .where(self.category_table.c.deleted == False)
+                .order_by(self.category_table.c.title.asc()))
+            categories = connection.execute(statement).all()
+        return CategoryTree(categories)
+
+    def _invalidate_category_tree(self, book_id: int) -> None:
+        """Drop cached category tree of the book."""
+        self._invalidate('category_trees', book_id)
+
+    def _get_category_book_id(self, connection: Connection, id: int) -> Optional[int]:
+        """Returns id of the book the category belongs to."""
+        return connection.execute(
+            select(self.category_table.c.book_id)
+            .where(self.category_table.c.id == id)
+        ).scalar()
+
     def add_category(self, **kwargs):
         """Insert new category."""
-        with self.engine.connect() as connection:
+        with self._transaction() as connection:
             category_id = connection.execute(
                 insert(self.category_table).values(**kwargs)).inserted_primary_key.id
-            connection.commit()
+            self._bump_data_version(connection, kwargs['book_id'])
+        self._invalidate_category_tree(kwargs['book_id'])
         return category_id
 
     def update_category(self, id: int, **kwargs):
         """Update category."""
-        with self.engine.connect() as connection:
+        with self._transaction() as connection:
             connection.execute(update(self.category_table)
                 .where(self.category_table.c.id == id)
                 .values(**kwargs))
-            connection.commit()
-
-    def _delete_category(self, connection: Connection, id: int):
-        """Delete category."""
-        connection.execute(update(self.category_table)
-            .where(self.category_table.c.id == id)
-            .values(deleted=True))
-        statement = select(self.category_table).where(self.category_table.c.parent_id == id)
-        categories = connection.execute(statement).all()
-        for category in categories:
-            self._delete_category(connection, category.id)
+            book_id = self._get_category_book_id(connection, id)
+            self._bump_data_version(connection, book_id)
+        self._invalidate_category_tree(book_id)
 
     def delete_category(self, id: int):
-        """Delete category."""
-        with self.engine.connect() as connection:
-            self._delete_category(connection, id)
-            connection.commit()
+        """Delete category and all its subcategories with one statement."""
+        subtree = (select(self.category_table.c.id)
+            .where(self.category_table.c.id == id)
+            .cte('subtree', recursive=True))
+        subtree = subtree.union(
+            select(self.category_table.c.id)
+            .where(self.category_table.c.parent_id == subtree.c.id))
+        with self._transaction() as connection:
+            connection.execute(update(self.category_table)
+                .where(self.category_table.c.id.in_(select(subtree.c.id)))
+                .values(deleted=True))
+            book_id = self._get_category_book_id(connection, id)
+            self._bump_data_version(connection, book_id)
+        self._invalidate_category_tree(book_id)
 
     def _add_categories(
             self,
             connection: Connection,
             book_id: int,
-            category_type: str,
-            parent_id: int,
-            categories: dict[str, Any]
+            categories: dict[CategoryType, dict[str, Any]]
     ) -> None:
-        """Recursively add categories to specified book."""
-        for category in categories:
-            category_id = connection.execute(
-                insert(self.category_table).values(
-                    book_id=book_id,
-                    parent_id=parent_id,
-                    category_type=category_type,
-                    title=category,
-                    deleted=False
-                )
-            ).inserted_primary_key.id
-            self._add_categories(
-                connection=connection,
-                book_id=book_id,
-                category_type=category_type,
-                parent_id=category_id,
-                categories=categories[category]
-            )
-
+        """Add category trees to specified book, one INSERT per tree level."""
+        level = {
+            (category_type, 0): subcategories
+            for category_type, subcategories in categories.items()
+        }
+        while level:
+            rows = [
+                {
+                    'book_id': book_id,
+                    'parent_id': parent_id,
+                    'category_type': category_type,
+                    'title': title,
+                    'deleted': False,
+                }
+                for (category_type, parent_id), subcategories in level.items()
+                for title in subcategories
+            ]
+            if not rows:
+                return
+            inserted = connection.execute(
+                insert(self.category_table).returning(
+                    self.category_table.c.id,
+                    self.category_table.c.parent_id,
+                    self.category_table.c.category_type,
+                    self.category_table.c.title
+                ),
+                rows
+            ).all()
+            level = {
+                (category.category_type, category.id):
+                    level[(category.category_type, category.parent_id)][category.title]
+                for category in inserted
+            }
 
     def add_expense(self, **kwargs):
-        """Insert new expense."""
-        with self.engine.connect() as connection:
+        """Insert new expense and account it in monthly rollup."""
+        with self._transaction() as connection:
             expense_id = connection.execute(
                 insert(self.expense_table).values(**kwargs)).inserted_primary_key.id
-            connection.commit()
+            if not kwargs.get('deleted'):
+                self._update_expense_rollup(
+                    connection=connection,
+                    book_id=kwargs['book_id'],
+                    category_type=kwargs.get('category_type', CategoryType.EXPENSE),
+                    category_id=kwargs.get('category_id', 0),
+                    year=kwargs['year'],
+                    month=kwargs['month'],
+                    amount=kwargs['amount'],
+                    count=1
+                )
+                self._bump_data_version(connection, kwargs['book_id'])
         return expense_id
 
+    def _update_expense_rollup(
+            self,
+            connection: Connection,
+            book_id: int,
+            category_type: CategoryType,
+            category_id: int,
+            year: int,
+            month: int,
+            amount: float,
+            count: int
+    ) -> None:
+        """Add amount and number of expenses to relevant rollup row."""
+        statement = sqlite_insert(self.expense_rollup_table).values(
+            book_id=book_id,
+            category_type=category_type,
+            category_id=category_id,
+            year=year,
+            month=month,
+            amount=amount,
+            count=count
+        )
+        connection.execute(statement.on_conflict_do_update(
+            index_elements=[
+                self.expense_rollup_table.c.book_id,
+                self.expense_rollup_table.c.category_type,
+                self.expense_rollup_table.c.year,
+                self.expense_rollup_table.c.month,
+                self.expense_rollup_table.c.category_id,
+            ],
+            set_={
+                'amount': self.expense_rollup_table.c.amount + statement.excluded.amount,
+                'count': self.expense_rollup_table.c.count + statement.excluded.count,
+            }
+        ))
+
+    def rebuild_expense_rollups(self) -> None:
+        """Recalculate monthly rollup from scratch using expenses table."""
+        with self._transaction() as connection:
+            connection.execute(delete(self.expense_rollup_table))
+            connection.execute(insert(self.expense_rollup_table).from_select(
+                ['book_id', 'category_type', 'category_id', 'year', 'month', 'amount', 'count'],
+                select(
+                    self.expense_table.c.book_id,
+                    self.expense_table.c.category_type,
+                    self.expense_table.c.category_id,
+                    self.expense_table.c.year,
+                    self.expense_table.c.month,
+                    func.sum(self.expense_table.c.amount),
+                    func.count(self.expense_table.c.id)
+                )
+                .where(self.expense_table.c.deleted == False)
+                .group_by(
+                    self.expense_table.c.book_id,
+                    self.expense_table.c.category_type,
+                    self.expense_table.c.category_id,
+                    self.expense_table.c.year,
+                    self.expense_table.c.month
+                )
+            ))
+
     def get_expenses(
         self, *,
         book_id: int,
@@ -405,23 +951,27 @@ class DB:
         day: Optional[int] = None
     ):
         """Returns expenses."""
-        with self.engine.connect() as connection:
+        if day is None:
+            table = self.expense_rollup_table
+        else:
+            table = self.expense_table
+        with self._connect() as connection:
             statement = (
-                select(func.sum(self.expense_table.c.amount).label('amount'))
-                .select_from(self.expense_table)
-                .where(self.expense_table.c.book_id == book_id)
-                # .where(self.expense_table.c.category_type == CategoryType.EXPENSE)
-                .where(self.expense_table.c.deleted == False)
+                select(func.sum(table.c.amount).label('amount'))
+                .select_from(table)
+                .where(table.c.book_id == book_id)
                 .order_by(asc('amount'))
             )
+            if day is not None:
+                statement = (statement
+                    .where(table.c.deleted == False)
+                    .where(table.c.day == day))
             if category_id is not None:
-                statement = statement.where(self.expense_table.c.category_id == category_id)
+                statement = statement.where(table.c.category_id == category_id)
             if year is not None:
-                statement = statement.where(self.expense_table.c.year == year)
+                statement = statement.where(table.c.year == year)
             if month is not None:
-                statement = statement.where(self.expense_table.c.month == month)
-            if day is not None:
-                statement = statement.where(self.expense_table.c.day == day)
+                statement = statement.where(table.c.month == month)
             expenses = connection.execute(statement).first()
         return expenses.amount
 
@@ -433,31 +983,47 @@ class DB:
         month: Optional[int] = None,
         day: Optional[int] = None
     ):
-        """Returns expenses groupped by categories within specified dates."""
-        with self.engine.connect() as connection:
+        """Returns expenses groupped by categories within specified dates.
+
+        Every row also carries category options and monthly limit parsed
+        from them, so callers don't need to fetch categories one by one.
+        """
+        if day is None:
+            table = self.expense_rollup_table
+        else:
+            table = self.expense_table
+        with self._connect() as connection:
+            options = self.category_table.c.options
             statement = (select(
-                    self.expense_table.c.category_id.label('category_id'),
+                    table.c.category_id.label('category_id'),
                     self.category_table.c.title.label('category_title'),
-                    func.sum(self.expense_table.c.amount).label('amount')
+                    options.label('category_options'),
+                    case(
+                        (func.json_valid(options) == 1,
+                         func.json_extract(options, '$.monthly_limit')),
+                        else_=None
+                    ).label('monthly_limit'),
+                    func.sum(table.c.amount).label('amount')
                 )
-                .select_from(self.expense_table)
+                .select_from(table)
                 .join(
                     self.category_table,
-                    self.expense_table.c.category_id == self.category_table.c.id,
+                    table.c.category_id == self.category_table.c.id,
                     isouter=True
                 )
-                .where(self.expense_table.c.book_id == book_id)
-                .where(self.expense_table.c.category_type == category_type)
-                .where(self.expense_table.c.deleted == False)
-                .group_by(self.expense_table.c.category_id)
+                .where(table.c.book_id == book_id)
+                .where(table.c.category_type == category_type)
+                .group_by(table.c.category_id)
                 .order_by(asc('amount'))
             )
+            if day is not None:
+                statement = (statement
+                    .where(table.c.deleted == False)
+                    .where(table.c.day == day))
             if year is not None:
-                statement = statement.where(self.expense_table.c.year == year)
+                statement = statement.where(table.c.year == year)
             if month is not None:
-                statement = statement.where(self.expense_table.c.month == month)
-            if day is not None:
-                statement = statement.where(self.expense_table.c.day == day)
+                statement = statement.where(table.c.month == month)
             expenses = connection.execute(statement).all()
         return expenses
 
@@ -469,7 +1035,7 @@ class DB:
             month: int
     ) -> Any:
         """Returns expenses groupped by days within specified month."""
-        with self.engine.connect() as connection:
+        with self._connect() as connection:
             statement = (select(
                     self.expense_table.c.day,
                     func.sum(self.expense_table.c.amount).label('amount')
@@ -493,19 +1059,19 @@ class DB:
             category_type: Optional[CategoryType]
     ) -> Any:
         """Returns expenses groupped by years within specified book."""
-        with self.engine.connect() as connection:
+        with self._connect() as connection:
             statement = (select(
-                    self.expense_table.c.year,
-                    func.sum(self.expense_table.c.amount).label('amount')
+                    self.expense_rollup_table.c.year,
+                    func.sum(self.expense_rollup_table.c.amount).label('amount')
                 )
-                .select_from(self.expense_table)
-                .where(self.expense_table.c.book_id == book_id)
-                .where(self.expense_table.c.deleted == False)
-                .group_by(self.expense_table.c.year)
-                .order_by(self.expense_table.c.year.asc())
+                .select_from(self.expense_rollup_table)
+                .where(self.expense_rollup_table.c.book_id == book_id)
+                .group_by(self.expense_rollup_table.c.year)
+                .order_by(self.expense_rollup_table.c.year.asc())
             )
             if category_type is not None:
-                statement = statement.where(self.expense_table.c.category_type == category_type)
+                statement = statement.where(
+                    self.expense_rollup_table.c.category_type == category_type)
             expenses = connection.execute(statement).all()
         return expenses
 
@@ -516,20 +1082,20 @@ class DB:
             year: int
     ) -> Any:
         """Returns expenses groupped by month within specified year and book."""
-        with self.engine.connect() as connection:
+        with self._connect() as connection:
             statement = (select(
-                    self.expense_table.c.month,
-                    func.sum(self.expense_table.c.amount).label('amount')
+                    self.expense_rollup_table.c.month,
+                    func.sum(self.expense_rollup_table.c.amount).label('amount')
                 )
-                .select_from(self.expense_table)
-                .where(self.expense_table.c.book_id == book_id)
-                .where(self.expense_table.c.year == year)
-                .where(self.expense_table.c.deleted == False)
-                .group_by(self.expense_table.c.month)
-                .order_by(self.expense_table.c.month.asc())
+                .select_from(self.expense_rollup_table)
+                .where(self.expense_rollup_table.c.book_id == book_id)
+                .where(self.expense_rollup_table.c.year == year)
+                .group_by(self.expense_rollup_table.c.month)
+                .order_by(self.expense_rollup_table.c.month.asc())
             )
             if category_type is not None:
-                statement = statement.where(self.expense_table.c.category_type == category_type)
+                statement = statement.where(
+                    self.expense_rollup_table.c.category_type == category_type)
             expenses = connection.execute(statement).all()
         return expenses
 
@@ -541,7 +1107,7 @@ class DB:
                             offset: Optional[int] = 0,
                             number: Optional[int] = 100) -> list[Any]:
         """Get sahred books from DB."""
-        with self.engine.connect() as connection:
+        with self._connect() as connection:
             statement = (select(
                     self.shared_book_table.c.id.label('id'),
                     self.shared_book_table.c.book_id.label('book_id'),
@@ -579,7 +1145,7 @@ class DB:
                     disabled: Optional[bool] = None,
                     deleted: Optional[bool] = None) -> Any:
         """Get shared book from DB."""
-        with self.engine.connect() as connection:
+        with self._connect() as connection:
             statement = (select(
                     self.shared_book_table.c.id.label('id'),
                     self.shared_book_table.c.book_id.label('book_id'),
@@ -612,16 +1178,180 @@ class DB:
 
     def add_shared_book(self, **kwargs) -> int:
         """Insert new shared book and return its id."""
-        with self.engine.connect() as connection:
+        with self._transaction() as connection:
             id = connection.execute(
                 insert(self.shared_book_table).values(**kwargs)).inserted_primary_key.id
-            connection.commit()
+        self._invalidate('active_books', (kwargs['user_id'], kwargs['book_id']))
         return id
 
     def update_shared_book(self, id: int, **kwargs):
         """Update book."""
-        with self.engine.connect() as connection:
+        with self._transaction() as connection:
             connection.execute(update(self.shared_book_table)
                 .where(self.shared_book_table.c.id == id)
                 .values(**kwargs))
-            connection.commit()
+            shared_book = connection.execute(
+                select(self.shared_book_table.c.user_id, self.shared_book_table.c.book_id)
+                .where(self.shared_book_table.c.id == id)
+            ).first()
+        if shared_book:
+            self._invalidate('active_books', (shared_book.user_id, shared_book.book_id))
+
+    def get_telegram_file_id(self, content_hash: str) -> Optional[str]:
+        """Returns Telegram file_id of previously uploaded file."""
+        with self._connect() as connection:
+            return connection.execute(
+                select(self.telegram_file_table.c.file_id)
+                .where(self.telegram_file_table.c.content_hash == content_hash)
+            ).scalar()
+
+    def set_telegram_file_id(self, content_hash: str, file_id: str) -> None:
+        """Stores Telegram file_id of uploaded file.
+
+        Record is committed in its own short transaction instead of current
+        unit of work, so the update does not hold write lock while the rest
+        of the report is being sent. It is just a cache, so a failure to
+        store it is ignored.
+        """
+        statement = sqlite_insert(self.telegram_file_table).values(
+            content_hash=content_hash,
+            file_id=file_id,
+            created=datetime.utcnow()
+        )
+        statement = statement.on_conflict_do_update(
+            index_elements=[self.telegram_file_table.c.content_hash],
+            set_={'file_id': statement.excluded.file_id, 'created': statement.excluded.created}
+        )
+        try:
+            with self.engine.begin() as connection:
+                connection.execute(statement)
+        except OperationalError:
+            pass
+
+
+    def get_fsm_record(self, key: str) -> Optional[Any]:
+        """Returns FSM state and data stored for the key."""
+        with self._connect() as connection:
+            return connection.execute(
+                select(
+                    self.fsm_state_table.c.state,
+                    self.fsm_state_table.c.data,
+                    self.fsm_state_table.c.updated
+                )
+                .where(self.fsm_state_table.c.key == key)
+            ).first()
+
+    def set_fsm_records(self, records: list[dict[str, Any]]) -> None:
+        """Stores FSM states and data in one transaction.
+
+        Records with neither state nor data are deleted. Transaction is
+        separate from current unit of work, as states are written in
+        background.
+        """
+        empty_keys = [
+            record['key'] for record in records
+            if record['state'] is None and record['data'] == '{}'
+        ]
+        records = [record for record in records if record['key'] not in empty_keys]
+        with self.engine.begin() as connection:
+            if empty_keys:
+                connection.execute(
+                    delete(self.fsm_state_table)
+                    .where(self.fsm_state_table.c.key.in_(empty_keys))
+                )
+            if records:
+                statement = sqlite_insert(self.fsm_state_table)
+                statement = statement.on_conflict_do_update(
+                    index_elements=[self.fsm_state_table.c.key],
+                    set_={
+                        'state': statement.excluded.state,
+                        'data': statement.excluded.data,
+                        'updated': statement.excluded.updated,
+                    }
+                )
+                connection.execute(statement, records)
+
+    def delete_expired_fsm_records(self, updated_before: datetime) -> int:
+        """Deletes FSM states not changed since specified time."""
+        with self.engine.begin() as connection:
+            return connection.execute(
+                delete(self.fsm_state_table)
+                .where(self.fsm_state_table.c.updated < updated_before)
+            ).rowcount
+
+
+class AsyncDB:
+    """Awaitable facade for DB.
+
+    Exposes the same methods as DB, but every call is executed in a
+    dedicated thread pool, so blocking SQL never stalls the event loop.
+    Calls of a unit of work are made one by one, so they share its
+    connection safely whatever thread of the pool runs them. Pool must
+    have more threads than units of work: otherwise units waiting for
+    SQLite lock could take all of them, and the unit holding the lock
+    would never get a thread to commit.
+    """
+    db: DB
+    executor: ThreadPoolExecutor
+    units_of_work: asyncio.Semaphore
+
+    def __init__(
+            self,
+            db: DB,
+            max_workers: Optional[int] = None,
+            max_units_of_work: int = 10
+    ) -> None:
+        self.db = db
+        self.executor = ThreadPoolExecutor(
+            max_workers=max_workers,
+            thread_name_prefix='db'
+        )
+        self.units_of_work = asyncio.Semaphore(max_units_of_work)
+
+    def __getattr__(self, name: str) -> Any:
+        attr = getattr(self.db, name)
+        if name.startswith('_') or not callable(attr):
+            return attr
+        method = self._wrap(attr)
+        setattr(self, name, method)
+        return method
+
+    async def _run(self, func: Callable[..., Any], *args, **kwargs) -> Any:
+        """Run blocking function in the thread pool within current context."""
+        loop = asyncio.get_running_loop()
+        context = contextvars.copy_context()
+        return await loop.run_in_executor(
+            self.executor,
+            functools.partial(context.run, func, *args, **kwargs)
+        )
+
+    def _wrap(self, func: Callable[..., Any]) -> Callable[..., Any]:
+        """Turns blocking DB method into coroutine function."""
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            return await self._run(func, *args, **kwargs)
+        return wrapper
+
+    @asynccontextmanager
+    async def unit_of_work(self) -> AsyncIterator[None]:
+        """Run all DB calls within the block in one transaction.
+
+        Handler may commit changes made so far with commit_unit_of_work,
+        e.g. before it replies, so the lock is not held meanwhile.
+        """
+        async with self.units_of_work:
+            unit_of_work = await self._run(self.db._begin_unit_of_work)
+            token = self.db._unit_of_work.set(unit_of_work)
+            try:
+                yield
+            except BaseException:
+                await self._run(self.db._end_unit_of_work, unit_of_work, False)
+                raise
+            else:
+                await self._run(self.db._end_unit_of_work, unit_of_work, True)
+            finally:
+                self.db._unit_of_work.reset(token)
+
+    def shutdown(self) -> None:
+        """Waits for pending calls and releases worker threads."""
+        self.executor.shutdown(wait=True)
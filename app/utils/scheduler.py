@@ -0,0 +1,132 @@
+"""Scheduling of heavy jobs."""
+
+import asyncio
+import heapq
+import itertools
+from typing import Any, Awaitable, Callable, Optional
+
+
+class QueueFull(Exception):
+    """Raised when job can't be queued because queue is full."""
+
+
+class JobScheduler:
+    """Runs jobs with bounded concurrency, queueing the rest by priority.
+
+    Jobs with lower priority value run first, jobs with equal priority run
+    in order of arrival. Queue is bounded too, so under overload jobs
+    are rejected instead of waiting for unbounded time. If the queue is
+    full, the latest job with the lowest priority is rejected, so urgent
+    jobs still get queued. Jobs with priority below min_rejected_priority
+    are never rejected, they are queued even above max_queue.
+    """
+    max_concurrency: int
+    max_queue: int
+    min_rejected_priority: Optional[int]
+    running: int
+    submitted: int
+    delayed: int
+    rejected: int
+    max_queued: int
+
+    def __init__(
+        self,
+        max_concurrency: int,
+        max_queue: int,
+        min_rejected_priority: Optional[int] = None
+    ) -> None:
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.min_rejected_priority = min_rejected_priority
+        self.running = 0
+        self.submitted = 0
+        self.delayed = 0
+        self.rejected = 0
+        self.max_queued = 0
+        self._queue: list[tuple[int, int, asyncio.Future]] = []
+        self._counter = itertools.count()
+
+    async def run(
+        self,
+        priority: int,
+        job: Callable[[], Awaitable[Any]],
+        on_queued: Optional[Callable[[int], Awaitable[None]]] = None
+    ) -> Any:
+        """Runs job once there is a free slot and returns its result.
+
+        If job has to wait, on_queued is called with its position in queue.
+        Raises QueueFull if the job is rejected.
+        """
+        await self._acquire(priority, on_queued)
+        try:
+            return await job()
+        finally:
+            self._release()
+
+    async def _acquire(
+        self,
+        priority: int,
+        on_queued: Optional[Callable[[int], Awaitable[None]]]
+    ) -> None:
+        """Waits for free slot."""
+        self.submitted += 1
+        if self.running < self.max_concurrency and not self._queue:
+            self.running += 1
+            return
+        if len(self._queue) >= self.max_queue:
+            evicted = max(self._queue)
+            if evicted[0] > priority and self._rejectable(evicted[0]):
+                self._queue.remove(evicted)
+                heapq.heapify(self._queue)
+                self.rejected += 1
+                evicted[2].set_exception(QueueFull())
+            elif self._rejectable(priority):
+                self.rejected += 1
+                raise QueueFull()
+        future = asyncio.get_running_loop().create_future()
+        entry = (priority, next(self._counter), future)
+        heapq.heappush(self._queue, entry)
+        self.delayed += 1
+        self.max_queued = max(self.max_queued, len(self._queue))
+        try:
+            if on_queued:
+                await on_queued(sum(1 for other in self._queue if other[:2] < entry[:2]) + 1)
+            await future
+        except BaseException:
+            if future.done() and not future.cancelled():
+                if future.exception() is None:
+                    # Slot was already handed over to this job, pass it on.
+                    self._release()
+            else:
+                future.cancel()
+                self._queue.remove(entry)
+                heapq.heapify(self._queue)
+            raise
+
+    def _rejectable(self, priority: int) -> bool:
+        """Returns True if job with the priority may be rejected or evicted."""
+        return self.min_rejected_priority is None or priority >= self.min_rejected_priority
+
+    def _release(self) -> None:
+        """Hands slot over to the next queued job or frees it."""
+        while self._queue:
+            _, _, future = heapq.heappop(self._queue)
+            if not future.done():
+                future.set_result(None)
+                return
+        self.running -= 1
+
+    def stats(self) -> dict[str, Any]:
+        """Returns counters of jobs and current queue depth per priority."""
+        queued_by_priority = {}
+        for priority, _, _ in self._queue:
+            queued_by_priority[priority] = queued_by_priority.get(priority, 0) + 1
+        return {
+            'running': self.running,
+            'queued': len(self._queue),
+            'queued_by_priority': queued_by_priority,
+            'max_queued': self.max_queued,
+            'submitted': self.submitted,
+            'delayed': self.delayed,
+            'rejected': self.rejected,
+        }
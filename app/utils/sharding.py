@@ -0,0 +1,232 @@
+"""Routing of updates between bot worker processes."""
+
+import asyncio
+import bisect
+import functools
+import hashlib
+import logging
+import multiprocessing
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Awaitable, Callable, Hashable, Optional
+
+# Seconds worker waits for a message before checking that front is alive.
+POLL_INTERVAL = 1
+
+
+class HashRing:
+    """Consistent hashing of keys to shards.
+
+    Every shard owns many points of the ring, so keys are spread evenly
+    and changing number of shards moves only a share of keys.
+    """
+    points: list[int]
+    shards: list[int]
+
+    def __init__(self, shards: int, replicas: int = 128) -> None:
+        ring = sorted(
+            (self._hash(f'{shard}:{replica}'), shard)
+            for shard in range(shards)
+            for replica in range(replicas)
+        )
+        self.points = [point for point, _ in ring]
+        self.shards = [shard for _, shard in ring]
+
+    @staticmethod
+    def _hash(value: str) -> int:
+        """Returns stable hash of the value."""
+        return int.from_bytes(hashlib.blake2b(value.encode(), digest_size=8).digest(), 'big')
+
+    def shard(self, key: Hashable) -> int:
+        """Returns shard of the key."""
+        index = bisect.bisect(self.points, self._hash(str(key)))
+        return self.shards[index % len(self.shards)]
+
+
+def update_key(update: dict[str, Any]) -> int:
+    """Returns id of the user the raw update comes from, or of its chat.
+
+    FSM state is stored per user, so all updates of a user have to be
+    handled by the same worker and in order.
+    """
+    for event in update.values():
+        if not isinstance(event, dict):
+            continue
+        if 'from' in event:
+            return event['from']['id']
+        if 'chat' in event:
+            return event['chat']['id']
+        if 'user' in event:
+            return event['user']['id']
+    return update.get('update_id', 0)
+
+
+class ShardRouter:
+    """Runs worker processes and routes raw updates between them.
+
+    Workers report committed changes to the shared invalidation bus and
+    the router passes them to all other workers, so their caches stay
+    coherent.
+    """
+    shards: int
+    ring: HashRing
+    processes: list[multiprocessing.Process]
+    inboxes: list[multiprocessing.Queue]
+    bus: multiprocessing.Queue
+    routed: list[int]
+    invalidations: int
+
+    def __init__(self, shards: int, target: Callable[..., None]) -> None:
+        self.shards = shards
+        self.ring = HashRing(shards)
+        # Workers are spawned, so they don't inherit event loop, threads and
+        # connections of the front process. They are not daemons, as they run
+        # chart workers of their own, and exit once the front is gone.
+        context = multiprocessing.get_context('spawn')
+        self.inboxes = [context.Queue() for _ in range(shards)]
+        self.bus = context.Queue()
+        self.processes = [
+            context.Process(
+                target=target,
+                args=(shard, self.inboxes[shard], self.bus),
+                name=f'shard-{shard}'
+            )
+            for shard in range(shards)
+        ]
+        self.routed = [0] * shards
+        self.invalidations = 0
+        self._bus_thread = threading.Thread(target=self._forward_invalidations, daemon=True)
+
+    def start(self) -> None:
+        """Starts workers."""
+        for process in self.processes:
+            process.start()
+        self._bus_thread.start()
+
+    def route(self, update: dict[str, Any]) -> None:
+        """Passes raw update to the worker of its user."""
+        key = update_key(update)
+        shard = self.ring.shard(key)
+        self.routed[shard] += 1
+        self.inboxes[shard].put(('update', key, update))
+
+    def _forward_invalidations(self) -> None:
+        """Passes invalidations reported by a worker to all other workers."""
+        while True:
+            message = self.bus.get()
+            if message is None:
+                return
+            source, cache, key = message
+            self.invalidations += 1
+            for shard, inbox in enumerate(self.inboxes):
+                if shard != source:
+                    inbox.put(('invalidate', cache, key))
+
+    def stop(self, timeout: float = 10) -> None:
+        """Asks workers to finish pending updates and waits for them."""
+        for inbox in self.inboxes:
+            inbox.put(None)
+        for process in self.processes:
+            process.join(timeout)
+            if process.is_alive():
+                process.terminate()
+        self.bus.put(None)
+        self._bus_thread.join()
+
+    def stats(self) -> dict[str, Any]:
+        """Returns counters of routed updates and invalidations."""
+        return {
+            'routed': list(self.routed),
+            'invalidations': self.invalidations,
+        }
+
+
+class ShardConsumer:
+    """Worker side of ShardRouter.
+
+    Updates of the same user are handled one by one in order of arrival,
+    updates of different users are handled concurrently.
+    """
+    shard: int
+    inbox: multiprocessing.Queue
+    bus: multiprocessing.Queue
+    max_concurrency: int
+    handled: int
+
+    def __init__(
+        self,
+        shard: int,
+        inbox: multiprocessing.Queue,
+        bus: multiprocessing.Queue,
+        max_concurrency: int
+    ) -> None:
+        self.shard = shard
+        self.inbox = inbox
+        self.bus = bus
+        self.max_concurrency = max_concurrency
+        self.handled = 0
+        self._tails: dict[int, asyncio.Task] = {}
+        self._reader = ThreadPoolExecutor(max_workers=1, thread_name_prefix='shard-inbox')
+
+    def publish_invalidation(self, cache: str, key: Hashable) -> None:
+        """Reports committed change to other workers, safe to call from any thread."""
+        self.bus.put((self.shard, cache, key))
+
+    async def run(
+        self,
+        handle_update: Callable[[dict[str, Any]], Awaitable[Any]],
+        drop_cached: Callable[[str, Hashable], None]
+    ) -> None:
+        """Handles messages from the router until it asks to stop."""
+        loop = asyncio.get_running_loop()
+        slots = asyncio.Semaphore(self.max_concurrency)
+        try:
+            while True:
+                message = await loop.run_in_executor(self._reader, self._get)
+                if message is None:
+                    break
+                if message[0] == 'invalidate':
+                    drop_cached(message[1], message[2])
+                    continue
+                _, key, update = message
+                previous = self._tails.get(key)
+                task = asyncio.create_task(self._handle(previous, slots, handle_update, update))
+                self._tails[key] = task
+                task.add_done_callback(functools.partial(self._forget, key))
+            if self._tails:
+                await asyncio.wait(list(self._tails.values()))
+        finally:
+            self._reader.shutdown(wait=False)
+
+    def _forget(self, key: int, task: asyncio.Task) -> None:
+        """Drops handled task unless next update of the user is waiting for it."""
+        if self._tails.get(key) is task:
+            del self._tails[key]
+
+    def _get(self) -> Optional[tuple]:
+        """Returns next message, or None once router is gone."""
+        while True:
+            try:
+                return self.inbox.get(timeout=POLL_INTERVAL)
+            except queue.Empty:
+                parent = multiprocessing.parent_process()
+                if parent is not None and not parent.is_alive():
+                    return None
+
+    async def _handle(
+        self,
+        previous: Optional[asyncio.Task],
+        slots: asyncio.Semaphore,
+        handle_update: Callable[[dict[str, Any]], Awaitable[Any]],
+        update: dict[str, Any]
+    ) -> None:
+        """Handles update once previous update of the same user is handled."""
+        if previous is not None:
+            await asyncio.wait([previous])
+        async with slots:
+            try:
+                await handle_update(update)
+            except Exception:
+                logging.exception('Shard %s failed to handle update %s', self.shard, update)
+            self.handled += 1
@@ -0,0 +1,212 @@
+"""FSM storage backed by the database."""
+
+import asyncio
+import contextvars
+import copy
+import enum
+import json
+import logging
+import time
+from datetime import datetime, timedelta
+from typing import Any, Mapping, Optional
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, DefaultKeyBuilder, StateType, StorageKey
+from sqlalchemy.exc import OperationalError
+
+from utils import CategoryType
+from utils import models
+
+# Enums that may be stored in FSM data.
+ENUMS = {enum_type.__name__: enum_type for enum_type in (CategoryType,)}
+
+
+def _encode(value: Any) -> Any:
+    """Encodes values that JSON does not support."""
+    if isinstance(value, enum.Enum) and type(value).__name__ in ENUMS:
+        return {'__enum__': type(value).__name__, 'name': value.name}
+    raise TypeError(f'{type(value).__name__} can not be stored in FSM data')
+
+
+def _decode(value: dict[str, Any]) -> Any:
+    """Decodes values encoded by _encode."""
+    if '__enum__' in value:
+        return ENUMS[value['__enum__']][value['name']]
+    return value
+
+
+class StateRecord:
+    """Cached state and data of one dialog."""
+    state: Optional[str]
+    data: dict[str, Any]
+    updated: datetime
+    accessed: float
+    dirty: bool
+
+    def __init__(self, state: Optional[str], data: dict[str, Any], updated: datetime) -> None:
+        self.state = state
+        self.data = data
+        self.updated = updated
+        self.accessed = time.monotonic()
+        self.dirty = False
+
+
+class DBStorage(BaseStorage):
+    """FSM storage keeping dialogs in the database, so they survive restarts.
+
+    Changes are kept in process memory and written to the database in
+    background every flush_interval seconds and on close. So a state must
+    be changed by one process only, which holds for shard workers as all
+    updates of a user go to the same worker. Dialogs not changed for ttl
+    seconds are abandoned and expire.
+    """
+    db: models.AsyncDB
+    flush_interval: float
+    ttl: float
+    cache_ttl: float
+    key_builder: DefaultKeyBuilder
+    loads: int
+    flushes: int
+    expired: int
+
+    def __init__(
+        self,
+        db: models.AsyncDB,
+        flush_interval: float = 1,
+        ttl: float = 86400,
+        cache_ttl: float = 600
+    ) -> None:
+        self.db = db
+        self.flush_interval = flush_interval
+        self.ttl = ttl
+        self.cache_ttl = cache_ttl
+        self.key_builder = DefaultKeyBuilder(with_bot_id=True, with_destiny=True)
+        self.loads = 0
+        self.flushes = 0
+        self.expired = 0
+        self._records: dict[str, StateRecord] = {}
+        self._flusher: Optional[asyncio.Task] = None
+        self._purged = 0.0
+
+    async def _record(self, key: StorageKey) -> StateRecord:
+        """Returns cached record of the dialog, loading it if necessary."""
+        record_key = self.key_builder.build(key)
+        record = self._records.get(record_key)
+        if record is None:
+            self.loads += 1
+            row = await self.db.get_fsm_record(record_key)
+            record = self._records.get(record_key)
+            if record is None:
+                if row is None:
+                    record = StateRecord(None, {}, datetime.utcnow())
+                else:
+                    record = StateRecord(
+                        row.state,
+                        json.loads(row.data, object_hook=_decode),
+                        row.updated
+                    )
+                self._records[record_key] = record
+        record.accessed = time.monotonic()
+        if record.updated < datetime.utcnow() - timedelta(seconds=self.ttl):
+            self.expired += 1
+            self._change(record, None, {})
+        return record
+
+    def _change(self, record: StateRecord, state: Optional[str], data: dict[str, Any]) -> None:
+        """Changes cached record and schedules its flush."""
+        record.state = state
+        record.data = data
+        record.updated = datetime.utcnow()
+        record.dirty = True
+        if self._flusher is None or self._flusher.done():
+            # Flusher must not inherit unit of work of the current update.
+            self._flusher = asyncio.create_task(
+                self._flush_periodically(),
+                context=contextvars.Context()
+            )
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        record = await self._record(key)
+        if isinstance(state, State):
+            state = state.state
+        self._change(record, state, record.data)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        record = await self._record(key)
+        return record.state
+
+    async def set_data(self, key: StorageKey, data: Mapping[str, Any]) -> None:
+        record = await self._record(key)
+        # Fail now rather than on flush if data can't be stored.
+        json.dumps(data, default=_encode)
+        # Nested values are copied too, so changes made by the caller later
+        # can't get into the record without being flushed.
+        self._change(record, record.state, copy.deepcopy(dict(data)))
+
+    async def get_data(self, key: StorageKey) -> dict[str, Any]:
+        record = await self._record(key)
+        return copy.deepcopy(record.data)
+
+    async def _flush_periodically(self) -> None:
+        """Flushes changes until there are none left."""
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except OperationalError as error:
+                logging.warning('FSM states are not flushed, will retry: %s', error)
+                continue
+            self._evict()
+            if not any(record.dirty for record in self._records.values()):
+                return
+
+    async def flush(self) -> None:
+        """Writes changed records to the database."""
+        changed = [(key, record) for key, record in self._records.items() if record.dirty]
+        if changed:
+            for _, record in changed:
+                record.dirty = False
+            try:
+                await self.db.set_fsm_records([
+                    {
+                        'key': key,
+                        'state': record.state,
+                        'data': json.dumps(record.data, default=_encode),
+                        'updated': record.updated,
+                    }
+                    for key, record in changed
+                ])
+            except BaseException:
+                for _, record in changed:
+                    record.dirty = True
+                raise
+            self.flushes += 1
+        if time.monotonic() - self._purged > self.ttl / 24:
+            self._purged = time.monotonic()
+            await self.db.delete_expired_fsm_records(
+                datetime.utcnow() - timedelta(seconds=self.ttl))
+
+    def _evict(self) -> None:
+        """Drops flushed records not used for cache_ttl seconds."""
+        accessed_before = time.monotonic() - self.cache_ttl
+        for key in [
+            key for key, record in self._records.items()
+            if not record.dirty and record.accessed < accessed_before
+        ]:
+            del self._records[key]
+
+    def stats(self) -> dict[str, int]:
+        """Returns counters of cached records, loads and flushes."""
+        return {
+            'records': len(self._records),
+            'dirty': sum(1 for record in self._records.values() if record.dirty),
+            'loads': self.loads,
+            'flushes': self.flushes,
+            'expired': self.expired,
+        }
+
+    async def close(self) -> None:
+        if self._flusher is not None:
+            self._flusher.cancel()
+            self._flusher = None
+        await self.flush()
@@ -0,0 +1,251 @@
+"""Shaping of outgoing Bot API requests to stay within Telegram limits."""
+
+import asyncio
+import contextlib
+import contextvars
+import heapq
+import itertools
+import logging
+import time
+from typing import Any, Iterator, Optional, Union
+
+from aiogram import Bot
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware, NextRequestMiddlewareType
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import (
+    CopyMessage,
+    EditMessageCaption,
+    EditMessageMedia,
+    EditMessageReplyMarkup,
+    EditMessageText,
+    ForwardMessage,
+    Response,
+    SendDocument,
+    SendMediaGroup,
+    SendMessage,
+    SendPhoto,
+    TelegramMethod,
+)
+from aiogram.methods.base import TelegramType
+
+# Requests queued for the global limit are sent in order of priority,
+# lower value first. Replies to user's own updates are interactive, bulk
+# is for messages nobody is waiting for, e.g. broadcasts and backfills.
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BULK = 1
+
+# Methods counted by Telegram flood control, others are never delayed.
+LIMITED_METHODS = (
+    CopyMessage,
+    EditMessageCaption,
+    EditMessageMedia,
+    EditMessageReplyMarkup,
+    EditMessageText,
+    ForwardMessage,
+    SendDocument,
+    SendMediaGroup,
+    SendMessage,
+    SendPhoto,
+)
+# Telegram allows about 20 messages per minute in a group.
+GROUP_RATE = 20 / 60
+# Chat buckets are checked for being unused after this number of requests.
+PRUNE_INTERVAL = 1000
+
+_priority: contextvars.ContextVar[int] = contextvars.ContextVar(
+    'send_priority',
+    default=PRIORITY_INTERACTIVE
+)
+
+
+@contextlib.contextmanager
+def send_priority(priority: int) -> Iterator[None]:
+    """Sends requests made within the block with the given priority."""
+    token = _priority.set(priority)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+
+class TokenBucket:
+    """Allows rate requests per second on average and bursts up to capacity.
+
+    Rate 0 means no limit, bucket only waits for pause set by RetryAfter.
+    """
+    rate: float
+    capacity: float
+    tokens: float
+    updated: float
+    paused_until: float
+    lock: asyncio.Lock
+
+    def __init__(self, rate: float, capacity: float) -> None:
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.lock = asyncio.Lock()
+
+    def _refill(self) -> float:
+        """Adds tokens accumulated since the last call and returns current time."""
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return now
+
+    def delay(self, cost: float) -> float:
+        """Returns seconds to wait until cost tokens are available."""
+        now = self._refill()
+        # Costly requests wait for full bucket rather than forever.
+        missing = min(cost, self.capacity) - self.tokens
+        if self.rate <= 0:
+            return max(self.paused_until - now, 0)
+        return max(self.paused_until - now, missing / self.rate, 0)
+
+    def take(self, cost: float) -> None:
+        """Spends tokens, bucket goes into debt if cost is above capacity."""
+        self._refill()
+        self.tokens -= cost
+
+    def pause(self, seconds: float) -> None:
+        """Allows nothing for the given number of seconds."""
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    def idle(self) -> bool:
+        """Returns True if bucket is full, i.e. it is the same as a new one."""
+        return not self.lock.locked() and self.delay(self.capacity) == 0
+
+
+class SendLimiter(BaseRequestMiddleware):
+    """Bot session middleware delaying messages to stay within flood limits.
+
+    Every chat has a token bucket of its own, requests to the same chat are
+    sent in order of arrival. Then they share the global bucket, where
+    interactive replies overtake bulk ones, see send_priority. Requests
+    rejected with RetryAfter pause their chat and are retried. Rate 0
+    disables the corresponding limit.
+    """
+    chat_rate: float
+    chat_capacity: float
+    max_retries: int
+    global_bucket: TokenBucket
+    requests: int
+    delayed: int
+    max_delay: float
+    retries: int
+    failed: int
+
+    def __init__(
+        self,
+        rate: float = 25,
+        capacity: float = 5,
+        chat_rate: float = 1,
+        chat_capacity: float = 4,
+        max_retries: int = 3
+    ) -> None:
+        self.chat_rate = chat_rate
+        self.chat_capacity = chat_capacity
+        self.max_retries = max_retries
+        self.global_bucket = TokenBucket(rate, capacity)
+        self.requests = 0
+        self.delayed = 0
+        self.max_delay = 0.0
+        self.retries = 0
+        self.failed = 0
+        self._chats: dict[Union[int, str], TokenBucket] = {}
+        self._queue: list[tuple[int, int, float, asyncio.Future]] = []
+        self._counter = itertools.count()
+        self._pump: Optional[asyncio.Task] = None
+
+    async def __call__(
+        self,
+        make_request: NextRequestMiddlewareType[TelegramType],
+        bot: Bot,
+        method: TelegramMethod[TelegramType]
+    ) -> Response[TelegramType]:
+        chat_id = getattr(method, 'chat_id', None)
+        if not isinstance(method, LIMITED_METHODS) or chat_id is None:
+            return await make_request(bot, method)
+        cost = len(method.media) if isinstance(method, SendMediaGroup) else 1
+        bucket = self._chat_bucket(chat_id)
+        for attempt in itertools.count():
+            await self._acquire(bucket, cost)
+            try:
+                return await make_request(bot, method)
+            except TelegramRetryAfter as error:
+                self.retries += 1
+                if attempt >= self.max_retries:
+                    self.failed += 1
+                    raise
+                logging.warning(
+                    'Flood control on %s in chat %s, retrying in %s s',
+                    type(method).__name__, chat_id, error.retry_after
+                )
+                bucket.pause(error.retry_after)
+
+    def _chat_bucket(self, chat_id: Union[int, str]) -> TokenBucket:
+        """Returns bucket of the chat, dropping buckets of idle chats from time to time."""
+        self.requests += 1
+        if not self.requests % PRUNE_INTERVAL:
+            for idle_chat_id in [key for key, bucket in self._chats.items() if bucket.idle()]:
+                del self._chats[idle_chat_id]
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            is_group = isinstance(chat_id, str) or chat_id < 0
+            bucket = TokenBucket(GROUP_RATE if is_group else self.chat_rate, self.chat_capacity)
+            self._chats[chat_id] = bucket
+        return bucket
+
+    async def _acquire(self, bucket: TokenBucket, cost: float) -> None:
+        """Waits until both chat and global limits allow the request."""
+        started = time.monotonic()
+        async with bucket.lock:
+            while (delay := bucket.delay(cost)) > 0:
+                await asyncio.sleep(delay)
+            bucket.take(cost)
+        if self._queue or self.global_bucket.delay(cost) > 0:
+            future = asyncio.get_running_loop().create_future()
+            heapq.heappush(self._queue, (_priority.get(), next(self._counter), cost, future))
+            if self._pump is None or self._pump.done():
+                self._pump = asyncio.create_task(self._release_queued())
+            await future
+        else:
+            self.global_bucket.take(cost)
+        waited = time.monotonic() - started
+        if waited > 0.001:
+            self.delayed += 1
+            self.max_delay = max(self.max_delay, waited)
+
+    async def _release_queued(self) -> None:
+        """Lets queued requests go as global bucket allows."""
+        while self._queue:
+            _, _, cost, future = self._queue[0]
+            if future.done():
+                heapq.heappop(self._queue)
+                continue
+            delay = self.global_bucket.delay(cost)
+            if delay > 0:
+                await asyncio.sleep(delay)
+                continue
+            heapq.heappop(self._queue)
+            self.global_bucket.take(cost)
+            future.set_result(None)
+
+    def stats(self) -> dict[str, Any]:
+        """Returns counters of requests and current queue depth per priority."""
+        queued_by_priority = {}
+        for priority, _, _, future in self._queue:
+            if not future.done():
+                queued_by_priority[priority] = queued_by_priority.get(priority, 0) + 1
+        return {
+            'requests': self.requests,
+            'delayed': self.delayed,
+            'max_delay': round(self.max_delay, 3),
+            'queued_by_priority': queued_by_priority,
+            'waiting_chats': sum(1 for bucket in self._chats.values() if bucket.lock.locked()),
+            'chats': len(self._chats),
+            'retries': self.retries,
+            'failed': self.failed,
+        }